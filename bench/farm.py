@@ -0,0 +1,273 @@
+"""A farm of synthetic Open edX sites, for benchmarking the scraper.
+
+One local aiohttp server impersonates any number of virtual hosts.  The
+behavior of a host is encoded in its name: "tiles-00012.farm.test" serves
+pages of course tiles, "dead-00013.farm.test" doesn't resolve, and so on.
+A custom resolver points all the farm's hosts at the local server.
+
+"""
+
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+
+import aiohttp
+import aiohttp.abc
+import aiohttp.web
+
+
+FARM_DOMAIN = "farm.test"
+
+# The kinds of hosts in the farm.
+#   tiles: /courses and / have course tiles, no course search.
+#   search: /search/course_discovery/ has paginated JSON, no tiles.
+#   redirect: everything redirects to a "tiles" host with the same number.
+#   alias: everything redirects to one of ALIAS_TARGETS shared "tiles" hosts,
+#       like the many domains that point at one LMS.
+#   slow: like "tiles", but every response is delayed.
+#   tls: an https site whose TLS handshake fails.
+#   dead: a host that doesn't resolve.
+KINDS = ["tiles", "search", "redirect", "alias", "slow", "tls", "dead"]
+
+# How many hosts the "alias" hosts redirect to.
+ALIAS_TARGETS = 20
+
+DEFAULT_MIX = "tiles=40,search=25,redirect=10,slow=5,tls=5,dead=15"
+
+
+def parse_mix(mix):
+    """Parse "tiles=40,dead=10" into a dict of weights."""
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError(f"Unknown kind of host: {kind!r}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def farm_urls(num_sites, mix=DEFAULT_MIX, seed=17):
+    """Make a list of `num_sites` site URLs, with kinds in the proportions of `mix`."""
+    weights = parse_mix(mix)
+    kinds = list(weights)
+    rand = random.Random(seed)
+    urls = []
+    for num in range(num_sites):
+        kind = rand.choices(kinds, [weights[k] for k in kinds])[0]
+        scheme = "https" if kind == "tls" else "http"
+        urls.append(f"{scheme}://{kind}-{num:05d}.{FARM_DOMAIN}")
+    return urls
+
+
+def host_kind(host):
+    """Return (kind, number) for a farm host name."""
+    kind, _, rest = host.partition("-")
+    return kind, int(rest.partition(".")[0])
+
+
+def num_courses(num):
+    """How many courses does site number `num` have?"""
+    return 1 + (num * 7) % 40
+
+
+def course_id(num, course):
+    return f"course-v1:Org{num % 50}+CS{course:03d}+2024"
+
+
+# Realistic pages are mostly markup that has nothing to do with courses.
+FILLER = "".join(
+    f'<div class="nav-item"><a href="/page/{i}">Page number {i}</a></div>\n' for i in range(300)
+)
+
+TILES_PAGE = """\
+<!DOCTYPE html>
+<html>
+<head><title>{host}</title>
+<script type="text/javascript" src="/jsi18n/"></script>
+</head>
+<body>
+<header class="global ">{filler}</header>
+<section class="courses"><ul class="courses-listing">
+{tiles}
+</ul></section>
+<footer>Powered by <a href="https://open.edx.org">Open edX</a>.
+Contact us at info@{host}</footer>
+</body>
+</html>
+"""
+
+CONTACT_PAGE = """\
+<!DOCTYPE html>
+<html><head><title>Contact {host}</title></head>
+<body><p>Write to support@{host} for help.</p></body>
+</html>
+"""
+
+TILE = """\
+<li class="courses-listing-item"><article class="course" id="{course_id}">
+<h2 class="course-name">Course {course}</h2>
+<time data-datetime="2020-01-01T00:00:00+00:00">Jan 1, 2020</time>
+</article></li>"""
+
+
+def tiles_page(host, ntiles):
+    tiles = "\n".join(
+        TILE.format(course_id=course_id(host_kind(host)[1], c), course=c) for c in range(ntiles)
+    )
+    return TILES_PAGE.format(host=host, tiles=tiles, filler=FILLER)
+
+
+def search_results(num, page_index, page_size):
+    total = num_courses(num)
+    results = [
+        {
+            "_id": course_id(num, c),
+            "data": {"start": "2020-01-01T00:00:00+00:00", "number": f"CS{c:03d}", "content": {}},
+        }
+        for c in range(page_index * page_size, min(total, (page_index + 1) * page_size))
+    ]
+    return {"total": total, "results": results, "took": random.randint(1, 50)}
+
+
+def course_api_page(host, num, page, page_size):
+    total = num_courses(num)
+    start = (page - 1) * page_size
+    results = [
+        {"id": course_id(num, c), "name": f"Course {c}", "start": "2020-01-01T00:00:00Z"}
+        for c in range(start, min(total, start + page_size))
+    ]
+    num_pages = (total + page_size - 1) // page_size
+    next_url = None
+    if page < num_pages:
+        next_url = f"http://{host}/api/courses/v1/courses/?page={page + 1}&page_size={page_size}"
+    pagination = {"count": total, "num_pages": num_pages, "next": next_url, "previous": None}
+    return {"results": results, "pagination": pagination}
+
+
+class Farm:
+    """The aiohttp application serving all the farm's hosts."""
+
+    def __init__(self, slow_delay, request_count):
+        self.slow_delay = slow_delay
+        self.request_count = request_count
+
+    async def handle(self, request):
+        self.request_count.value += 1
+        host = request.host.partition(":")[0]
+        kind, num = host_kind(host)
+        if kind == "redirect":
+            raise aiohttp.web.HTTPMovedPermanently(f"http://tiles-{num:05d}.{FARM_DOMAIN}{request.path_qs}")
+        if kind == "alias":
+            target = num % ALIAS_TARGETS
+            raise aiohttp.web.HTTPMovedPermanently(f"http://tiles-{target:05d}.{FARM_DOMAIN}{request.path_qs}")
+        if kind == "slow":
+            await asyncio.sleep(self.slow_delay)
+            kind = "tiles"
+
+        path = request.path.rstrip("/")
+        if kind in ["tiles", "search"] and path == "/contact":
+            return aiohttp.web.Response(text=CONTACT_PAGE.format(host=host), content_type="text/html")
+        if kind == "tiles" and path in ["", "/courses"]:
+            return aiohttp.web.Response(text=tiles_page(host, num_courses(num)), content_type="text/html")
+        if kind == "search":
+            # The newer sites, with search, also have the course api.
+            if path == "/api/courses/v1/courses":
+                page = int(request.query.get("page", 1))
+                page_size = int(request.query.get("page_size", 10))
+                data = course_api_page(host, num, page, page_size)
+                return aiohttp.web.Response(text=json.dumps(data), content_type="application/json")
+            if path == "/search/course_discovery":
+                form = await request.post()
+                data = search_results(num, int(form.get("page_index", 0)), int(form.get("page_size", 20)))
+                return aiohttp.web.Response(text=json.dumps(data), content_type="application/json")
+            if path in ["", "/courses"]:
+                resp = aiohttp.web.Response(text=tiles_page(host, 0), content_type="text/html")
+                resp.set_cookie("csrftoken", f"token{num}")
+                return resp
+        raise aiohttp.web.HTTPNotFound()
+
+
+async def _refuse_tls(reader, writer):
+    """A "TLS" server that hangs up on every client."""
+    writer.close()
+
+
+async def _serve(slow_delay, request_count, ports, stop):
+    farm = Farm(slow_delay, request_count)
+    app = aiohttp.web.Application()
+    app.router.add_route("*", "/{tail:.*}", farm.handle)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0, backlog=1024)
+    await site.start()
+    http_port = runner.addresses[0][1]
+    tls_server = await asyncio.start_server(_refuse_tls, "127.0.0.1", 0)
+    tls_port = tls_server.sockets[0].getsockname()[1]
+    ports.send((http_port, tls_port))
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, stop.wait)
+    tls_server.close()
+    await runner.cleanup()
+
+
+def _serve_process(slow_delay, request_count, ports, stop):
+    asyncio.run(_serve(slow_delay, request_count, ports, stop))
+
+
+class FarmServer:
+    """Run the farm in a separate process, so it doesn't skew the scraper's measurements."""
+
+    def __init__(self, slow_delay=2.0):
+        self.slow_delay = slow_delay
+        self.request_count = multiprocessing.Value("q", 0, lock=False)
+        self.stop = multiprocessing.Event()
+        self.process = None
+        self.http_port = self.tls_port = None
+
+    def __enter__(self):
+        ports_recv, ports_send = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=_serve_process,
+            args=(self.slow_delay, self.request_count, ports_send, self.stop),
+            daemon=True,
+        )
+        self.process.start()
+        self.http_port, self.tls_port = ports_recv.recv()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop.set()
+        self.process.join(timeout=10)
+
+    @property
+    def requests(self):
+        return self.request_count.value
+
+    def resolver(self):
+        return FarmResolver(self.http_port, self.tls_port)
+
+
+class FarmResolver(aiohttp.abc.AbstractResolver):
+    """Resolve every farm host to the local farm server."""
+
+    def __init__(self, http_port, tls_port):
+        self.http_port = http_port
+        self.tls_port = tls_port
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        if not host.endswith("." + FARM_DOMAIN) or host.startswith("dead-"):
+            raise OSError(f"Farm host {host} doesn't exist")
+        return [{
+            "hostname": host,
+            "host": "127.0.0.1",
+            "port": self.tls_port if port == 443 else self.http_port,
+            "family": socket.AF_INET,
+            "proto": 0,
+            "flags": socket.AI_NUMERICHOST,
+        }]
+
+    async def close(self):
+        pass
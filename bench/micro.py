@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Microbenchmarks of the CPU-heavy parts of scraping and reporting.
+
+Each benchmark is timed over the pages in bench/corpus, or over synthetic
+state big enough to look like a full referer scrape.  Results are seconds
+per call.  Compare them against a saved baseline to find regressions:
+
+    python micro.py --baseline baseline.json
+
+"""
+
+import collections
+import fnmatch
+import json
+import os
+import random
+import sys
+import timeit
+
+import click
+
+from census.helpers import calc_simhash, elements_by_css, emails_in_text, sniff_tags, sniff_version
+from census.parsers import count_tiles
+from census.sites import Site, courses_and_orgs, overcount
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "corpus")
+BASELINE_JSON = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def corpus(name):
+    with open(os.path.join(CORPUS_DIR, name), "rb") as f:
+        return f.read()
+
+
+def run_sync(coro):
+    """Run a coroutine that never actually suspends."""
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("Coroutine suspended")
+
+
+class CannedSession:
+    """A stand-in for SmartSession that returns the same text for every URL."""
+    def __init__(self, text):
+        self.text = text
+
+    async def text_from_url(self, url, **kwargs):
+        return self.text
+
+
+def synthetic_sites(num_sites=3000, seed=17):
+    """Make sites with course ids, like a big scrape would.
+
+    Many courses are syndicated: the same id shows up on many sites, or the
+    same course number shows up under a different org.
+    """
+    rand = random.Random(seed)
+    shared = [f"course-v1:Microsoft+DAT{n:03d}x+2021_T1" for n in range(200)]
+    sites = []
+    for num in range(num_sites):
+        site = Site.from_url(f"https://site{num}.example.com")
+        org = f"Org{num % 500}"
+        for course in range(rand.randint(1, 60)):
+            site.add_course_id(f"course-v1:{org}+C{course:03d}+2021")
+        if num % 10 == 0:
+            for course_id in rand.sample(shared, 30):
+                site.add_course_id(course_id)
+                site.add_course_id(course_id.replace("Microsoft", org))
+        site.add_course_id(f"not a course id {num}")
+        sites.append(site)
+    return sites
+
+
+def benchmarks():
+    """Return a dict mapping benchmark names to zero-argument functions."""
+    pages = {
+        "small": corpus("small.html"),
+        "large": corpus("large.html"),
+    }
+    search = corpus("search.json")
+    url = "https://courses.example.com"
+    benches = {}
+
+    for size, text in pages.items():
+        def process_text(text=text):
+            Site.from_url(url).process_text(text)
+        benches[f"process_text_{size}"] = process_text
+        def process_site(text=text):
+            site = Site.from_url(url)
+            site.process_text(text)
+            site.finish_pages()
+        benches[f"process_site_{size}"] = process_site
+        benches[f"calc_simhash_{size}"] = lambda text=text: calc_simhash(text)
+        benches[f"sniff_version_{size}"] = lambda text=text: sniff_version(text)
+        benches[f"sniff_tags_{size}"] = lambda text=text: list(sniff_tags(url, text))
+        benches[f"emails_in_text_{size}"] = lambda text=text: list(emails_in_text(text))
+        benches[f"elements_by_css_{size}"] = lambda text=text: elements_by_css(text, ".courses-listing-item")
+        def tiles(text=text):
+            run_sync(count_tiles(url, Site.from_url(url), CannedSession(text)))
+        benches[f"count_tiles_{size}"] = tiles
+
+    def process_json():
+        Site.from_url(url).process_text(search, type="json", emails=False)
+    benches["process_text_json"] = process_json
+    benches["emails_in_text_json"] = lambda: list(emails_in_text(search))
+
+    sites = synthetic_sites()
+    all_courses = courses_and_orgs(sites)[0]
+    benches["courses_and_orgs"] = lambda: courses_and_orgs(sites)
+    benches["overcount"] = lambda: overcount(all_courses)
+    return benches
+
+
+def time_it(func, repeat=5):
+    """Return the best time per call of `func`, in seconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def compare(results, baseline, tolerance):
+    """Print a comparison with the baseline, and return the names that regressed."""
+    regressed = []
+    for name, secs in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:>25}: {secs * 1e6:12.1f} us   (new)")
+            continue
+        ratio = secs / base
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressed.append(name)
+        print(f"{name:>25}: {secs * 1e6:12.1f} us   {ratio:6.2f}x baseline{flag}")
+    return regressed
+
+
+@click.command(help=__doc__)
+@click.option('-k', 'pattern', default="*", help="Only run benchmarks matching this glob")
+@click.option('--save', 'save_file', type=click.File('w'), help="Write results to this JSON file")
+@click.option('--baseline', 'baseline_file', type=click.File('r'), help="Compare against this JSON file")
+@click.option('--update-baseline', is_flag=True, help=f"Write results to {os.path.basename(BASELINE_JSON)}")
+@click.option('--tolerance', type=float, default=0.3, help="Slowdown that counts as a regression")
+def main(pattern, save_file, baseline_file, update_baseline, tolerance):
+    results = collections.OrderedDict()
+    for name, func in benchmarks().items():
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        results[name] = time_it(func)
+
+    regressed = []
+    if baseline_file:
+        with baseline_file:
+            baseline = json.load(baseline_file)
+        regressed = compare(results, baseline, tolerance)
+    else:
+        for name, secs in results.items():
+            print(f"{name:>25}: {secs * 1e6:12.1f} us")
+
+    if save_file:
+        with save_file:
+            json.dump(results, save_file, indent=4)
+    if update_baseline:
+        with open(BASELINE_JSON, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if regressed:
+        print(f"{len(regressed)} regressed by more than {tolerance:.0%}: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
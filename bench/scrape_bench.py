@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""End-to-end scrape throughput benchmark against a local farm of synthetic sites.
+
+Runs the real census scraping pipeline (census.census.run) over thousands of
+fake Open edX sites served from a local process, and reports throughput,
+site latency, and memory use.
+
+"""
+
+import asyncio
+import json
+import pickle
+import resource
+import statistics
+import sys
+import time
+
+import aiohttp
+import click
+
+from census.census import enrich, run
+from census.origins import OriginMap
+from census.schedule import prior_costs
+from census.settings import MAX_SITES
+from census.sites import Site
+
+from farm import DEFAULT_MIX, FarmServer, farm_urls
+
+
+def peak_rss_mb():
+    """The peak resident set size of this process, in megabytes."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    if sys.platform == "darwin":
+        maxrss /= 1024
+    return maxrss / 1024
+
+
+async def scrape_farm(
+    sites, farm, session_kwargs, probe_timeout=None, costs=None, max_sites=MAX_SITES, site_timeout=None,
+    enrich_mode="inline", course_ids=True,
+):
+    """Scrape the farm, returning the outcomes and the seconds until the counts were done."""
+    connector = aiohttp.TCPConnector(resolver=farm.resolver(), limit=0)
+    session_kwargs = dict(session_kwargs, connector=connector)
+    try:
+        start = time.perf_counter()
+        chars = await run(
+            sites, session_kwargs, probe_timeout=probe_timeout, costs=costs,
+            max_sites=max_sites, site_timeout=site_timeout, enrich=enrich_mode,
+            course_ids=course_ids,
+        )
+        count_seconds = time.perf_counter() - start
+        if enrich_mode == "deferred":
+            await enrich(sites, session_kwargs, site_timeout=site_timeout)
+        return chars, count_seconds
+    finally:
+        await connector.close()
+
+
+@click.command(help=__doc__)
+@click.option('--sites', 'num_sites', type=int, default=2000, help="Number of sites in the farm")
+@click.option('--mix', default=DEFAULT_MIX, help="Proportions of the kinds of sites")
+@click.option('--slow-delay', type=float, default=2.0, help="Seconds for a slow site to respond")
+@click.option('--max-requests', type=int, default=50, help="Maximum concurrent requests")
+@click.option('--max-sites', type=int, default=MAX_SITES, help="Maximum sites scraped at once")
+@click.option('--timeout', type=int, default=5, help="Timeout in seconds for each request")
+@click.option('--site-timeout', type=float, help="Timeout in seconds for each whole site")
+@click.option('--probe-timeout', type=float, help="Probe the sites first, with this timeout")
+@click.option('--prior', 'prior_file', type=click.File('rb'),
+              help="A pickle from an earlier run, to schedule the slow sites first")
+@click.option('--origins', 'origins_file', type=click.Path(dir_okay=False),
+              help="Use and update this map of where sites redirect")
+@click.option('--enrich', 'enrich_mode', type=click.Choice(["inline", "deferred", "skip"]), default="inline",
+              help="When to look for emails, as census scrape --enrich does")
+@click.option('--course-ids/--no-course-ids', default=True, help="Get course ids, as census scrape does")
+@click.option('--save', is_flag=True, help="Save the scraped pages, as census scrape --save does")
+@click.option('--out', 'out_file', type=click.File('wb'), help="Write the scraped sites to this pickle")
+@click.option('--json', 'json_file', type=click.File('w'), help="Write the results to this JSON file")
+def main(
+    num_sites, mix, slow_delay, max_requests, max_sites, timeout, site_timeout, probe_timeout, prior_file,
+    origins_file, enrich_mode, course_ids, save, out_file, json_file,
+):
+    sites = [Site.from_url(url) for url in farm_urls(num_sites, mix)]
+    costs = None
+    if prior_file:
+        with prior_file:
+            costs = prior_costs(pickle.load(prior_file))
+    session_kwargs = {
+        'max_requests': max_requests,
+        'timeout': timeout,
+        'save': save,
+        'origins': OriginMap(origins_file) if origins_file else None,
+    }
+
+    with FarmServer(slow_delay=slow_delay) as farm:
+        start = time.perf_counter()
+        chars, count_seconds = asyncio.run(
+            scrape_farm(
+                sites, farm, session_kwargs, probe_timeout, costs, max_sites, site_timeout, enrich_mode, course_ids,
+            )
+        )
+        elapsed = time.perf_counter() - start
+        num_requests = farm.requests
+    if origins_file:
+        session_kwargs['origins'].save()
+
+    site_times = sorted(site.time for site in sites if site.time is not None)
+    percentiles = statistics.quantiles(site_times, n=100, method="inclusive")
+    results = {
+        "sites": len(sites),
+        "mix": mix,
+        "max_requests": max_requests,
+        "max_sites": max_sites,
+        "site_timeout": site_timeout,
+        "probe_timeout": probe_timeout,
+        "scheduled": costs is not None,
+        "save": save,
+        "enrich": enrich_mode,
+        "course_ids": course_ids,
+        "origins": len(session_kwargs['origins']) if origins_file else None,
+        "seconds": round(elapsed, 3),
+        "count_seconds": round(count_seconds, 3),
+        "requests": num_requests,
+        "sites_per_sec": round(len(sites) / elapsed, 2),
+        "requests_per_sec": round(num_requests / elapsed, 2),
+        "site_latency_p50": round(percentiles[49], 3),
+        "site_latency_p99": round(percentiles[98], 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "emails": sum(len(site.emails) for site in sites),
+        "course_id_count": sum(len(site.course_ids) for site in sites),
+        "outcomes": dict(sorted(chars.items())),
+    }
+
+    for key, value in results.items():
+        print(f"{key:>20}: {value}")
+    if out_file:
+        with out_file:
+            pickle.dump(sites, out_file)
+    if json_file:
+        with json_file:
+            json.dump(results, json_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
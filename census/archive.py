@@ -0,0 +1,175 @@
+"""A content-addressed archive of the pages we scraped.
+
+Page bodies are compressed and appended to segment files, and each distinct
+body is stored only once, however many sites served it.  The index is a JSON
+Lines file with a record for every response: its urls, status, content type,
+and the digest of its body, with where in the segments the body is.  Bodies
+archived without a response only have the digest and where the body is.
+
+"""
+
+import contextvars
+import hashlib
+import json
+import mmap
+import os
+import queue
+import threading
+import time
+import zlib
+
+from census.settings import SAVE_DIR
+
+# Start a new segment file when the current one gets this big.
+SEGMENT_SIZE = 256 * 1024 * 1024
+# The most responses to write at once.
+BATCH_SIZE = 500
+
+INDEX_NAME = "index.jsonl"
+
+# The Archive that scraping is saving pages to, if any.
+current_archive = contextvars.ContextVar("current_archive", default=None)
+
+
+def page_digest(body):
+    """The digest that identifies a page body in the archive."""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def segment_name(num):
+    return f"segment-{num:05d}.z"
+
+
+def read_locations(index_file):
+    """Read an index file for where the bodies are.
+
+    Returns a dict mapping digests to (segment number, offset, length), and the
+    number of the last segment.
+
+    """
+    locations = {}
+    last_segment = 0
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            for line in f:
+                rec = json.loads(line)
+                locations[rec["digest"]] = (rec["segment"], rec["offset"], rec["length"])
+                last_segment = max(last_segment, rec["segment"])
+    return locations, last_segment
+
+
+class Archive:
+    """Save pages to an archive directory, writing them in a background thread.
+
+    `save` and `add` only queue their pages, so they're cheap to call from the
+    event loop.  The writer thread compresses and writes whatever has queued up
+    in one go.  Call `close` to finish writing.
+
+    """
+    def __init__(self, dir=SAVE_DIR):
+        self.dir = dir
+        os.makedirs(dir, exist_ok=True)
+        self.index_file = os.path.join(dir, INDEX_NAME)
+        # Maps digests to (segment number, offset, length).
+        self.locations, self.segment = read_locations(self.index_file)
+        segment_file = os.path.join(dir, segment_name(self.segment))
+        self.segment_size = os.path.getsize(segment_file) if os.path.exists(segment_file) else 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._writer, name="archive-writer", daemon=True)
+        self.thread.start()
+
+    def save(self, url, text, response):
+        """Queue a response to be archived."""
+        record = {
+            "url": url,
+            "final_url": str(response.url),
+            "method": response.method,
+            "status": response.status,
+            "type": response.content_type,
+            "time": round(time.time(), 3),
+        }
+        self.queue.put((record, text, None))
+
+    def add(self, body):
+        """Queue a body to be archived if it isn't already, and return its digest.
+
+        This is for text that didn't come straight from a response, so it has
+        no url.
+
+        """
+        digest = page_digest(body)
+        self.queue.put((None, body, digest))
+        return digest
+
+    def close(self):
+        """Write everything queued so far, and stop the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _writer(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < BATCH_SIZE:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = records[-1] is None
+            if done:
+                records.pop()
+            if records:
+                self._write(records)
+            if done:
+                return
+
+    def _write(self, records):
+        index_lines = []
+        chunks = []
+        for record, body, digest in records:
+            digest = digest or page_digest(body)
+            is_new = digest not in self.locations
+            if is_new:
+                if self.segment_size >= SEGMENT_SIZE:
+                    self._write_segment(chunks)
+                    chunks = []
+                    self.segment += 1
+                    self.segment_size = 0
+                data = zlib.compress(body)
+                self.locations[digest] = (self.segment, self.segment_size, len(data))
+                chunks.append(data)
+                self.segment_size += len(data)
+            if record is None:
+                if not is_new:
+                    continue
+                record = {}
+            record["digest"] = digest
+            record["segment"], record["offset"], record["length"] = self.locations[digest]
+            index_lines.append(json.dumps(record) + "\n")
+        self._write_segment(chunks)
+        with open(self.index_file, "a") as f:
+            f.writelines(index_lines)
+
+    def _write_segment(self, chunks):
+        if chunks:
+            with open(os.path.join(self.dir, segment_name(self.segment)), "ab") as f:
+                f.writelines(chunks)
+
+
+class ArchiveReader:
+    """Read pages from an archive, with the segment files memory-mapped."""
+    def __init__(self, dir=SAVE_DIR):
+        self.dir = dir
+        self.locations, _ = read_locations(os.path.join(dir, INDEX_NAME))
+        self.maps = {}
+
+    def __contains__(self, digest):
+        return digest in self.locations
+
+    def read(self, digest):
+        """Get the body with `digest` from the archive."""
+        segment, offset, length = self.locations[digest]
+        segment_map = self.maps.get(segment)
+        if segment_map is None:
+            with open(os.path.join(self.dir, segment_name(segment)), "rb") as f:
+                segment_map = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return zlib.decompress(segment_map[offset:offset + length])
@@ -3,14 +3,18 @@
 
 import asyncio
 import collections
+import contextlib
 import csv
+import functools
 import itertools
 import json
 import logging
+import multiprocessing
 import os
 import pickle
 import pprint
 import re
+import sys
 import time
 import traceback
 import urllib.parse
@@ -20,22 +24,42 @@ import click
 import requests
 import tqdm
 
-from census.helpers import NotTrying, ScrapeFail
+from census.archive import Archive, current_archive
+from census.helpers import NotTrying, ScrapeFail, in_pool
 from census.html_report import html_report
-from census.keys import username, password
-from census.report_helpers import get_known_domains, hash_sites_together, sort_sites
-from census.session import SessionFactory
+from census.metrics import metrics, serve_metrics
+from census.monitor import LoopMonitor, install_callback_timer, uninstall_callback_timer, working_on
+from census.origins import FoundOwner, OriginClaimer, OriginClaims, OriginMap
+from census.probe import probe_sites
+from census.reanalyze import reanalyze_sites
+from census.refs import RefererHistory, clean_referers, months_ago, read_junk_regex
+from census.report_helpers import ReportData, cluster_hashed_sites, strategy_stats
+from census.schedule import prior_costs, schedule
+from census.session import SessionFactory, is_gone_error, site_time_limit
 from census.settings import (
     STATS_SITE,
     UPDATE_JSON,
     SITES_CSV,
     SITES_PICKLE,
+    RAW_REFERERS,
+    REFERERS_TXT,
+    NEW_REFERERS_TXT,
+    REFERER_HISTORY,
+    JUNK_REFERERS,
+    ENRICH_REQUESTS,
     MAX_REQUESTS,
+    MAX_SITES,
+    ORIGINS_JSON,
+    SAVE_DIR,
+    SITE_TIMEOUT,
     TIMEOUT,
     USER_AGENT,
     )
-from census.sites import Attempt, Site, HashedSite, read_sites_csv, courses_and_orgs, totals, read_sites_flat, overcount
-from census.site_patterns import find_site_functions
+from census.sites import (
+    Attempt, Site, HashedSite, enrich_mode, find_course_ids, read_sites_csv, totals, read_sites_flat, overcount,
+    overcount_details,
+)
+from census.site_patterns import ENRICHERS, find_site_functions, is_conclusive
 
 # We don't use anything from this module, it just registers all the parsers.
 from census import parsers
@@ -45,123 +69,382 @@ HEADERS = {
     'User-Agent': USER_AGENT,
 }
 
-GONE_MSGS = [
-    "Cannot connect to host",
-    "Bad Gateway",
-    "TimeoutError",
-    "500",
-    "503",
-    "404",
-    "530 get http",     # Cloudflare DNS failures
-]
-
-CERTIFICATE_MSGS = [
-    "certificate verify failed",
-    "CertificateError:",
-]
-
-FALSE_ALARM_CERTIFICATE_MSGS = [
-    "unable to get local issuer certificate",
-]
+CERTIFICATE_ERROR_KINDS = {"tls_verify", "tls_issuer"}
 
 log = logging.getLogger(__name__)
 
-def all_have_snippets(errors, snippets):
-    """Do all of the errors match one of the snippets?"""
-    return all(any(snip in err for snip in snippets) for err in errors)
 
+async def parse_site(
+    site, session_factory, priority=None, tracebacks=False, claims=None, site_timeout=None, enrich=True,
+):
+    """Scrape `site`, and return its progress character.
 
-async def parse_site(site, session_factory):
+    If `claims` is an OriginClaims, a site whose origin is already being
+    scraped by another site waits for that site's results instead.
+
+    If the site takes more than `site_timeout` seconds, not counting waits for
+    a turn to make a request, it's stopped, keeping any count it already has.
+
+    If `enrich` is true, the enrichers run as soon as the site is counted,
+    with their own `site_timeout`.
+
+    """
+    done = asyncio.get_running_loop().create_future() if claims is not None else None
+    start = time.time()
+    try:
+        try:
+            async with site_time_limit(site_timeout):
+                char = await scrape_site(site, session_factory, priority, tracebacks, claims, done)
+        except asyncio.TimeoutError:
+            if site.tried:
+                attempt = site.tried[-1]
+                if attempt.courses is None and attempt.error is None:
+                    attempt.error = f"Site timed out after {site_timeout}s"
+                    attempt.error_kind = "site_timeout"
+            metrics.errors["site_timeout"] += 1
+            site.current_courses = site.attempt_course_count()
+            site.time = time.time() - start
+            return 'T'
+        if enrich and needs_enrichment(site):
+            try:
+                async with site_time_limit(site_timeout):
+                    async with session_factory.new(
+                        verify_ssl=not site.ssl_err, listeners=[site], priority=priority,
+                    ) as session:
+                        await enrich_site(site, session)
+            except asyncio.TimeoutError:
+                enrichment_timed_out(site, site_timeout)
+        return char
+    finally:
+        try:
+            # The SimHash of a large page takes tens of milliseconds.  On a
+            # thread, the loop gets the GIL back every few milliseconds.
+            await asyncio.get_running_loop().run_in_executor(None, site.finish_pages)
+        finally:
+            if done is not None:
+                done.set_result(None)
+
+def success_char(site):
+    """The progress character for a site we counted."""
+    if site.is_gone:
+        return 'B'
+    if site.current_courses == site.latest_courses:
+        return '='
+    elif site.current_courses < site.latest_courses:
+        return '-'
+    else:
+        return '+'
+
+def failure_char(site):
+    """The progress character for a site we couldn't count."""
+    if site.is_gone_now:
+        return 'X' if site.is_gone else 'G'
+    return 'E'
+
+@contextlib.contextmanager
+def measuring(site, attempt, session):
+    """Charge the time, requests, and bytes used in the block to `attempt`."""
+    working_on.set((site.url, attempt))
+    requests_before, bytes_before, wait_before = session.requests, session.bytes, session.wait_time
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        working_on.set(None)
+        attempt.wall_time = time.perf_counter() - start
+        attempt.requests = session.requests - requests_before
+        attempt.bytes = session.bytes - bytes_before
+        attempt.wait_time = session.wait_time - wait_before
+
+def format_error(tracebacks):
+    """The error being handled, as a full traceback or just its last line."""
+    if tracebacks:
+        return traceback.format_exc()
+    exc_type, exc, _ = sys.exc_info()
+    return "".join(traceback.format_exception_only(exc_type, exc)).strip()
+
+async def scrape_site(site, session_factory, priority=None, tracebacks=False, claims=None, done=None):
+    claimer = None
+    if claims is not None and session_factory.origins is not None:
+        # Claim the site's origin as soon as a parser's response shows where
+        # it goes, in case another site is already scraping it.
+        claimer = OriginClaimer(site, claims, session_factory.origins, done)
     for verify_ssl in [True, False]:
-        async with session_factory.new(verify_ssl=verify_ssl, listeners=[site]) as session:
+        async with session_factory.new(
+            verify_ssl=verify_ssl, listeners=[site], priority=priority, claimer=claimer,
+        ) as session:
             start = time.time()
             errs = []
             success = False
+            found = None
             for parser, args, kwargs, custom_parser in find_site_functions(site.url):
                 attempt = Attempt(parser.__name__)
-                err = None
-                try:
-                    attempt.courses = await parser(site, session, *args, **kwargs)
-                except NotTrying as exc:
-                    attempt.error = str(exc)
-                except ScrapeFail as exc:
-                    attempt.error = f"{exc.__class__.__name__}: {exc}"
-                    err = str(exc) or exc.__class__.__name__
-                except Exception as exc:
-                    #print(f"Exception: {exc!r}, {exc}, {exc.__class__.__name__}")
-                    #print(traceback.format_exc())
-                    attempt.error = traceback.format_exc()
-                    err = str(exc) or exc.__class__.__name__
-                else:
-                    success = True
                 site.tried.append(attempt)
+                err = None
+                with measuring(site, attempt, session):
+                    try:
+                        attempt.courses = await parser(site, session, *args, **kwargs)
+                    except FoundOwner as exc:
+                        attempt.error = str(exc)
+                        attempt.error_kind = "alias"
+                        found = exc
+                    except NotTrying as exc:
+                        # These are often the same, share them.
+                        attempt.error = sys.intern(str(exc))
+                    except ScrapeFail as exc:
+                        attempt.error = f"{exc.__class__.__name__}: {exc}"
+                        attempt.error_kind = exc.kind
+                        err = (exc.kind, getattr(exc, "status", None))
+                    except Exception:
+                        attempt.error = format_error(tracebacks)
+                        attempt.error_kind = "exception"
+                        err = ("exception", None)
+                    else:
+                        success = True
+                if found is not None:
+                    # Another site is scraping this origin, use its results.
+                    # Shielded, so if we time out, the owner's future isn't cancelled.
+                    await asyncio.shield(found.owner_done)
+                    site.copy_results_from(found.owner)
+                    site.time = time.time() - start
+                    if site.current_courses is not None:
+                        return success_char(site)
+                    return failure_char(site)
                 if err:
                     errs.append(err)
+                    metrics.errors[attempt.error_kind] += 1
                     if custom_parser:
                         site.custom_parser_err = True
                 else:
                     if custom_parser:
                         break
+                    if attempt.courses is not None and is_conclusive(parser):
+                        # The other generic parsers couldn't do better.
+                        break
 
             if success:
                 site.current_courses = site.attempt_course_count()
-                if site.is_gone:
-                    char = 'B'
-                else:
-                    if site.current_courses == site.latest_courses:
-                        char = '='
-                    elif site.current_courses < site.latest_courses:
-                        char = '-'
-                    else:
-                        char = '+'
+                char = success_char(site)
             else:
-                if verify_ssl and all_have_snippets(errs, CERTIFICATE_MSGS):
+                if verify_ssl and all(kind in CERTIFICATE_ERROR_KINDS for kind, _ in errs):
                     # We had an SSL error.  Try again. But only mark it as an error if it wasn't
                     # a false alarm error.
-                    if not all_have_snippets(errs, FALSE_ALARM_CERTIFICATE_MSGS):
+                    if not all(kind == "tls_issuer" for kind, _ in errs):
                         site.ssl_err = True
                     site.tried = []
                     site.custom_parser_err = False
                     log.debug("SSL error: %s", (errs,))
                     continue
                 gone_content = site.current_courses is None and not site.is_openedx
-                gone_http = all_have_snippets(errs, GONE_MSGS)
+                gone_http = all(is_gone_error(kind, status) for kind, status in errs)
                 if gone_content or gone_http:
                     site.is_gone_now = True
-                    if site.is_gone:
-                        char = 'X'
-                    else:
-                        char = 'G'
-                else:
-                    char = 'E'
+                char = failure_char(site)
 
             site.time = time.time() - start
             return char
 
-async def run(sites, session_kwargs):
+def needs_enrichment(site):
+    """Should the enrichers run on `site`?
+
+    Not if it wasn't counted, or is an alias that gets its details from
+    another site, or was counted by a parser meant only for it.
+
+    """
+    if site.current_courses is None or site.alias_of is not None:
+        return False
+    custom = {func.__name__ for func, _, _, custom_parser in find_site_functions(site.url) if custom_parser}
+    return not any(attempt.courses is not None and attempt.strategy in custom for attempt in site.tried)
+
+async def enrich_site(site, session):
+    """Run the enrichers on a counted site.
+
+    Each run is recorded as an Attempt in `site.enrichments`.  They only add
+    details, so failures are only recorded.
+
+    """
+    for enricher in ENRICHERS:
+        attempt = Attempt(enricher.__name__)
+        site.enrichments.append(attempt)
+        with measuring(site, attempt, session):
+            try:
+                await enricher(site, session)
+            except Exception as exc:
+                log.debug("Enricher %s failed for %s: %s", enricher.__name__, site.url, exc)
+                attempt.error = format_error(False)
+                attempt.error_kind = getattr(exc, "kind", "exception")
+
+def enrichment_timed_out(site, site_timeout):
+    """Note on the enricher that was running that the site's time ran out."""
+    log.debug("Enriching %s timed out", site.url)
+    if site.enrichments and site.enrichments[-1].error is None:
+        site.enrichments[-1].error = f"Site timed out after {site_timeout}s"
+        site.enrichments[-1].error_kind = "site_timeout"
+
+async def run(
+    sites, session_kwargs, loop_monitor=None, metrics_port=None, probe_timeout=None, costs=None, tracebacks=False,
+    max_sites=MAX_SITES, site_timeout=None, enrich="inline", course_ids=True, cpu_time=False,
+):
+    """Scrape `sites`, any iterable of Site's, `max_sites` at a time.
+
+    Sites are taken from `sites` only as workers are ready for them.  Probing
+    and scheduling need all the sites up front, so they read them all first.
+
+    `enrich` is "inline" to run the enrichers as each site is counted,
+    "deferred" to leave them for `enrich`, or "skip".
+
+    If `course_ids` is false, parsers that can count without getting the
+    course ids don't get them.
+
+    If `cpu_time` is true, each Attempt's CPU time is measured, for the
+    strategies report.  Timing every callback costs, so it's off by default.
+
+    """
     kwargs = dict(max_requests=MAX_REQUESTS, headers=HEADERS)
     kwargs.update(session_kwargs)
-    factory = SessionFactory(**kwargs)
-    tasks = [asyncio.ensure_future(parse_site(site, factory)) for site in sites]
+    archive = Archive(SAVE_DIR) if kwargs.get("save") else None
+    archive_token = current_archive.set(archive)
+    enrich_token = enrich_mode.set(enrich)
+    course_ids_token = find_course_ids.set(course_ids)
+    factory = SessionFactory(archive=archive, **kwargs)
+    # Aliases are only noticed if we're learning where sites redirect.
+    claims = OriginClaims() if kwargs.get("origins") is not None else None
+    metrics.reset()
+    metrics_runner = None
+    if metrics_port:
+        metrics_runner = await serve_metrics(metrics_port)
     chars = collections.Counter()
-    progress = tqdm.tqdm(asyncio.as_completed(tasks), total=len(tasks), smoothing=0.0)
-    for completed in progress:
-        char = await completed
+    if probe_timeout or costs:
+        sites = list(sites)
+    if probe_timeout:
+        live_sites = await probe_sites(sites, probe_timeout, headers=kwargs["headers"], connector=kwargs.get("connector"))
+        for site in sites:
+            if site.gone_reason:
+                char = 'X' if site.is_gone else 'G'
+                chars[char] += 1
+                metrics.outcomes[char] += 1
+                metrics.sites_started += 1
+        print(f"Probe: {len(sites) - len(live_sites)} of {len(sites)} sites are gone")
+        sites = live_sites
+    timing = loop_monitor is not None or cpu_time
+    if timing:
+        install_callback_timer(loop_monitor)
+    if loop_monitor:
+        loop_monitor.start()
+    if costs:
+        # Start the expensive sites first, and let their requests go first,
+        # so the cheap sites fill in around them.
+        scheduled = schedule(sites, costs)
+    else:
+        scheduled = ((site, None) for site in sites)
+    progress = tqdm.tqdm(total=len(sites) if hasattr(sites, "__len__") else None, smoothing=0.0)
+
+    async def count(item):
+        site, priority = item
+        metrics.sites_started += 1
+        char = await parse_site(site, factory, priority, tracebacks, claims, site_timeout, enrich == "inline")
         chars[char] += 1
+        metrics.outcomes[char] += 1
         desc = " ".join(f"{c}{v}" for c, v in sorted(chars.items()))
-        progress.set_description(desc)
+        progress.set_description(desc, refresh=False)
+        progress.update()
+
+    try:
+        await in_pool(scheduled, count, max_sites)
+    finally:
+        if loop_monitor:
+            loop_monitor.stop()
+        if timing:
+            uninstall_callback_timer()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        find_course_ids.reset(course_ids_token)
+        enrich_mode.reset(enrich_token)
+        current_archive.reset(archive_token)
+        if archive:
+            archive.close()
     progress.close()
     print()
+    if loop_monitor:
+        print(loop_monitor.summary())
+    return chars
+
+async def enrich(sites, session_kwargs, max_requests=ENRICH_REQUESTS, site_timeout=None):
+    """Run the enrichers on the counted sites in `sites`, after counting is done.
+
+    The requests have their own budget of `max_requests`, so a slow contact
+    page never holds up a count.  Aliases get the emails of the site they're
+    an alias of.
+
+    """
+    kwargs = dict(headers=HEADERS)
+    kwargs.update(session_kwargs)
+    kwargs["max_requests"] = max_requests
+    archive = Archive(SAVE_DIR) if kwargs.get("save") else None
+    archive_token = current_archive.set(archive)
+    factory = SessionFactory(archive=archive, **kwargs)
+    counted = [site for site in sites if site.current_courses is not None]
+    owners = {site.url: site for site in counted if site.alias_of is None}
+    to_enrich = [site for site in owners.values() if needs_enrichment(site)]
+    progress = tqdm.tqdm(total=len(to_enrich), smoothing=0.0, desc="Enriching")
+
+    async def enrich_one(site):
+        try:
+            async with site_time_limit(site_timeout):
+                async with factory.new(verify_ssl=not site.ssl_err, listeners=[site]) as session:
+                    await enrich_site(site, session)
+        except asyncio.TimeoutError:
+            enrichment_timed_out(site, site_timeout)
+        progress.update()
 
-def scrape_sites(sites, session_kwargs):
+    try:
+        # Even sites that aren't enriched can have emails on their pages.
+        for site in owners.values():
+            site.find_deferred_emails()
+        await in_pool(to_enrich, enrich_one, max_requests)
+    finally:
+        current_archive.reset(archive_token)
+        if archive:
+            archive.close()
+    progress.close()
+    for site in counted:
+        owner = owners.get(site.alias_of)
+        if owner is not None:
+            site.emails = list(owner.emails)
+
+def scrape_sites(
+    sites, session_kwargs, loop_monitor=None, metrics_port=None, probe_timeout=None, costs=None, tracebacks=False,
+    max_sites=MAX_SITES, site_timeout=None, enrich="inline", course_ids=True, cpu_time=False,
+):
+    return run_until_complete(
+        run(
+            sites, session_kwargs, loop_monitor, metrics_port, probe_timeout, costs, tracebacks, max_sites,
+            site_timeout, enrich, course_ids, cpu_time,
+        )
+    )
+
+def enrich_sites(sites, session_kwargs, max_requests=ENRICH_REQUESTS, site_timeout=None):
+    return run_until_complete(enrich(sites, session_kwargs, max_requests, site_timeout))
+
+def run_until_complete(coro):
+    """Run `coro`, returning False if it was interrupted."""
     try:
         loop = asyncio.get_event_loop()
-        future = asyncio.ensure_future(run(sites, session_kwargs))
+        future = asyncio.ensure_future(coro)
         # Some exceptions go to stderr and then to my except clause? Shut up.
         loop.set_exception_handler(lambda loop, context: None)
         loop.run_until_complete(future)
     except KeyboardInterrupt:
-        pass
+        return False
+    return True
+
+def write_pickle(sites, out_file):
+    # Write a new file and then replace the old one, so an interruption
+    # doesn't lose the old one.
+    temp_file = out_file + ".tmp"
+    with open(temp_file, "wb") as f:
+        pickle.dump(sites, f)
+    os.replace(temp_file, out_file)
 
 @click.group(help=__doc__)
 def cli():
@@ -173,11 +456,37 @@ def cli():
 @click.option('--gone', is_flag=True, help="Scrape the sites we've recorded as gone")
 @click.option('--site', is_flag=True, help="Command-line arguments are URLs to scrape")
 @click.option('--summarize', is_flag=True, help="Summarize results instead of saving pickle")
-@click.option('--save', is_flag=True, help="Save the scraped pages in the save/ directory")
-@click.option('--out', 'out_file', type=click.File('wb'), default=SITES_PICKLE, help="Pickle file to write")
+@click.option('--save', is_flag=True, help=f"Save the scraped pages in the {SAVE_DIR}/ archive")
+@click.option('--out', 'out_file', type=click.Path(dir_okay=False), default=SITES_PICKLE, help="Pickle file to write")
 @click.option('--timeout', type=int, help=f"Timeout in seconds for each request [{TIMEOUT}]", default=TIMEOUT)
+@click.option('--site-timeout', type=float, default=SITE_TIMEOUT,
+              help=f"Seconds a site can take, not counting waits for a request slot, 0 for none "
+                   f"[{SITE_TIMEOUT}]")
+@click.option('--loop-monitor', is_flag=True, help="Report event loop lag and slow callbacks")
+@click.option('--slow-callback', type=float, default=0.1,
+              help="Seconds a callback can run before --loop-monitor reports it [0.1]")
+@click.option('--cpu-time', is_flag=True, help="Measure each parser's CPU time, for the strategies report")
+@click.option('--metrics-port', type=int, help="Serve Prometheus metrics on this local port while scraping")
+@click.option('--probe', is_flag=True, help="First probe all sites quickly, and only scrape the ones that answer")
+@click.option('--probe-timeout', type=float, default=5, help="Timeout in seconds for each probe")
+@click.option('--prior', 'prior_file', type=click.File('rb'),
+              help="A pickle from an earlier scrape, to start the slow sites first")
+@click.option('--tracebacks', is_flag=True, help="Keep full tracebacks of unexpected errors, not just the last line")
+@click.option('--max-sites', type=int, default=MAX_SITES, help=f"How many sites to scrape at once [{MAX_SITES}]")
+@click.option('--origins/--no-origins', 'use_origins', default=True,
+              help=f"Use and update {ORIGINS_JSON}, to go straight to where sites redirect")
+@click.option('--enrich', type=click.Choice(["inline", "deferred", "skip"]), default="inline",
+              help="Look for emails while counting, in a pass after counting, or not at all [inline]")
+@click.option('--enrich-requests', type=int, default=ENRICH_REQUESTS,
+              help=f"How many requests a deferred enrichment can make at once [{ENRICH_REQUESTS}]")
+@click.option('--course-ids/--no-course-ids', default=True,
+              help="Get course ids even when they take more requests than the count")
 @click.argument('site_patterns', nargs=-1)
-def scrape(in_file, log_level, gone, site, summarize, save, out_file, timeout, site_patterns):
+def scrape(
+    in_file, log_level, gone, site, summarize, save, out_file, timeout, site_timeout, loop_monitor, slow_callback,
+    cpu_time, metrics_port, probe, probe_timeout, prior_file, tracebacks, max_sites, use_origins, enrich,
+    enrich_requests, course_ids, site_patterns,
+):
     """Visit sites and count their courses."""
     logging.basicConfig(level=log_level.upper())
     # aiohttp issues warnings about cookies, silence them (and all other warnings!)
@@ -199,36 +508,115 @@ def scrape(in_file, log_level, gone, site, summarize, save, out_file, timeout, s
         if not gone:
             sites = (s for s in sites if not s.is_gone)
 
-    sites = list(sites)
-    if len(sites) == 1:
-        print("1 site")
-    else:
-        print(f"{len(sites)} sites")
-
-    os.makedirs("save", exist_ok=True)
+    # Sites are read as the scraping needs them.  Keep them for writing out.
+    scraped = []
+    def keep(sites):
+        for site in sites:
+            scraped.append(site)
+            yield site
 
     # SCRAPE!
+    origins = OriginMap(ORIGINS_JSON) if use_origins else None
     session_kwargs = {
         'save': save,
         'timeout': timeout,
+        'origins': origins,
     }
-    scrape_sites(sites, session_kwargs)
+    monitor = LoopMonitor(threshold=slow_callback) if loop_monitor else None
+    costs = None
+    if prior_file:
+        with prior_file:
+            costs = prior_costs(pickle.load(prior_file))
+    finished = scrape_sites(
+        keep(sites), session_kwargs, monitor, metrics_port, probe_timeout if probe else None, costs, tracebacks,
+        max_sites, site_timeout or None, enrich, course_ids, cpu_time,
+    )
+    if origins is not None:
+        origins.save()
+    if len(scraped) == 1:
+        print("1 site")
+    else:
+        print(f"{len(scraped)} sites")
+
+    if enrich == "deferred" and finished:
+        # The counts are done, save them before looking for emails.
+        if not summarize:
+            write_pickle(scraped, out_file)
+        enrich_sites(scraped, session_kwargs, enrich_requests, site_timeout or None)
+        if origins is not None:
+            origins.save()
 
     if summarize:
-        show_text_report(sites)
+        show_text_report(ReportData(scraped))
     else:
-        with out_file:
-            pickle.dump(sites, out_file)
+        write_pickle(scraped, out_file)
+
+@cli.command()
+@click.option('--in', 'in_file', type=click.Path(exists=True, dir_okay=False), default=SITES_PICKLE,
+              help='The sites.pickle file to update')
+@click.option('--archive', 'archive_dir', type=click.Path(exists=True, file_okay=False), default=SAVE_DIR,
+              help="The archive of pages saved by scrape --save")
+@click.option('--jobs', type=int, default=os.cpu_count(), help="How many processes to use")
+def reanalyze(in_file, archive_dir, jobs):
+    """Process the saved pages again, without scraping.
+
+    Tags, versions, fingerprints and emails are found again with the current
+    code.  Only sites scraped with --save can be reanalyzed.
+    """
+    with open(in_file, "rb") as f:
+        sites = pickle.load(f)
+    done, changed = reanalyze_sites(sites, archive_dir, jobs)
+    print(f"Reanalyzed {len(done)} of {len(sites)} sites, {changed} with new fingerprints")
+    write_pickle(sites, in_file)
+
+@cli.command()
+@click.option('--in', 'in_file', type=click.File('r', errors='replace'), default=RAW_REFERERS,
+              help='The raw referer dump to read')
+@click.option('--out', 'out_file', type=click.File('w'), default=REFERERS_TXT,
+              help='The file of domains to write, for scraping')
+@click.option('--junk', 'junk_file', type=click.Path(exists=True), default=JUNK_REFERERS,
+              help='File of regexes for referers to ignore')
+@click.option('--keep-chaff', is_flag=True, help="Keep staging, sandbox, etc, domains")
+def refs(in_file, out_file, junk_file, keep_chaff):
+    """Clean a raw referer dump into a sorted list of domains."""
+    junk_re = read_junk_regex(junk_file)
+    with in_file:
+        hosts = sorted(clean_referers(in_file, junk_re, keep_chaff=keep_chaff))
+    with out_file:
+        out_file.write("".join(host + "\n" for host in hosts))
+    print(f"Wrote {len(hosts)} domains to {out_file.name}")
+
+@cli.command('new-refs')
+@click.option('--in', 'in_file', type=click.File('r'), default=REFERERS_TXT,
+              help='The file of referer domains to read')
+@click.option('--out', 'out_file', type=click.File('w'), default=NEW_REFERERS_TXT,
+              help='The file of new referer domains to write')
+@click.option('--history', 'history_dir', type=click.Path(exists=True, file_okay=False), default=REFERER_HISTORY,
+              help='The directory of referers_YYYYMMDD.txt snapshots')
+@click.option('--since', type=click.DateTime(formats=["%Y-%m-%d", "%Y%m%d"]),
+              help="Referers not seen before this date are new [two months ago]")
+def new_refs(in_file, out_file, history_dir, since):
+    """Find referers that are new since a date."""
+    since = since.date() if since else months_ago(2)
+    history = RefererHistory(history_dir)
+    history.update()
+    with in_file:
+        domains = [line.strip() for line in in_file if line.strip()]
+    new_domains = list(history.new_since(domains, since))
+    with out_file:
+        out_file.write("".join(domain + "\n" for domain in new_domains))
+    print(f"{len(new_domains)} of {len(domains)} referers are new since {since}")
 
 @cli.command()
 @click.option('--in', 'in_file', type=click.File('rb'), default=SITES_PICKLE,
               help='The sites.pickle file to read')
-def summary(in_file):
+@click.option('--cluster', is_flag=True, help="Also group near-duplicate sites together")
+def summary(in_file, cluster):
     with in_file:
         sites = pickle.load(in_file)
-    summarize(sites)
+    summarize(sites, cluster=cluster)
 
-def summarize(sites):
+def summarize(sites, cluster=False):
     old, new = totals(sites)
 
     changed = sum(1 for s in sites if s.should_update())
@@ -236,6 +624,13 @@ def summarize(sites):
     back = sum(1 for s in sites if not s.is_gone_now and s.is_gone and s.current_courses)
     print(f"{len(sites)} sites")
     print(f"Courses: {old} --> {new} ({new-old:+d});   Sites: {changed} changed, {gone} gone, {back} back")
+    error_kinds = collections.Counter()
+    for site in sites:
+        if site.gone_reason:
+            error_kinds[f"probe_{site.gone_reason[0]}"] += 1
+        error_kinds.update(attempt.error_kind for attempt in site.tried if attempt.error_kind)
+    if error_kinds:
+        print("Errors: " + ", ".join(f"{n} {kind}" for kind, n in error_kinds.most_common()))
 
     hashed_sites = collections.defaultdict(HashedSite)
     nohash_sites = []
@@ -254,13 +649,17 @@ def summarize(sites):
             hashed_site.sites.append(site)
 
     print(f"{len(nohash_sites)} with no hash, {len(hashed_sites)} with hash")
+    hashed_sites = list(hashed_sites.values())
+    if cluster:
+        hashed_sites = cluster_hashed_sites(hashed_sites)
+        print(f"{len(hashed_sites)} clusters of near-duplicate sites")
     if nohash_sites:
         print("No hash:")
         for site in nohash_sites:
             print(f" {site.best_url()}: {site.current_courses()}")
     chaff_sites = []
     not_chaff_sites = []
-    for hashed_site in itertools.chain(hashed_sites.values(), nohash_sites):
+    for hashed_site in itertools.chain(hashed_sites, nohash_sites):
         if hashed_site.all_chaff():
             chaff_sites.append(hashed_site)
         else:
@@ -276,24 +675,32 @@ def summarize(sites):
 @click.option('--skip-none', is_flag=True, help="Don't include sites with no count")
 @click.option('--only-new', is_flag=True, help="Only include sites we think are new")
 @click.option('--full', is_flag=True, help="Include courses, orgs, etc")
-def html(in_file, out_file, skip_none, only_new, full):
+@click.option('--sharded', is_flag=True,
+              help="Write sections as separate files in a _files directory, loaded as needed")
+@click.option('--cluster', is_flag=True, help="Group near-duplicate sites together")
+def html(in_file, out_file, skip_none, only_new, full, sharded, cluster):
     """Write an HTML report."""
     with in_file:
         sites = pickle.load(in_file)
 
-    if skip_none:
-        sites = [site for site in sites if site.current_courses is not None]
-
-    # Prep data for reporting.
-    old, new = totals(sites)
+    data = ReportData(sites)
     if full:
-        all_courses, all_orgs, all_course_ids = courses_and_orgs(sites)
-        with open("course-ids.txt", "w") as f:
-            f.write("".join(i + "\n" for i in sorted(all_course_ids)))
-    else:
-        all_courses = all_orgs = None
-
-    html_report(out_file, sites, old, new, all_courses, all_orgs, only_new=only_new)
+        write_course_ids(data, skip_none)
+    write_html(data, out_file, skip_none=skip_none, only_new=only_new, full=full, sharded=sharded, cluster=cluster)
+
+def write_course_ids(data, skip_none=False):
+    _, _, all_course_ids = data.courses_and_orgs(skip_none)
+    with open("course-ids.txt", "w") as f:
+        f.write("".join(i + "\n" for i in sorted(all_course_ids)))
+
+def write_html(data, out_file, skip_none=False, only_new=False, full=False, sharded=False, cluster=False):
+    fragment_dir = None
+    if sharded:
+        fragment_dir = os.path.splitext(out_file.name)[0] + "_files"
+    html_report(
+        out_file, data, skip_none=skip_none, only_new=only_new, full=full,
+        fragment_dir=fragment_dir, cluster=cluster,
+    )
 
 
 @cli.command()
@@ -301,18 +708,18 @@ def html(in_file, out_file, skip_none, only_new, full):
               help='The sites.pickle file to read')
 @click.option('--out', 'out_file', type=click.File('w'), default="html/sites.csv",
               help='The CSV file to write')
-def sheet(in_file, out_file):
+@click.option('--cluster', is_flag=True, help="Group near-duplicate sites together")
+def sheet(in_file, out_file, cluster):
     """Write a CSV file for importing into a spreadsheet.
 
     Always skips no-course sites. Only includes new sites.
     """
     with in_file:
         sites = pickle.load(in_file)
+    write_sheet(ReportData(sites), out_file, cluster=cluster)
 
-    sites = [site for site in sites if site.current_courses is not None]
-
-    known_domains = get_known_domains()
-    hashed_sites = hash_sites_together(sites, known_domains, only_new=True)
+def write_sheet(data, out_file, cluster=False):
+    hashed_sites = data.hashed_sites(skip_none=True, only_new=True, cluster=cluster)
 
     writer = csv.DictWriter(out_file, ["disposition", "language", "geography", "url", "courses", "sites", "tags", "aliases"])
     writer.writeheader()
@@ -336,11 +743,13 @@ def emails(in_file):
     """Write the emails found."""
     with in_file:
         sites = pickle.load(in_file)
+    write_emails(sites)
 
+def write_emails(sites, out=None):
     emails = set()
     for site in sites:
         emails.update(site.emails)
-    print("\n".join(sorted(emails)))
+    print("\n".join(sorted(emails)), file=out)
 
 
 @cli.command('json')
@@ -349,13 +758,38 @@ def write_json(in_file):
     """Write the update.json file."""
     with in_file:
         sites = pickle.load(in_file)
+    write_update_json(ReportData(sites))
 
-    # Prep data for reporting.
-    sites_descending = sorted(sites, key=lambda s: s.latest_courses, reverse=True)
-    all_courses, _, _ = courses_and_orgs(sites)
+def write_update_json(data):
+    sites_descending = sorted(data.sites(), key=lambda s: s.latest_courses, reverse=True)
+    all_courses, _, _ = data.courses_and_orgs()
     json_update(sites_descending, all_courses, include_overcount=True)
 
 
+@cli.command()
+@click.option('--in', 'in_file', type=click.File('rb'), default=SITES_PICKLE,
+              help='The sites.pickle file to read')
+def strategies(in_file):
+    """Show what each strategy costs, and how often it counts courses.
+
+    CPU times are only measured by `scrape --cpu-time` or `--loop-monitor`.
+    """
+    with in_file:
+        sites = pickle.load(in_file)
+
+    print(
+        f"{'strategy':30} {'tried':>6} {'ok':>6} {'ok%':>5} {'final':>6} "
+        f"{'reqs':>7} {'req/try':>7} {'MB':>8} {'wall/try':>8} {'cpu s':>7} {'cpu ms/try':>10}"
+    )
+    for st in strategy_stats(sites):
+        tried = st.tried or 1
+        print(
+            f"{st.name:30} {st.tried:6d} {st.succeeded:6d} {st.succeeded / tried:5.0%} {st.final:6d} "
+            f"{st.requests:7d} {st.requests / tried:7.1f} {st.bytes / 1e6:8.1f} "
+            f"{st.wall_time / tried:8.2f} {st.cpu_time:7.1f} {st.cpu_time / tried * 1000:10.1f}"
+        )
+
+
 @cli.command('text')
 @click.option('--in', 'in_file', type=click.File('rb'), default=SITES_PICKLE,
               help='The sites.pickle file to read')
@@ -363,26 +797,140 @@ def text_report(in_file):
     """Write a text report about site scraping."""
     with in_file:
         sites = pickle.load(in_file)
-    show_text_report(sites)
-
-def show_text_report(sites):
-    old, new = totals(sites)
-    sites = sorted(sites, key=lambda s: s.latest_courses, reverse=True)
-    print(f"Found courses went from {old} to {new}")
+    show_text_report(ReportData(sites))
+
+def show_text_report(data, out=None):
+    old, new = data.totals()
+    sites = sorted(data.sites(), key=lambda s: s.latest_courses, reverse=True)
+    print(f"Found courses went from {old} to {new}", file=out)
+    all_courses, _, _ = data.courses_and_orgs()
+    true_dups, reorged = overcount_details(all_courses)
+    reorged_total = sum(sum(orgs.values()) for orgs in reorged.values())
+    print(f"Overcount: {true_dups + reorged_total}", file=out)
+    print(f"    {true_dups} from courses run by more than one site", file=out)
+    for syn_org, orgs in reorged.items():
+        for org, n in sorted(orgs.items(), key=lambda kv: kv[1], reverse=True):
+            print(f"    {n} from {syn_org} courses re-labelled by {org}", file=out)
     for site in sites:
-        print(f"{site.url}: {site.latest_courses} --> {site.current_courses} ({site.fingerprint})")
+        print(f"{site.url}: {site.latest_courses} --> {site.current_courses} ({site.fingerprint})", file=out)
+        if site.gone_reason:
+            reason, detail = site.gone_reason
+            print(f"    probe: {reason}: {detail}", file=out)
+        if site.alias_of:
+            print(f"    alias of {site.alias_of}", file=out)
         for attempt in site.tried:
             if attempt.error is not None:
                 line = attempt.error.splitlines()[-1]
             else:
                 line = f"Counted {attempt.courses} courses"
-            print(f"    {attempt.strategy}: {line}")
+            print(f"    {attempt.strategy}: {line}", file=out)
         tags = ", ".join(t for t, s in site.styled_tags())
         if tags:
-            print(f"    [{tags}]")
+            print(f"    [{tags}]", file=out)
         other = site.other_info + site.emails
         if other:
-            print(f"    Info: {'; '.join(set(other))}")
+            print(f"    Info: {'; '.join(set(other))}", file=out)
+
+HTML_OPTIONS = ["skip-none", "only-new", "full", "sharded", "cluster"]
+
+def parse_html_spec(spec):
+    """Parse "html/sites.html:skip-none,full" into a file name and write_html kwargs."""
+    filename, _, opts = spec.partition(":")
+    options = dict.fromkeys(HTML_OPTIONS, False)
+    for opt in filter(None, opts.split(",")):
+        if opt not in options:
+            raise click.BadParameter(f"Unknown HTML option {opt!r} in {spec!r}", param_hint="--html")
+        options[opt] = True
+    return filename, {opt.replace("-", "_"): val for opt, val in options.items()}
+
+def write_to_file(filename, func, *args, **kwargs):
+    """Call func(*args, out_file, **kwargs) with `filename` open for writing."""
+    with open(filename, "w") as out_file:
+        func(*args, out_file, **kwargs)
+
+def run_in_processes(jobs, max_procs):
+    """Run (name, function) jobs in forked processes, at most `max_procs` at a time.
+
+    The processes share the parent's memory, so anything computed before
+    they start is computed only once.
+
+    """
+    if max_procs < 2 or len(jobs) < 2 or "fork" not in multiprocessing.get_all_start_methods():
+        for _, func in jobs:
+            func()
+        return
+
+    context = multiprocessing.get_context("fork")
+    running = collections.deque()
+    failed = []
+    def wait_for_one():
+        name, proc = running.popleft()
+        proc.join()
+        if proc.exitcode != 0:
+            failed.append(name)
+
+    for name, func in jobs:
+        if len(running) >= max_procs:
+            wait_for_one()
+        proc = context.Process(target=func, name=name)
+        proc.start()
+        running.append((name, proc))
+    while running:
+        wait_for_one()
+    if failed:
+        raise click.ClickException(f"Couldn't write {', '.join(failed)}")
+
+@cli.command()
+@click.option('--in', 'in_file', type=click.File('rb'), default=SITES_PICKLE,
+              help='The sites.pickle file to read')
+@click.option('--html', 'html_specs', multiple=True, metavar="FILE[:OPTIONS]",
+              help=f"Write an HTML report.  OPTIONS are any of {', '.join(HTML_OPTIONS)}, separated by commas")
+@click.option('--sheet', 'sheet_file', type=click.Path(dir_okay=False), help="Write a CSV file of new sites")
+@click.option('--json', 'update_json', is_flag=True, help=f"Write the {UPDATE_JSON} file")
+@click.option('--summary', 'show_summary', is_flag=True, help="Print a summary")
+@click.option('--emails', 'emails_file', type=click.Path(dir_okay=False), help="Write the emails found")
+@click.option('--text', 'text_file', type=click.Path(dir_okay=False), help="Write a text report")
+@click.option('--cluster', is_flag=True, help="Group near-duplicate sites together in the sheet and summary")
+@click.option('--jobs', type=int, default=os.cpu_count(), help="How many reports to write at once")
+def report(in_file, html_specs, sheet_file, update_json, show_summary, emails_file, text_file, cluster, jobs):
+    """Write any number of reports, reading the sites only once.
+
+    \b
+    For example:
+        census report --in state/all-refs.pickle --summary \\
+            --html html/all-refs.html:skip-none,only-new \\
+            --html html/all-refs-full.html:only-new,full
+    """
+    with in_file:
+        sites = pickle.load(in_file)
+    data = ReportData(sites)
+
+    work = []
+    for spec in html_specs:
+        filename, options = parse_html_spec(spec)
+        data.prepare(skip_none=options["skip_none"], full=options["full"], cluster=options["cluster"])
+        work.append((filename, functools.partial(write_to_file, filename, write_html, data, **options)))
+    if sheet_file:
+        data.prepare(skip_none=True, cluster=cluster)
+        work.append((sheet_file, functools.partial(write_to_file, sheet_file, write_sheet, data, cluster=cluster)))
+    if update_json:
+        data.courses_and_orgs()
+        work.append((UPDATE_JSON, functools.partial(write_update_json, data)))
+    if emails_file:
+        work.append((emails_file, functools.partial(write_to_file, emails_file, write_emails, sites)))
+    if text_file:
+        data.totals()
+        data.courses_and_orgs()
+        work.append((text_file, functools.partial(write_to_file, text_file, show_text_report, data)))
+
+    # The html command writes course-ids.txt with a full report, so we do too.
+    full_specs = [options for _, options in map(parse_html_spec, html_specs) if options["full"]]
+    if full_specs:
+        write_course_ids(data, full_specs[-1]["skip_none"])
+
+    run_in_processes(work, jobs)
+    if show_summary:
+        summarize(sites, cluster=cluster)
 
 def json_update(sites, all_courses, include_overcount=False):
     """Write a JSON file for uploading to the stats site.
@@ -411,6 +959,8 @@ def json_update(sites, all_courses, include_overcount=False):
 
 
 def login(site, session):
+    # keys.py isn't in the repo, only needed here.
+    from census.keys import username, password
     login_url = urllib.parse.urljoin(site, "/login/")
     resp = session.get(login_url)
     resp.raise_for_status()
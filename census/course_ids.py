@@ -0,0 +1,66 @@
+"""An interned table of course ids, with their parsed keys cached."""
+
+import collections
+
+import opaque_keys
+import opaque_keys.edx.keys
+
+
+ParsedCourseId = collections.namedtuple("ParsedCourseId", "org course run valid")
+
+INVALID = ParsedCourseId(None, None, None, False)
+
+
+class CourseIdTable:
+    """Course id strings, each stored once and referred to by a small integer.
+
+    The same course ids show up on many sites, so sites store the numbers
+    instead of the strings.  Parsing a course id is slow, so each id is
+    parsed at most once.
+
+    """
+    def __init__(self):
+        self.ids = []
+        self.numbers = {}
+        self.parsed = {}
+
+    def __getstate__(self):
+        # The numbers and the parses can be rebuilt, don't store them.
+        return self.ids
+
+    def __setstate__(self, ids):
+        self.ids = ids
+        self.numbers = {course_id: num for num, course_id in enumerate(ids)}
+        self.parsed = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, num):
+        return self.ids[num]
+
+    def intern(self, course_id):
+        """Return the number for `course_id`, adding it if needed."""
+        num = self.numbers.get(course_id)
+        if num is None:
+            num = self.numbers[course_id] = len(self.ids)
+            self.ids.append(course_id)
+        return num
+
+    def parse(self, num):
+        """Return a ParsedCourseId for course id number `num`."""
+        parsed = self.parsed.get(num)
+        if parsed is None:
+            try:
+                key = opaque_keys.edx.keys.CourseKey.from_string(self.ids[num])
+            except opaque_keys.InvalidKeyError:
+                parsed = INVALID
+            else:
+                parsed = ParsedCourseId(key.org, key.course, key.run, True)
+            self.parsed[num] = parsed
+        return parsed
+
+
+# The table for sites made in this process.  Sites loaded from a state file
+# share the table that was saved with them.
+COURSE_IDS = CourseIdTable()
@@ -0,0 +1,79 @@
+"""An index of domains, for answering questions about them in O(labels)."""
+
+# The key in a trie node marking that a domain ends there.  Labels are
+# strings, so this can't be one.
+END = None
+
+
+def labels(domain):
+    """The labels of `domain`, from the top down, ignoring empty ones."""
+    return [label for label in reversed(domain.split(".")) if label]
+
+
+class DomainIndex:
+    """A set of domains, stored as a trie of their labels, reversed.
+
+    "courses.example.com" is stored as com -> example -> courses, so the
+    domains that a domain is a subdomain of are all on its path in the trie.
+
+    """
+    # Bump this when what the index holds changes, so caches of it are rebuilt.
+    VERSION = 2
+
+    def __init__(self, domains=()):
+        self.root = {}
+        self.count = 0
+        for domain in domains:
+            self.add(domain)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Produce the domains in the index."""
+        stack = [(self.root, [])]
+        while stack:
+            node, path = stack.pop()
+            for label, child in node.items():
+                if label is END:
+                    yield ".".join(reversed(path))
+                else:
+                    stack.append((child, path + [label]))
+
+    def add(self, domain):
+        domain_labels = labels(domain)
+        if not domain_labels:
+            return
+        node = self.root
+        for label in domain_labels:
+            node = node.setdefault(label, {})
+        if END not in node:
+            node[END] = True
+            self.count += 1
+
+    def __contains__(self, domain):
+        domain_labels = labels(domain)
+        if not domain_labels:
+            return False
+        node = self.root
+        for label in domain_labels:
+            node = node.get(label)
+            if node is None:
+                return False
+        return END in node
+
+    def is_known(self, domain):
+        """Is `domain` in the index, with or without a "www."?"""
+        return domain in self or (domain.startswith("www.") and domain[4:] in self)
+
+    def has_parent(self, domain):
+        """Is a domain that `domain` is a strict subdomain of in the index?"""
+        node = self.root
+        for label in labels(domain)[:-1]:
+            node = node.get(label)
+            if node is None:
+                return False
+            if END in node:
+                return True
+        return False
+
@@ -1,7 +1,13 @@
 """Helpers for picking apart web data."""
 
+import array
+import asyncio
+import functools
 import hashlib
+import operator
 import re
+import struct
+import sys
 import urllib.parse
 
 import lxml
@@ -11,15 +17,25 @@ import parse
 
 class ScrapeFail(Exception):
     """Any controlled failure of scraping."""
-    pass
+    # The category of failure, for deciding what to do about it.
+    kind = "parse"
 
 class GotZero(ScrapeFail):
     """Raised when we couldn't find the info we want."""
     pass
 
 class HttpError(ScrapeFail):
-    """Raised to nicely handle HTTP errors."""
-    pass
+    """Raised to nicely handle HTTP errors.
+
+    `kind` says what went wrong (see session.error_kind), and `status` is the
+    HTTP status if the server answered.
+
+    """
+    def __init__(self, message, kind="error", status=None, url=None):
+        super().__init__(message)
+        self.kind = kind
+        self.status = status
+        self.url = url
 
 class NotTrying(Exception):
     """When a parser decides to skip parsing."""
@@ -67,18 +83,59 @@ def calc_fingerprint(text):
     """Return a hex string that fingerprints `text`."""
     return hashlib.sha1(text).hexdigest()
 
+# Bits in a SimHash, and how many words are in each feature.
+SIMHASH_BITS = 64
+SIMHASH_SHINGLE = 3
+
+def calc_simhash(text):
+    """Return a SimHash of `text`, an integer that is close for similar texts.
+
+    The features are runs of three words.  Texts that differ only a little
+    have SimHashes that differ in only a few bits.
+
+    """
+    words = text.split()
+    if len(words) < SIMHASH_SHINGLE:
+        hashes = [_word_hashes(text)[0]]
+    else:
+        # Hash each distinct word once, with a different hash for each
+        # position in a shingle.  A shingle's hash is the xor of its words'.
+        word_hashes = {word: _word_hashes(word) for word in set(words)}
+        each_word = list(map(word_hashes.__getitem__, words))
+        hashes = list(map(operator.itemgetter(0), each_word[:1 - SIMHASH_SHINGLE]))
+        for pos in range(1, SIMHASH_SHINGLE):
+            hashes = list(map(operator.xor, hashes, map(operator.itemgetter(pos), each_word[pos:])))
+    # Each byte of the packed hashes is one lane of eight bits.  Count the
+    # ones in each bit of each lane without looking at the bytes in Python.
+    packed_hashes = array.array("Q", hashes)
+    if sys.byteorder == "big":
+        packed_hashes.byteswap()
+    packed = packed_hashes.tobytes()
+    nbytes = SIMHASH_BITS // 8
+    simhash = 0
+    for lane_num in range(nbytes):
+        lane = packed[lane_num::nbytes]
+        for bit in range(8):
+            ones = lane.translate(_BIT_SET[bit]).count(b"\x01")
+            if ones * 2 > len(hashes):
+                simhash |= 1 << (lane_num * 8 + bit)
+    return simhash
+
+_unpack_word_hashes = struct.Struct(f"<{SIMHASH_SHINGLE}Q").unpack
+
+def _word_hashes(word):
+    """SIMHASH_SHINGLE independent 64-bit hashes of `word`."""
+    return _unpack_word_hashes(hashlib.blake2b(word, digest_size=8 * SIMHASH_SHINGLE).digest())
+
+# For each bit, a bytes.translate table mapping bytes to 1 if that bit is set.
+_BIT_SET = [bytes(1 if byte & (1 << bit) else 0 for byte in range(256)) for bit in range(8)]
+
 def domain_from_url(url):
     return urllib.parse.urlparse(url).netloc or url
 
 def is_known(site, known_domains):
-    domain = domain_from_url(site.url)
-    for prefix in ['', 'www.']:
-        dom = domain
-        if domain.startswith(prefix):
-            dom = domain[len(prefix):]
-        if dom in known_domains:
-            return True
-    return False
+    """Is `site` in `known_domains`, a census.domains.DomainIndex?"""
+    return known_domains.is_known(domain_from_url(site.url))
 
 CHAFF_WORDS = set("""
     stage staging preview demo dev sandbox test loadtest qa
@@ -87,6 +144,7 @@ CHAFF_WORDS = set("""
     aspen birch cypress dogwood eucalyptus ficus ginkgo hawthorn ironwood juniper koa
     """.split())
 
+@functools.lru_cache(maxsize=None)
 def is_chaff_domain(domain):
     """Is this domain something we should ignore?"""
     parts = re.split(r"[.-]", domain)
@@ -180,3 +238,26 @@ def emails_in_text(text):
         if re.search(NOT_EMAIL_RX, email):
             continue
         yield email.decode("ascii")
+
+async def in_pool(items, func, workers):
+    """Await `func(item)` for each of `items`, with `workers` running at once.
+
+    Items are taken from `items` only as workers are ready for them.
+
+    """
+    queue = asyncio.Queue(maxsize=workers)
+
+    async def produce():
+        for item in items:
+            await queue.put(item)
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def work():
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            await func(item)
+
+    await asyncio.gather(produce(), *(work() for _ in range(workers)))
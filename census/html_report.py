@@ -1,9 +1,9 @@
 import collections
+import hashlib
 from xml.sax.saxutils import escape
 
 from census.helpers import domain_from_url, is_chaff_domain, is_known
 from census.html_writer import HtmlOutlineWriter
-from census.report_helpers import get_known_domains, hash_sites_together, sort_sites
 
 CSS = """\
     html {
@@ -66,22 +66,44 @@ CSS = """\
 """
 
 
-def html_report(out_file, sites, old, new, all_courses=None, all_orgs=None, only_new=False):
-    sites = sort_sites(sites)
-    known_domains = get_known_domains()
+def fragment_name(kind, key):
+    """A file-safe name for the fragment showing `key`."""
+    return f"{kind}-{hashlib.sha1(key.encode('utf8')).hexdigest()[:16]}"
 
-    writer = HtmlOutlineWriter(out_file, css=CSS, title=f"Census: {len(sites)} sites")
+
+def html_report(out_file, data, skip_none=False, only_new=False, full=False, fragment_dir=None, cluster=False):
+    """Write the HTML report.
+
+    `data` is a ReportData for the sites.  `skip_none` leaves out sites with
+    no course count, `only_new` shows only new sites in the hashed sections,
+    `full` adds courses and orgs, and `cluster` groups near-duplicate sites
+    together in the hashed sections.
+
+    If `fragment_dir` is provided, most sections are written as separate
+    fragment files there, loaded as they are expanded, and each site is
+    written only once no matter how many sections show it.
+
+    """
+    sites = data.sorted_sites(skip_none)
+    old, new = data.totals(skip_none)
+    known_domains = data.known_domains()
+    if full:
+        all_courses, all_orgs, _ = data.courses_and_orgs(skip_none)
+    else:
+        all_courses = all_orgs = None
+
+    writer = HtmlOutlineWriter(out_file, css=CSS, title=f"Census: {len(sites)} sites", fragment_dir=fragment_dir)
     header = f"{len(sites)} sites: {old}"
     if new != old:
         header += f" &rarr; {new}"
-    writer.start_section(header)
+    writer.start_section(header, fragment="sites")
     for site in sites:
         write_site(site, writer, known_domains)
     writer.end_section()
 
     if all_courses:
         total_course_ids = sum(len(sites) for sites in all_courses.values())
-        writer.start_section(f"<p>Course IDs: {total_course_ids}</p>")
+        writer.start_section(f"<p>Course IDs: {total_course_ids}</p>", fragment="course-ids")
         all_courses_items = sorted(all_courses.items())
         all_courses_items = sorted(all_courses_items, key=lambda item: len(item[1]), reverse=True)
         for course_id, cid_sites in all_courses_items:
@@ -93,7 +115,7 @@ def html_report(out_file, sites, old, new, all_courses=None, all_orgs=None, only
 
     if all_orgs:
         shared_orgs = [(org, sites) for org, sites in all_orgs.items() if len(sites) > 1]
-        writer.start_section(f"<p>Shared orgs: {len(shared_orgs)}</p>")
+        writer.start_section(f"<p>Shared orgs: {len(shared_orgs)}</p>", fragment="shared-orgs")
         for org, org_sites in sorted(shared_orgs):
             writer.start_section(f"{org}: {len(org_sites)}")
             for site in sorted(org_sites, key=lambda s: s.url):
@@ -101,7 +123,7 @@ def html_report(out_file, sites, old, new, all_courses=None, all_orgs=None, only
             writer.end_section()
         writer.end_section()
 
-    hashed_sites = hash_sites_together(sites, known_domains, only_new)
+    hashed_sites = data.hashed_sites(skip_none, only_new, cluster)
 
     versions = collections.defaultdict(list)
     tags = collections.defaultdict(list)
@@ -110,25 +132,25 @@ def html_report(out_file, sites, old, new, all_courses=None, all_orgs=None, only
         for tag in hashed_site.tags():
             tags[tag].append(hashed_site)
 
-    writer.start_section(f"<p>Versions</p>")
+    writer.start_section(f"<p>Versions</p>", fragment="versions")
     for version in sorted(versions.keys()):
         hsites = versions[version]
-        writer.start_section(f"<p>{version}: {len(hsites)}</p>")
+        writer.start_section(f"<p>{version}: {len(hsites)}</p>", fragment=fragment_name("version", version))
         for hashed_site in hsites:
             write_hashed_site(hashed_site, writer, known_domains)
         writer.end_section()
     writer.end_section()
 
-    writer.start_section(f"<p>Tags</p>")
+    writer.start_section(f"<p>Tags</p>", fragment="tags")
     for tag in sorted(tags.keys()):
         hsites = tags[tag]
-        writer.start_section(f"<p>{tag}: {len(hsites)}</p>")
+        writer.start_section(f"<p>{tag}: {len(hsites)}</p>", fragment=fragment_name("tag", tag))
         for hashed_site in hsites:
             write_hashed_site(hashed_site, writer, known_domains)
         writer.end_section()
     writer.end_section()
 
-    writer.start_section(f"<p>Hashed: {len(hashed_sites)}</p>")
+    writer.start_section(f"<p>Hashed: {len(hashed_sites)}</p>", fragment="hashed")
     for hashed_site in hashed_sites:
         write_hashed_site(hashed_site, writer, known_domains)
     writer.end_section()
@@ -145,16 +167,18 @@ def write_hashed_site(hashed_site, writer, known_domains):
     url = hashed_site.best_url()
     ncourses = hashed_site.current_courses()
     nsites = len(hashed_site.sites)
-    writer.start_section(
+    write_contents = writer.start_section(
         f"<a class='url' href='{url}'>{url}</a>&nbsp; "
         f"<b>{ncourses}</b> {pluralize(ncourses, 'course')}, "
-        f"{nsites} {pluralize(nsites, 'site')} {tags.html()}"
+        f"{nsites} {pluralize(nsites, 'site')} {tags.html()}",
+        fragment=fragment_name("hashed", hashed_site.fingerprint),
     )
-    for site in hashed_site.sites:
-        write_site(site, writer, known_domains)
-    info = hashed_site.other_info()
-    if info:
-        writer.write(f"<p class='info'><b>Info:</b> {'; '.join(sorted(info))}</p>")
+    if write_contents:
+        for site in hashed_site.sites:
+            write_site(site, writer, known_domains)
+        info = hashed_site.other_info()
+        if info:
+            writer.write(f"<p class='info'><b>Info:</b> {'; '.join(sorted(info))}</p>")
     writer.end_section()
 
 def write_site(site, writer, known_domains):
@@ -179,23 +203,27 @@ def write_site(site, writer, known_domains):
     for tag, style in sorted(site.styled_tags()):
         tags.add(tag, style)
 
-    writer.start_section(f"<a class='url' href='{site.url}'>{site.url}</a>: {old}{new_text} {tags.html()}")
-    for attempt in site.tried:
-        strategy = attempt.strategy
-        tb = attempt.error
-        if tb is not None:
-            lines = tb.splitlines()
-            if len(lines) > 1:
-                line = tb.splitlines()[-1][:100]
-                writer.start_section(f"<span class='strategy'>{strategy}:</span> {escape(line)}")
-                writer.write("""<pre class="stdout">""")
-                writer.write(escape(tb))
-                writer.write("""</pre>""")
-                writer.end_section()
+    write_contents = writer.start_section(
+        f"<a class='url' href='{site.url}'>{site.url}</a>: {old}{new_text} {tags.html()}",
+        fragment=fragment_name("site", site.url),
+    )
+    if write_contents:
+        for attempt in site.tried:
+            strategy = attempt.strategy
+            tb = attempt.error
+            if tb is not None:
+                lines = tb.splitlines()
+                if len(lines) > 1:
+                    line = tb.splitlines()[-1][:100]
+                    writer.start_section(f"<span class='strategy'>{strategy}:</span> {escape(line)}")
+                    writer.write("""<pre class="stdout">""")
+                    writer.write(escape(tb))
+                    writer.write("""</pre>""")
+                    writer.end_section()
+                else:
+                    writer.write(f"<p>{strategy}: {escape(lines[0])}</p>")
             else:
-                writer.write(f"<p>{strategy}: {lines[0]}")
-        else:
-            writer.write(f"<p>{strategy}: counted {attempt.courses} courses</p>")
+                writer.write(f"<p>{strategy}: counted {attempt.courses} courses</p>")
     writer.end_section()
 
 
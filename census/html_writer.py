@@ -1,8 +1,19 @@
+import io
+import json
+import os
 import textwrap
 
 
 class HtmlOutlineWriter:
-    """Write an HTML file with nested collapsable sections."""
+    """Write an HTML file with nested collapsable sections.
+
+    If `fragment_dir` is provided, sections can be written as fragments: their
+    contents go into separate files in that directory, loaded by the browser
+    when the section is expanded.  The directory has to be next to the HTML
+    file.  A fragment is written once, and can be shown in many sections.
+    Fragments left in the directory by an earlier report are removed.
+
+    """
 
     HEAD = textwrap.dedent(r"""
         <!DOCTYPE html>
@@ -62,24 +73,119 @@ class HtmlOutlineWriter:
         <div>
     """)
 
+    FRAGMENT_SECTION_START = textwrap.dedent("""\
+        <div class="{klass}">
+        <input class="toggle-box {klass}" id="sect_{id:05d}" type="checkbox" data-fragment="{fragment}">
+        <label for="sect_{id:05d}">{html}</label>
+        <div>
+    """)
+
     SECTION_END = "</div></div>"
 
-    def __init__(self, fout, css="", title=""):
+    # Loads fragments when their sections are expanded.  Fragments are
+    # JavaScript files rather than HTML so that they load from file: URLs.
+    FRAGMENT_SCRIPT = textwrap.dedent("""\
+        <script>
+        var fragmentDir = [[FRAGMENT_DIR]];
+        var fragmentHtml = {};
+        var fragmentWaiting = {};
+        var fragmentCopies = 0;
+
+        function fillFragment(box, html) {
+            var div = box.parentNode.lastElementChild;
+            div.innerHTML = html;
+            // A fragment can be shown in many places, so make its ids unique.
+            fragmentCopies += 1;
+            div.querySelectorAll("input.toggle-box").forEach(function (input) {
+                input.id = input.id + "_" + fragmentCopies;
+                input.nextElementSibling.htmlFor = input.id;
+            });
+        }
+
+        function censusFragment(name, html) {
+            fragmentHtml[name] = html;
+            (fragmentWaiting[name] || []).forEach(function (box) { fillFragment(box, html); });
+            delete fragmentWaiting[name];
+        }
+
+        document.addEventListener("change", function (event) {
+            var box = event.target;
+            var name = box.dataset && box.dataset.fragment;
+            if (!name || !box.checked || box.dataset.loaded) {
+                return;
+            }
+            box.dataset.loaded = "yes";
+            if (name in fragmentHtml) {
+                fillFragment(box, fragmentHtml[name]);
+            } else if (name in fragmentWaiting) {
+                fragmentWaiting[name].push(box);
+            } else {
+                fragmentWaiting[name] = [box];
+                var script = document.createElement("script");
+                script.src = fragmentDir + "/" + name + ".js";
+                document.head.appendChild(script);
+            }
+        });
+        </script>
+    """)
+
+    def __init__(self, fout, css="", title="", fragment_dir=None):
         self.fout = fout
         self.section_id = 0
+        self.fragment_dir = fragment_dir
+        self.fragments_written = set()
+        # Where output goes now: fout, or the fragment being written.
+        self.outputs = [fout]
+        # For each open section: None, or the name of the fragment being written.
+        self.sections = []
         head = self.HEAD
         head = head.replace("[[CSS]]", textwrap.dedent(css))
         head = head.replace("[[TITLE]]", title)
+        if fragment_dir:
+            os.makedirs(fragment_dir, exist_ok=True)
+            for name in os.listdir(fragment_dir):
+                if name.endswith(".js"):
+                    os.remove(os.path.join(fragment_dir, name))
+            script = self.FRAGMENT_SCRIPT.replace("[[FRAGMENT_DIR]]", json.dumps(os.path.basename(fragment_dir)))
+            head = head.replace("</head>", script + "</head>")
         self.fout.write(head)
 
-    def start_section(self, html, klass=None):
-        self.fout.write(self.SECTION_START.format(
-            id=self.section_id, html=html, klass=klass or "",
+    def start_section(self, html, klass=None, fragment=None):
+        """Start a section, with `html` as its always-visible header.
+
+        If `fragment` is a name, and we are writing fragments, the contents of
+        the section are written as that fragment.  Returns False if the
+        fragment was already written: the caller should skip writing the
+        contents, but still end the section.
+
+        """
+        if fragment is None or self.fragment_dir is None:
+            self.write(self.SECTION_START.format(
+                id=self.section_id, html=html, klass=klass or "",
+            ))
+            self.section_id += 1
+            self.sections.append(None)
+            return True
+
+        self.write(self.FRAGMENT_SECTION_START.format(
+            id=self.section_id, html=html, klass=klass or "", fragment=fragment,
         ))
         self.section_id += 1
+        if fragment in self.fragments_written:
+            self.sections.append(None)
+            return False
+        self.fragments_written.add(fragment)
+        self.sections.append(fragment)
+        self.outputs.append(io.StringIO())
+        return True
 
     def end_section(self):
-        self.fout.write(self.SECTION_END)
+        fragment = self.sections.pop()
+        if fragment is not None:
+            html = self.outputs.pop().getvalue()
+            with open(os.path.join(self.fragment_dir, fragment + ".js"), "w") as fjs:
+                fjs.write(f"censusFragment({json.dumps(fragment)}, {json.dumps(html)});\n")
+        self.write(self.SECTION_END)
 
     def write(self, html):
-        self.fout.write(html)
+        self.outputs[-1].write(html)
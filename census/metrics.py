@@ -0,0 +1,112 @@
+"""Live metrics about a scrape, served in Prometheus text format."""
+
+import collections
+import time
+
+import aiohttp.web
+
+
+class Metrics:
+    """Counters and gauges updated as the scrape runs."""
+
+    # How many seconds of history to use for the rates.
+    RATE_WINDOW = 60
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Start over, for a new scrape."""
+        # Sites started, and sites the probe found gone without starting.
+        self.sites_started = 0
+        self.in_flight = 0
+        # Requests waiting for the semaphore.
+        self.waiting = 0
+        self.requests = 0
+        self.bytes = 0
+        # Outcome characters from parse_site: =, +, -, G, E, B, X.
+        self.outcomes = collections.Counter()
+        # Failed attempts, by category of error.
+        self.errors = collections.Counter()
+        self.cache_hits = collections.Counter()
+        self.cache_misses = collections.Counter()
+        self.history = collections.deque([(time.monotonic(), 0, 0)])
+
+    def cache_lookup(self, cache, hit):
+        """Record a hit or a miss in the cache named `cache`."""
+        if hit:
+            self.cache_hits[cache] += 1
+        else:
+            self.cache_misses[cache] += 1
+
+    def rates(self):
+        """Return requests/sec and bytes/sec over the recent past."""
+        now = time.monotonic()
+        self.history.append((now, self.requests, self.bytes))
+        while len(self.history) > 2 and now - self.history[1][0] > self.RATE_WINDOW:
+            self.history.popleft()
+        then, requests, nbytes = self.history[0]
+        elapsed = (now - then) or 1
+        return (self.requests - requests) / elapsed, (self.bytes - nbytes) / elapsed
+
+    def render(self):
+        """Produce the Prometheus text format of the metrics."""
+        lines = []
+        def metric(name, kind, help, values):
+            lines.append(f"# HELP census_{name} {help}")
+            lines.append(f"# TYPE census_{name} {kind}")
+            for labels, value in values:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                if label_text:
+                    label_text = "{" + label_text + "}"
+                lines.append(f"census_{name}{label_text} {value}")
+
+        requests_per_sec, bytes_per_sec = self.rates()
+        done = sum(self.outcomes.values())
+        metric("sites_started_total", "counter", "Sites started, or found gone by the probe.", [({}, self.sites_started)])
+        metric("sites_done", "gauge", "Sites finished.", [({}, done)])
+        metric("requests_in_flight", "gauge", "Requests being made now.", [({}, self.in_flight)])
+        metric("requests_waiting", "gauge", "Requests waiting for the concurrency limit.", [({}, self.waiting)])
+        metric("requests_total", "counter", "Requests made.", [({}, self.requests)])
+        metric("bytes_total", "counter", "Bytes read.", [({}, self.bytes)])
+        metric("requests_per_second", "gauge", "Recent requests per second.", [({}, round(requests_per_sec, 3))])
+        metric("bytes_per_second", "gauge", "Recent bytes per second.", [({}, round(bytes_per_sec, 1))])
+        metric(
+            "outcomes_total", "counter", "Finished sites, by outcome.",
+            [({"outcome": char}, n) for char, n in sorted(self.outcomes.items())],
+        )
+        metric(
+            "errors_total", "counter", "Failed attempts, by category.",
+            [({"category": cat}, n) for cat, n in sorted(self.errors.items())],
+        )
+        caches = sorted(set(self.cache_hits) | set(self.cache_misses))
+        metric("cache_hits_total", "counter", "Cache hits.", [({"cache": c}, self.cache_hits[c]) for c in caches])
+        metric("cache_misses_total", "counter", "Cache misses.", [({"cache": c}, self.cache_misses[c]) for c in caches])
+        metric(
+            "cache_hit_ratio", "gauge", "Fraction of cache lookups that hit.",
+            [
+                ({"cache": c}, round(self.cache_hits[c] / ((self.cache_hits[c] + self.cache_misses[c]) or 1), 4))
+                for c in caches
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+
+# The metrics for this process.
+metrics = Metrics()
+
+
+async def serve_metrics(port, host="127.0.0.1"):
+    """Serve /metrics on a local port.  Returns the runner, to clean up later."""
+    async def handle(request):
+        return aiohttp.web.Response(
+            text=metrics.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, host, port).start()
+    return runner
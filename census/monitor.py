@@ -0,0 +1,113 @@
+"""Time the callbacks run by the event loop.
+
+Every callback's CPU time is charged to the Attempt its task was working on,
+and a LoopMonitor can watch for callbacks that block the loop.
+
+"""
+
+import asyncio
+import asyncio.events
+import collections
+import contextvars
+import time
+
+# What the current task is working on: (site url, Attempt).
+working_on = contextvars.ContextVar("working_on", default=None)
+
+_original_run = None
+
+
+def install_callback_timer(loop_monitor=None):
+    """Start timing the callbacks run by asyncio event loops."""
+    global _original_run
+    if _original_run is None:
+        _original_run = asyncio.events.Handle._run
+    original_run = _original_run
+
+    def _run(handle):
+        context = handle._context
+        work = context.get(working_on)
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        original_run(handle)
+        cpu = time.thread_time() - cpu_start
+        duration = time.perf_counter() - start
+        if work is None:
+            # The callback might have started some work.
+            work = context.get(working_on)
+        if work is not None:
+            work[1].cpu_time += cpu
+        if loop_monitor is not None and duration > loop_monitor.threshold:
+            loop_monitor.slow.append((duration, work))
+
+    asyncio.events.Handle._run = _run
+
+
+def uninstall_callback_timer():
+    """Stop timing callbacks."""
+    global _original_run
+    if _original_run is not None:
+        asyncio.events.Handle._run = _original_run
+        _original_run = None
+
+
+class LoopMonitor:
+    """Sample event loop lag, and note callbacks that run too long.
+
+    A slow callback is attributed to the site and parser its task was working
+    on, as recorded in `working_on`.
+
+    """
+    def __init__(self, threshold=0.1, interval=0.05):
+        self.threshold = threshold
+        self.interval = interval
+        self.lags = []
+        # List of (duration, (site url, Attempt))
+        self.slow = []
+        self.sampler = None
+
+    def start(self):
+        """Start sampling the running loop's lag."""
+        self.sampler = asyncio.ensure_future(self.sample_lag())
+
+    def stop(self):
+        """Stop sampling."""
+        if self.sampler is not None:
+            self.sampler.cancel()
+            self.sampler = None
+
+    async def sample_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(loop.time() - before - self.interval)
+
+    def summary(self, top=10):
+        """Return a multi-line string summarizing what we saw."""
+        lines = []
+        if self.lags:
+            lags = sorted(self.lags)
+            p99 = lags[int(len(lags) * .99)]
+            lines.append(
+                f"Loop lag: {len(lags)} samples, "
+                f"mean {sum(lags) / len(lags) * 1000:.1f}ms, "
+                f"p99 {p99 * 1000:.1f}ms, max {lags[-1] * 1000:.1f}ms"
+            )
+        total = sum(duration for duration, _ in self.slow)
+        lines.append(
+            f"Slow callbacks (> {self.threshold * 1000:.0f}ms): {len(self.slow)}, "
+            f"blocking {total:.1f}s in all"
+        )
+        by_parser = collections.defaultdict(list)
+        for duration, work in self.slow:
+            parser = work[1].strategy if work else None
+            by_parser[parser].append(duration)
+        for parser, durations in sorted(by_parser.items(), key=lambda kv: sum(kv[1]), reverse=True):
+            lines.append(f"    {parser or '(no parser)'}: {len(durations)}, {sum(durations):.2f}s")
+        if self.slow:
+            lines.append("Slowest:")
+            for duration, work in sorted(self.slow, key=lambda dw: dw[0], reverse=True)[:top]:
+                url, attempt = work or ("(unknown)", None)
+                lines.append(f"    {duration * 1000:.0f}ms {url} {attempt.strategy if attempt else ''}")
+        return "\n".join(lines)
@@ -0,0 +1,151 @@
+"""Remember where sites redirect to, so we can go straight there next time."""
+
+import json
+import os
+import urllib.parse
+
+from census.metrics import metrics
+
+
+def split_origin(url):
+    """Split `url` into its origin ("https://example.com") and the rest."""
+    parts = urllib.parse.urlsplit(url)
+    rest = parts.path or "/"
+    if parts.query:
+        rest += "?" + parts.query
+    return f"{parts.scheme}://{parts.netloc}".lower(), rest
+
+
+class OriginMap:
+    """A persistent map from the origins we request to the origins that answer.
+
+    Sites are mostly listed as bare domains, so we request http://example.com,
+    which redirects to https://example.com, or some other host.  The map lets
+    requests go straight to the final origin.  Only redirects that keep the
+    path are remembered, so a redirect to a login page doesn't send every
+    request there.
+
+    Entries read from the file are trusted to rewrite requests, but the
+    session goes back to the original url if the rewritten one can't connect.
+    `confirmed` has the origins that have worked in this run.
+
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.origins = {}
+        self.confirmed = set()
+        self.changed = False
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.origins = json.load(f)
+
+    def __len__(self):
+        return len(self.origins)
+
+    def rewrite(self, url):
+        """Get the url to request instead of `url`."""
+        origin, rest = split_origin(url)
+        final = self.origins.get(origin)
+        metrics.cache_lookup("origins", final is not None)
+        if final is None or final == origin:
+            return url
+        return final + rest
+
+    def known_url(self, url):
+        """Get the confirmed final url for `url`, or None if we don't know it."""
+        final_origin = self.known_origin(url)
+        metrics.cache_lookup("confirmed_origins", final_origin is not None)
+        if final_origin is None:
+            return None
+        return final_origin + split_origin(url)[1]
+
+    def known_origin(self, url):
+        """Get the confirmed final origin for `url`, or None if we don't know it."""
+        origin, _ = split_origin(url)
+        if origin not in self.confirmed:
+            return None
+        return self.origins[origin]
+
+    def learn(self, url, final_url):
+        """Record that a request for `url` ended up at `final_url`."""
+        origin, rest = split_origin(url)
+        final_origin, final_rest = split_origin(final_url)
+        if rest.rstrip("/") != final_rest.rstrip("/"):
+            return
+        if self.origins.get(origin) != final_origin:
+            self.origins[origin] = final_origin
+            self.changed = True
+        self.confirmed.add(origin)
+
+    def forget(self, url):
+        """Forget where `url`'s origin goes, because it didn't work."""
+        origin, _ = split_origin(url)
+        if self.origins.pop(origin, None) is not None:
+            self.changed = True
+        self.confirmed.discard(origin)
+
+    def save(self):
+        """Write the map to its file, if it has changed."""
+        if not self.filename or not self.changed:
+            return
+        temp_file = self.filename + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(self.origins, f, indent=0, sort_keys=True)
+        os.replace(temp_file, self.filename)
+        self.changed = False
+
+
+class OriginClaims:
+    """Which site is scraping each final origin in this run.
+
+    Many sites are aliases that redirect to the same place.  The first site to
+    claim an origin scrapes it, and the others can wait for its result.
+
+    """
+    def __init__(self):
+        # Maps origins to (site, future done when the site is finished).
+        self.owners = {}
+
+    def claim(self, origin, site, done):
+        """Claim `origin` for `site`, unless another site already has.
+
+        Returns the (site, done) pair that owns the origin.
+
+        """
+        return self.owners.setdefault(origin, (site, done))
+
+
+class FoundOwner(Exception):
+    """Raised when a site's origin is already claimed by another site."""
+    def __init__(self, owner, owner_done):
+        super().__init__(f"Alias of {owner.url}")
+        self.owner = owner
+        self.owner_done = owner_done
+
+
+class OriginClaimer:
+    """Claims a site's origin for it once a response confirms where it goes.
+
+    The session checks after every response, even an error, so the claim is
+    made from the first response a parser gets, and finding out costs no
+    extra requests.  If another site already owns the origin, FoundOwner is
+    raised out of the parser.
+
+    """
+    def __init__(self, site, claims, origins, done):
+        self.site = site
+        self.claims = claims
+        self.origins = origins
+        self.done = done
+        self.claimed = False
+
+    def check(self):
+        if self.claimed:
+            return
+        origin = self.origins.known_origin(self.site.url)
+        if origin is None:
+            return
+        self.claimed = True
+        owner, owner_done = self.claims.claim(origin, self.site, self.done)
+        if owner is not self.site:
+            raise FoundOwner(owner, owner_done)
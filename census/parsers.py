@@ -11,9 +11,10 @@ from census.helpers import (
     site_url,
     parse_text,
     element_by_css, elements_by_css, elements_by_xpath,
-    GotZero, NotTrying,
+    GotZero, NotTrying, ScrapeFail,
 )
-from census.site_patterns import matches, matches_any
+from census.site_patterns import conclusive, enriches, matches, matches_any
+from census.sites import find_course_ids
 
 # FUN has an api that returns a count.
 @matches("fun-mooc.fr", "/fun/api/courses/?rpp=50&page=1", "count")
@@ -266,7 +267,7 @@ async def edx_org_parser(site, session):
         for obj in objs:
             course_id = obj.get('key')
             if course_id:
-                site.course_ids[course_id] += 1
+                site.add_course_id(course_id)
         url = data['objects'].get('next')
         if not url:
             break
@@ -317,12 +318,74 @@ async def count_tiles(url, site, session):
     try:
         for elt in elts:
             course_id = elt.xpath("article/@id")[0]
-            site.course_ids[course_id] += 1
+            site.add_course_id(course_id)
     except Exception:
         pass
     site.process_text(text)
     return count
 
+def is_current_course(course, now, soon):
+    """Is a Course API `course` one we'd count: not ended, and starting soon?"""
+    end, start = course.get("end"), course.get("start")
+    if isinstance(end, str) and end < now:
+        return False
+    if isinstance(start, str) and start > soon:
+        return False
+    return True
+
+@matches_any
+@conclusive
+async def course_api(site, session):
+    """Count current courses with the Course API.
+
+    Like the other parsers, courses that have ended or start more than a year
+    from now aren't counted.  Newer sites leave out ended courses when asked
+    with active_only, but older ones list them all, so every page is read to
+    check the dates.
+
+    The home page is read for the fingerprint, version and tags, unless an
+    earlier parser already read a page for them.
+    """
+    url = site_url(site, "/api/courses/v1/courses/?active_only=true&page_size=100")
+    now = datetime.datetime.now().isoformat()
+    soon = (datetime.datetime.now() + datetime.timedelta(days=365)).isoformat()
+    keep_ids = find_course_ids.get()
+    listed = set()
+    current = set()
+    seen = set()
+    while url and url not in seen:
+        seen.add(url)
+        text = await session.text_from_url(url)
+        try:
+            data = json.loads(text)
+            results = list(data["results"])
+            url = data["pagination"].get("next")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise GotZero("No course api")
+        listed_before = len(listed)
+        for course in results:
+            if isinstance(course, dict) and course.get("id"):
+                listed.add(course["id"])
+                if is_current_course(course, now, soon):
+                    current.add(course["id"])
+        if len(listed) == listed_before:
+            # A page with nothing new, don't keep going.
+            break
+    if not current:
+        raise GotZero("No current courses in the course api")
+    if keep_ids:
+        for course_id in sorted(current):
+            site.add_course_id(course_id)
+
+    if not site.fingerprint:
+        try:
+            text = await session.text_from_url(site.url)
+        except ScrapeFail:
+            pass
+        else:
+            site.process_text(text)
+    return len(current)
+
 @matches_any
 async def edx_search_post(site, session):
     real_url = await session.real_url(site.url)
@@ -350,7 +413,7 @@ async def edx_search_post(site, session):
             break
         try:
             for course in data["results"]:
-                site.course_ids[course["_id"]] += 1
+                site.add_course_id(course["_id"])
                 start = course["data"]["start"]
                 if start < soon:
                     count += 1
@@ -374,17 +437,11 @@ async def courses_page_full_of_tiles(site, session):
 async def home_page_full_of_tiles(site, session):
     return await count_tiles(site.url, site, session)
 
-@matches_any
+@enriches
 async def contact_page(site, session):
-    current_courses = site.attempt_course_count()
-    if current_courses is None:
-        raise NotTrying("No point trying /contact")
-
-    # Only try the contact page if we got some data from the site.
     url = site_url(site, "/contact")
     text = await session.text_from_url(url)
     site.process_text(text, fingerprint=False, emails=True)
-    raise NotTrying("Not looking for courses on /contact")
 
 # This isn't ready yet.
 # Studio has a link to its LMS.  This could help us find sites that aren't
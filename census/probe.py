@@ -0,0 +1,64 @@
+"""A quick check of which sites are alive, before scraping them properly."""
+
+import aiohttp
+
+from census.helpers import in_pool
+from census.metrics import metrics
+from census.session import GONE_ERROR_KINDS, error_kind
+
+# Probe failures that mean a site is gone.  A probe's short timeout doesn't:
+# a slow site gets the scrape's longer timeout.
+PROBE_GONE_KINDS = GONE_ERROR_KINDS - {"timeout"}
+
+# How many probes to run at once.
+PROBE_CONCURRENCY = 500
+
+
+async def probe_site(site, session, timeout):
+    """Make a HEAD request to `site`.
+
+    Returns None if the site answered at all, with any status, or a
+    (reason, detail) pair if it didn't.
+
+    """
+    try:
+        async with session.head(
+            site.url, allow_redirects=False, ssl=False,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ):
+            return None
+    except Exception as exc:
+        return error_kind(exc), str(exc) or exc.__class__.__name__
+
+
+async def probe_sites(sites, timeout, headers=None, connector=None, concurrency=PROBE_CONCURRENCY):
+    """Probe all of `sites`, and mark the ones that are gone.
+
+    Only failures that the scrape would also take to mean a site is gone
+    count.  Sites that failed in other ways, like timing out, still get
+    scraped.
+
+    Returns the list of sites to scrape, in their original order.
+
+    """
+    failures = [None] * len(sites)
+
+    async def probe(item):
+        num, site = item
+        failures[num] = await probe_site(site, session, timeout)
+
+    async with aiohttp.ClientSession(
+        headers=headers, connector=connector, connector_owner=(connector is None),
+    ) as session:
+        await in_pool(enumerate(sites), probe, concurrency)
+
+    live = []
+    for site, failure in zip(sites, failures):
+        if failure is not None:
+            metrics.errors[f"probe_{failure[0]}"] += 1
+            if failure[0] in PROBE_GONE_KINDS:
+                site.is_gone_now = True
+                site.gone_reason = failure
+                continue
+        live.append(site)
+    return live
@@ -0,0 +1,63 @@
+"""Process archived pages again, to pick up changes in how we sniff them."""
+
+import itertools
+import multiprocessing
+
+from census.archive import ArchiveReader
+from census.sites import Site
+
+# The Site fields that process_text sets.
+ANALYZED_FIELDS = ["fingerprint", "simhash", "version", "tags", "emails"]
+
+# How many sites a worker process analyzes at a time.
+CHUNK_SIZE = 200
+
+# Forked workers find their work here, rather than having it pickled to them.
+_reader = None
+_todo = None
+
+
+def analyze_pages(url, pages, reader):
+    """Replay process_text on the archived `pages` of the site at `url`.
+
+    Returns the values of ANALYZED_FIELDS.
+
+    """
+    site = Site(url, latest_courses=0, is_gone=False)
+    for digest, fingerprint, type, emails in pages:
+        site.process_text(reader.read(digest), fingerprint=fingerprint, type=type, emails=emails)
+    site.finish_pages()
+    return [getattr(site, name) for name in ANALYZED_FIELDS]
+
+
+def _analyze_chunk(start):
+    return [analyze_pages(site.url, site.pages, _reader) for site in _todo[start:start + CHUNK_SIZE]]
+
+
+def reanalyze_sites(sites, archive_dir, jobs=1):
+    """Update `sites` by processing their archived pages again.
+
+    Sites whose pages weren't all archived are left alone.  Returns the list
+    of sites that were updated, and how many of them got a new fingerprint.
+
+    """
+    global _reader, _todo
+    _reader = ArchiveReader(archive_dir)
+    _todo = [site for site in sites if site.pages and all(page[0] in _reader for page in site.pages)]
+    starts = range(0, len(_todo), CHUNK_SIZE)
+    try:
+        if jobs > 1 and len(starts) > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context("fork").Pool(jobs) as pool:
+                results = pool.map(_analyze_chunk, starts)
+        else:
+            results = map(_analyze_chunk, starts)
+        todo = _todo
+        changed = 0
+        for site, values in zip(todo, itertools.chain.from_iterable(results)):
+            if site.fingerprint != values[0]:
+                changed += 1
+            for name, value in zip(ANALYZED_FIELDS, values):
+                setattr(site, name, value)
+    finally:
+        _reader = _todo = None
+    return todo, changed
@@ -0,0 +1,214 @@
+"""Turn raw referer dumps into lists of domains to scrape."""
+
+import calendar
+import collections
+import datetime
+import gzip
+import json
+import os
+import re
+
+from census.helpers import is_chaff_domain
+
+
+def read_junk_regex(regex_file):
+    """Read the lines of `regex_file` into a JunkMatcher."""
+    with open(regex_file) as f:
+        patterns = [line.rstrip("\n") for line in f]
+    return JunkMatcher([pat for pat in patterns if pat])
+
+
+class JunkMatcher:
+    """Match strings against many regexes at once.
+
+    Python regexes try every alternative at every position, so one big
+    alternation is slow.  Most of our patterns contain some literal text that
+    any match must include, so first we look for any of those literals, and
+    only then try the patterns.  The patterns with no literal are combined into
+    one regex that is always tried.
+
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+        literal_pats = []
+        other_pats = []
+        for pat in patterns:
+            literal = required_literal(pat)
+            if len(literal) >= 3:
+                literal_pats.append((literal, pat))
+            else:
+                other_pats.append(pat)
+        self.literals_re = combine_regexes(re.escape(lit) for lit, _ in literal_pats)
+        self.literal_res = [re.compile(pat) for _, pat in literal_pats]
+        self.others_re = combine_regexes(other_pats)
+
+    def search(self, text):
+        """Does any pattern match `text`?"""
+        if self.others_re.search(text):
+            return True
+        if self.literals_re.search(text):
+            return any(regex.search(text) for regex in self.literal_res)
+        return False
+
+
+def combine_regexes(patterns):
+    """Compile one regex matching any of `patterns`, or nothing if there are none."""
+    patterns = list(patterns)
+    if not patterns:
+        return re.compile(r"(?!)")
+    return re.compile("|".join(f"(?:{pat})" for pat in patterns))
+
+
+def required_literal(pattern):
+    """Find the longest literal text any match of `pattern` must contain.
+
+    Only understands simple regexes: anything in groups or character classes
+    is skipped, and a top-level alternation means there's no literal.
+
+    """
+    best = run = ""
+    def end_run():
+        nonlocal best, run
+        if len(run) > len(best):
+            best = run
+        run = ""
+
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            escaped = pattern[i+1:i+2]
+            if depth == 0 and escaped and not escaped.isalnum():
+                run += escaped
+            else:
+                end_run()
+            i += 2
+            continue
+        if c == "[":
+            # Skip the character class.
+            end_run()
+            i += 2 if pattern[i+1:i+2] == "]" else 1
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+        elif c == "(":
+            end_run()
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return ""
+        elif c in "*?{":
+            # The last character is optional.
+            run = run[:-1]
+            end_run()
+            if c == "{":
+                i = pattern.find("}", i)
+                if i < 0:
+                    break
+        elif depth == 0 and (c.isalnum() or c in "-_"):
+            run += c
+        else:
+            end_run()
+        i += 1
+    end_run()
+    return best
+
+
+def normalize_referer(line):
+    """Get the host name from a line of a referer dump, or "" if none.
+
+    Lines can be bare domains as printed by psql (" example.com."), or urls.
+
+    """
+    host = line.strip().lower()
+    if "/" in host:
+        if "://" in host:
+            host = host.partition("://")[2]
+        host = host.partition("/")[0]
+    return host.rstrip(".")
+
+
+def clean_referers(lines, junk_re, keep_chaff=False):
+    """Produce the distinct, non-junk hosts from the referer dump `lines`.
+
+    Hosts come out in the order they were first seen.
+
+    """
+    seen = set()
+    for line in lines:
+        host = normalize_referer(line)
+        if not host or host in seen:
+            continue
+        seen.add(host)
+        if junk_re.search(host):
+            continue
+        if not keep_chaff and is_chaff_domain(host):
+            continue
+        yield host
+
+
+class RefererHistory:
+    """The date each referer domain was first seen in the history snapshots.
+
+    Snapshots are files named referers_YYYYMMDD.txt in `history_dir`.  The
+    dates are kept in a gzipped index file there, with the domains grouped by
+    date so each is stored once.  Only snapshots not already in the index are
+    read.
+
+    """
+    INDEX_NAME = "first-seen.json.gz"
+    SNAPSHOT_RE = re.compile(r"^referers_(\d{8})\.txt$")
+
+    def __init__(self, history_dir):
+        self.history_dir = history_dir
+        self.index_file = os.path.join(history_dir, self.INDEX_NAME)
+        # Snapshot file names already indexed.
+        self.snapshots = []
+        # Maps domain to "YYYYMMDD".
+        self.first_seen = {}
+        if os.path.exists(self.index_file):
+            with gzip.open(self.index_file, "rt") as f:
+                data = json.load(f)
+            self.snapshots = data["snapshots"]
+            for date, domains in data["first_seen"].items():
+                self.first_seen.update(dict.fromkeys(domains, date))
+
+    def update(self):
+        """Read any new snapshots into the index, and save it if it changed."""
+        indexed = set(self.snapshots)
+        new_snapshots = []
+        for name in sorted(os.listdir(self.history_dir)):
+            m = self.SNAPSHOT_RE.match(name)
+            if m and name not in indexed:
+                new_snapshots.append((m[1], name))
+        if not new_snapshots:
+            return
+        for date, name in new_snapshots:
+            with open(os.path.join(self.history_dir, name)) as f:
+                for line in f:
+                    domain = line.strip()
+                    if domain and date < self.first_seen.get(domain, "99999999"):
+                        self.first_seen[domain] = date
+            self.snapshots.append(name)
+        by_date = collections.defaultdict(list)
+        for domain, date in self.first_seen.items():
+            by_date[date].append(domain)
+        with gzip.open(self.index_file, "wt", compresslevel=5) as f:
+            json.dump({"snapshots": self.snapshots, "first_seen": by_date}, f, separators=(",", ":"))
+
+    def new_since(self, domains, since):
+        """Produce the `domains` that weren't seen in snapshots before `since`, a date."""
+        since = since.strftime("%Y%m%d")
+        for domain in domains:
+            if self.first_seen.get(domain, "99999999") >= since:
+                yield domain
+
+
+def months_ago(months, today=None):
+    """The date `months` months before `today`."""
+    today = today or datetime.date.today()
+    year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+    month += 1
+    day = min(today.day, calendar.monthrange(year, month)[1])
+    return datetime.date(year, month, day)
@@ -1,10 +1,16 @@
 """Helpers for making reports."""
 
 import collections
+import json
+import os
 
-from census.helpers import domain_from_url
-from census.settings import ALIASES_TXT, SITES_CSV
-from census.sites import read_sites_csv, HashedSite
+import attr
+
+from census.domains import DomainIndex
+from census.helpers import SIMHASH_BITS, domain_from_url
+from census.settings import ALIASES_TXT, DOMAINS_CACHE, SITES_CSV
+from census.site_patterns import ENRICHERS, SITE_PATTERNS
+from census.sites import read_sites_csv, HashedSite, courses_and_orgs, totals
 
 
 def sort_sites(sites):
@@ -15,13 +21,40 @@ def sort_sites(sites):
 
 
 def get_known_domains():
-    known_domains = {domain_from_url(site.url) for site in read_sites_csv(SITES_CSV)}
+    """Get a DomainIndex of the domains in the sites and aliases files.
+
+    The domains are cached in DOMAINS_CACHE as a JSON list, and only read
+    again from the files when they or the DomainIndex version change.
+
+    """
+    key = {
+        "version": DomainIndex.VERSION,
+        "files": [[name, os.path.getmtime(name)] for name in [SITES_CSV, ALIASES_TXT]],
+    }
+    try:
+        with open(DOMAINS_CACHE) as f:
+            cache = json.load(f)
+        if cache["key"] == key:
+            return DomainIndex(cache["domains"])
+    except Exception:
+        # No cache, or one we can't use: rebuild it.
+        pass
+
+    known_domains = DomainIndex(domain_from_url(site.url) for site in read_sites_csv(SITES_CSV))
     with open(ALIASES_TXT) as aliases:
-        known_domains.update(domain_from_url(line.strip()) for line in aliases)
+        for line in aliases:
+            known_domains.add(domain_from_url(line.strip()))
+
+    try:
+        with open(DOMAINS_CACHE, "w") as f:
+            json.dump({"key": key, "domains": sorted(known_domains)}, f)
+    except OSError:
+        # No cache this time.
+        pass
     return known_domains
 
 
-def hash_sites_together(sites, known_domains, only_new=False):
+def hash_sites_together(sites, known_domains, only_new=False, cluster=False):
     hashed_sites_by_fp = collections.defaultdict(HashedSite)
     for site in sites:
         fp = site.fingerprint or site.url
@@ -31,6 +64,8 @@ def hash_sites_together(sites, known_domains, only_new=False):
         hashed_site.sites.append(site)
 
     hashed_sites = list(hashed_sites_by_fp.values())
+    if cluster:
+        hashed_sites = cluster_hashed_sites(hashed_sites)
 
     for hashed_site in hashed_sites:
         if hashed_site.all_chaff():
@@ -47,3 +82,169 @@ def hash_sites_together(sites, known_domains, only_new=False):
 
     hashed_sites = sorted(hashed_sites, key=lambda hs: hs.current_courses() or 0, reverse=True)
     return hashed_sites
+
+
+# SimHashes are split into this many bands for finding candidate pairs.
+SIMHASH_BANDS = 4
+
+def cluster_hashed_sites(hashed_sites, max_distance=SIMHASH_BANDS - 1):
+    """Merge HashedSites whose SimHashes differ by at most `max_distance` bits.
+
+    Sites are only compared if one of their SimHash bands is the same.  With
+    `max_distance` less than the number of bands, any two close enough
+    SimHashes must have a band in common, so no pair is missed.
+
+    Returns a new list of HashedSites.  Each takes its fingerprint from the
+    largest of the HashedSites it is made from.
+
+    """
+    parent = list(range(len(hashed_sites)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    band_bits = SIMHASH_BITS // SIMHASH_BANDS
+    band_mask = (1 << band_bits) - 1
+    buckets = collections.defaultdict(list)
+    simhashes = [hashed_site.simhash() for hashed_site in hashed_sites]
+    for i, simhash in enumerate(simhashes):
+        if simhash is None:
+            continue
+        for band in range(SIMHASH_BANDS):
+            bucket = buckets[band, (simhash >> (band * band_bits)) & band_mask]
+            for j in bucket:
+                if find(i) != find(j) and bin(simhash ^ simhashes[j]).count("1") <= max_distance:
+                    parent[find(i)] = find(j)
+            bucket.append(i)
+
+    clusters = collections.defaultdict(list)
+    for i, hashed_site in enumerate(hashed_sites):
+        clusters[find(i)].append(hashed_site)
+
+    clustered = []
+    for members in clusters.values():
+        if len(members) == 1:
+            clustered.append(members[0])
+            continue
+        members.sort(key=lambda hs: len(hs.sites), reverse=True)
+        clustered.append(HashedSite(
+            fingerprint=members[0].fingerprint,
+            sites=[site for hs in members for site in hs.sites],
+            version=members[0].version,
+        ))
+    return clustered
+
+
+class ReportData:
+    """The structures reports need, derived from a list of sites.
+
+    Each structure is computed once, the first time it's asked for.  Reports
+    can leave out the sites with no course count (`skip_none`), so there can
+    be two of each structure.
+
+    """
+    def __init__(self, sites):
+        self.all_sites = sites
+        self.memo = {}
+
+    def _memoized(self, key, func):
+        if key not in self.memo:
+            self.memo[key] = func()
+        return self.memo[key]
+
+    def sites(self, skip_none=False):
+        if not skip_none:
+            return self.all_sites
+        return self._memoized(
+            ("sites", skip_none),
+            lambda: [site for site in self.all_sites if site.current_courses is not None],
+        )
+
+    def sorted_sites(self, skip_none=False):
+        return self._memoized(("sorted_sites", skip_none), lambda: sort_sites(self.sites(skip_none)))
+
+    def totals(self, skip_none=False):
+        return self._memoized(("totals", skip_none), lambda: totals(self.sites(skip_none)))
+
+    def known_domains(self):
+        return self._memoized("known_domains", get_known_domains)
+
+    def courses_and_orgs(self, skip_none=False):
+        return self._memoized(("courses_and_orgs", skip_none), lambda: courses_and_orgs(self.sites(skip_none)))
+
+    def hashed_sites(self, skip_none=False, only_new=False, cluster=False):
+        hashed_sites = self._memoized(
+            ("hashed_sites", skip_none, cluster),
+            lambda: hash_sites_together(self.sites(skip_none), self.known_domains(), cluster=cluster),
+        )
+        if only_new:
+            hashed_sites = [hashed_site for hashed_site in hashed_sites if hashed_site.is_new]
+        return hashed_sites
+
+    def prepare(self, skip_none=False, full=False, cluster=False):
+        """Compute everything a report will need."""
+        self.sorted_sites(skip_none)
+        self.totals(skip_none)
+        self.hashed_sites(skip_none, cluster=cluster)
+        if full:
+            self.courses_and_orgs(skip_none)
+
+
+@attr.s
+class StrategyStats:
+    """Totals of the cost and yield of one strategy."""
+    name = attr.ib()
+    tried = attr.ib(default=0)
+    succeeded = attr.ib(default=0)
+    final = attr.ib(default=0)
+    requests = attr.ib(default=0)
+    bytes = attr.ib(default=0)
+    wall_time = attr.ib(default=0.0)
+    cpu_time = attr.ib(default=0.0)
+
+    def add_cost(self, attempt):
+        self.tried += 1
+        self.requests += attempt.requests
+        self.bytes += attempt.bytes
+        self.wall_time += attempt.wall_time
+        self.cpu_time += attempt.cpu_time
+
+
+def strategy_stats(sites):
+    """Collect a StrategyStats for every parser and enricher, tried or not.
+
+    A strategy is "final" for a site if it's the first one that counted the
+    courses the site ended up with.  An enricher succeeds if it had no error,
+    and is never final.
+
+    Returns a list of StrategyStats, in the order the strategies are tried,
+    then the enrichers.
+    """
+    stats = {}
+    for func in [func for _, func, _, _ in SITE_PATTERNS] + ENRICHERS:
+        if func.__name__ not in stats:
+            stats[func.__name__] = StrategyStats(func.__name__)
+
+    def stats_for(attempt):
+        if attempt.strategy not in stats:
+            stats[attempt.strategy] = StrategyStats(attempt.strategy)
+        return stats[attempt.strategy]
+
+    for site in sites:
+        final_found = False
+        for attempt in site.tried:
+            st = stats_for(attempt)
+            st.add_cost(attempt)
+            if attempt.courses is not None:
+                st.succeeded += 1
+                if not final_found and attempt.courses == site.current_courses:
+                    st.final += 1
+                    final_found = True
+        for attempt in site.enrichments:
+            st = stats_for(attempt)
+            st.add_cost(attempt)
+            if attempt.error is None:
+                st.succeeded += 1
+    return list(stats.values())
@@ -0,0 +1,34 @@
+"""Decide which sites to scrape first, based on how long they took before."""
+
+import statistics
+
+
+def prior_costs(prior_sites):
+    """Estimate the seconds each site will take, from a previous scrape.
+
+    Returns a dict mapping urls to seconds.  The time a site spent waiting for
+    other sites' requests isn't counted, since that depends on when it ran,
+    not on the site.
+
+    """
+    costs = {}
+    for site in prior_sites:
+        if site.tried:
+            costs[site.url] = sum(attempt.wall_time - attempt.wait_time for attempt in site.tried)
+        elif site.time is not None:
+            costs[site.url] = site.time
+    return costs
+
+
+def schedule(sites, costs):
+    """Order `sites` most expensive first.
+
+    Returns a list of (site, priority) pairs.  The priority is the negative
+    of the expected seconds, so lower priorities should go first.  Sites with
+    no known cost are assumed to be typical.
+
+    """
+    default = statistics.median(costs.values()) if costs else 0
+    site_costs = [(site, costs.get(site.url, default)) for site in sites]
+    site_costs.sort(key=lambda sc: sc[1], reverse=True)
+    return [(site, -cost) for site, cost in site_costs]
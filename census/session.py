@@ -1,29 +1,184 @@
 import asyncio
+import contextlib
+import contextvars
+import heapq
 import itertools
-import json
 import logging
-import os
-import re
+import socket
+import ssl
+import time
 
 import aiohttp
 import async_timeout
 from asyncio_extras.contextmanager import async_contextmanager
 
 from census.helpers import HttpError
+from census.metrics import metrics
 
 
 log = logging.getLogger(__name__)
 
+# OpenSSL's X509_V_ERR_UNABLE_TO_GET_ISSUER_CERT_LOCALLY: the server didn't
+# send its intermediate certificates.  Browsers usually cope, so it's a false
+# alarm.
+UNABLE_TO_GET_ISSUER_CERT_LOCALLY = 20
+
+# The async_timeout.Timeout limiting the site being scraped, if any.  Time
+# spent waiting for the semaphore isn't charged to it.
+site_deadline = contextvars.ContextVar("site_deadline", default=None)
+
+@contextlib.contextmanager
+def deadline_paused():
+    """Don't count the time spent in the block against `site_deadline`."""
+    deadline = site_deadline.get()
+    if deadline is None or deadline.deadline is None or deadline.expired:
+        yield
+        return
+    loop = asyncio.get_running_loop()
+    paused_at = loop.time()
+    deadline.reject()
+    try:
+        yield
+    finally:
+        deadline.update(deadline.deadline + loop.time() - paused_at)
+
+@async_contextmanager
+async def site_time_limit(seconds):
+    """Raise TimeoutError if the block takes more than `seconds` of its own time.
+
+    Waits for the semaphore don't count: with many sites sharing a few
+    request slots, a healthy site can spend a long time in line.
+
+    """
+    async with async_timeout.timeout(seconds) as deadline:
+        token = site_deadline.set(deadline)
+        try:
+            yield deadline
+        finally:
+            site_deadline.reset(token)
+
+# aiohttp 3.10 added an exception for DNS failures, older versions only have
+# the socket.gaierror in os_error.
+ClientConnectorDNSError = getattr(aiohttp, "ClientConnectorDNSError", ())
+
+# Failures that mean the site isn't there any more.
+GONE_ERROR_KINDS = {"dns", "refused", "connect", "timeout", "tls"}
+GONE_HTTP_STATUSES = {
+    404,
+    500,
+    502,
+    503,
+    530,        # Cloudflare DNS failures
+}
+
+def is_gone_error(kind, status):
+    """Does an error of this kind and HTTP status mean the site is gone?"""
+    return kind in GONE_ERROR_KINDS or (kind == "http" and status in GONE_HTTP_STATUSES)
+
+def error_kind(exc):
+    """Classify an exception from making a request.
+
+    Returns one of "timeout", "http", "tls_issuer", "tls_verify", "tls",
+    "dns", "refused", "connect", "disconnected", or "error".
+
+    """
+    if isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return "http"
+    if isinstance(exc, ssl.SSLCertVerificationError):
+        cert_error = getattr(exc, "certificate_error", exc)
+        if getattr(cert_error, "verify_code", None) == UNABLE_TO_GET_ISSUER_CERT_LOCALLY:
+            return "tls_issuer"
+        return "tls_verify"
+    if isinstance(exc, (aiohttp.ClientSSLError, ssl.SSLError)):
+        return "tls"
+    if isinstance(exc, ClientConnectorDNSError):
+        return "dns"
+    if isinstance(exc, aiohttp.ClientConnectorError):
+        if isinstance(exc.os_error, socket.gaierror):
+            return "dns"
+        if isinstance(exc.os_error, ConnectionRefusedError):
+            return "refused"
+        return "connect"
+    if isinstance(exc, aiohttp.ServerDisconnectedError):
+        return "disconnected"
+    return "error"
+
+def http_error(exc, method, url):
+    """Make an HttpError from `exc`, raised while requesting `url`."""
+    kind = error_kind(exc)
+    status = getattr(exc, "status", None) if kind == "http" else None
+    detail = status if status is not None else (str(exc) or exc.__class__.__name__)
+    return HttpError(f"{detail} {method} {url}", kind=kind, status=status, url=url)
+
+
+class PrioritySemaphore:
+    """A semaphore whose waiters get in by priority, lowest first, then in order."""
+    def __init__(self, value):
+        self.value = value
+        self.waiters = []
+        self.order = itertools.count()
+
+    async def acquire(self, priority=0):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # We were given the slot, but can't use it.
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, fut = heapq.heappop(self.waiters)
+            if not fut.done():
+                # Hand our slot directly to the waiter.
+                fut.set_result(None)
+                return
+        self.value += 1
+
+
 class SmartSession:
-    def __init__(self, sem, timeout=20, headers=None, save=False, saver=None, listeners=None, **kwargs):
+    def __init__(
+        self, sem, timeout=20, headers=None, save=False, saver=None, listeners=None, connector=None,
+        priority=None, origins=None, claimer=None, **kwargs
+    ):
         self.sem = sem
+        # An OriginMap, to skip redirects we already know about.
+        self.origins = origins
+        # An OriginClaimer, to check after each response.
+        self.claimer = claimer
+        # Requests with lower priority numbers get to go first.  The priority
+        # is raised by the time our requests take, so a site that has done a
+        # lot of its work makes way for ones that have more left to do.  None
+        # means first come, first served.
+        self.priority = priority
         self.timeout = timeout
         self.kwargs = kwargs
-        self.session = aiohttp.ClientSession(headers=headers or {}, raise_for_status=True)
+        # A shared connector (for example, one with a custom resolver) is
+        # owned by whoever made it, not by this session.
+        self.session = aiohttp.ClientSession(
+            headers=headers or {},
+            raise_for_status=True,
+            connector=connector,
+            connector_owner=(connector is None),
+        )
         self.headers = {}
         self.save = save
         self.saver = saver
         self.listeners = listeners
+        # How much have we fetched?
+        self.requests = 0
+        self.bytes = 0
+        # Seconds spent waiting for the semaphore, and then holding it.
+        self.wait_time = 0.0
+        self.busy_time = 0.0
 
     async def __aenter__(self):
         await self.session.__aenter__()
@@ -38,21 +193,88 @@ class SmartSession:
     @async_contextmanager
     async def request(self, url, method="get", **kwargs):
         """How we like to make HTTP requests."""
-        async with self.sem:
-            log.debug("%s %s", method.upper(), url)
-            with async_timeout.timeout(self.timeout):
-                try:
-                    async with self.session.request(method, url, **self.kwargs, **kwargs) as response:
+        metrics.waiting += 1
+        wait_start = time.perf_counter()
+        try:
+            with deadline_paused():
+                if self.priority is None:
+                    await self.sem.acquire()
+                else:
+                    await self.sem.acquire(self.priority + self.busy_time)
+        finally:
+            metrics.waiting -= 1
+            self.wait_time += time.perf_counter() - wait_start
+        metrics.in_flight += 1
+        busy_start = time.perf_counter()
+        try:
+            try:
+                with async_timeout.timeout(self.timeout) as timeout:
+                    async with await self._send(method, url, kwargs, timeout) as response:
+                        if self.claimer is not None:
+                            self.claimer.check()
                         yield response
-                except aiohttp.ClientError as exc:
-                    code = getattr(exc, 'code', str(exc))
-                    raise HttpError(f"{code} {method} {url}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                if self.claimer is not None and isinstance(exc, aiohttp.ClientResponseError):
+                    self.claimer.check()
+                raise http_error(exc, method, url)
+        finally:
+            metrics.in_flight -= 1
+            self.busy_time += time.perf_counter() - busy_start
+            self.sem.release()
+
+    async def _send(self, method, url, kwargs, timeout):
+        """Make a request, going straight to where `url` redirects to, if we know.
+
+        If the request to where we thought it went fails, that's forgotten,
+        and `url` is requested with a fresh `timeout`.  Once the origin has
+        worked in this run, an HTTP error from it is believed.
+
+        """
+        if self.origins is not None:
+            known_url = self.origins.rewrite(url)
+            if known_url != url:
+                confirmed = self.origins.known_origin(url) is not None
+                deadline = timeout.deadline
+                timeout.reject()
+                try:
+                    async with async_timeout.timeout(self.timeout):
+                        response = await self._send_to(method, known_url, kwargs)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                    if confirmed and isinstance(exc, aiohttp.ClientResponseError):
+                        # The origin works, this is a real error from the site.
+                        timeout.update(deadline)
+                        raise
+                    # The site has changed since we learned where it goes.
+                    self.origins.forget(url)
+                    timeout.update(asyncio.get_running_loop().time() + self.timeout)
+                else:
+                    timeout.update(deadline)
+                    self.origins.learn(url, str(response.url))
+                    return response
+        try:
+            response = await self._send_to(method, url, kwargs)
+        except aiohttp.ClientResponseError as exc:
+            if self.origins is not None:
+                # An error still shows where the site went.
+                self.origins.learn(url, str(exc.request_info.real_url))
+            raise
+        if self.origins is not None:
+            self.origins.learn(url, str(response.url))
+        return response
+
+    async def _send_to(self, method, url, kwargs):
+        log.debug("%s %s", method.upper(), url)
+        self.requests += 1
+        metrics.requests += 1
+        return await self.session.request(method, url, **self.kwargs, **kwargs)
 
     async def text_from_url(self, url, came_from=None, method='get', data=None, save=False):
         if came_from:
             async with self.request(came_from) as resp:
                 real_url = str(resp.url)
                 from_text = await resp.read()
+                self.bytes += len(from_text)
+                metrics.bytes += len(from_text)
             if self.saver and (save or self.save):
                 self.saver(came_from, from_text, resp)
             cookies = self.session.cookie_jar.filter_cookies(url)
@@ -65,8 +287,9 @@ class SmartSession:
             try:
                 text = await response.read()
             except aiohttp.ClientError as exc:
-                code = getattr(exc, 'code', str(exc))
-                raise HttpError(f"{code} {method} {url}")
+                raise http_error(exc, method, url)
+        self.bytes += len(text)
+        metrics.bytes += len(text)
 
         if self.saver and (save or self.save):
             self.saver(url, text, response)
@@ -77,40 +300,26 @@ class SmartSession:
         return text
 
     async def real_url(self, url):
+        if self.origins is not None:
+            known_url = self.origins.known_url(url)
+            if known_url is not None:
+                return known_url
         async with self.request(url) as resp:
             return str(resp.url)
 
 
-class Saver:
-    numbers = itertools.count()
-
-    def __init__(self, dir="save"):
-        self.dir = dir
-
-    def save(self, url, text, response):
-        os.makedirs(self.dir, exist_ok=True)
-        if 1:
-            num = next(self.numbers)
-            ext = re.split(r"[+/]", response.content_type)[-1]
-            save_name = f"{num:06d}.{ext}"
-            with open(os.path.join(self.dir, "index.txt"), "a") as idx:
-                print(f"{save_name}: {response.method} {url} ({response.status})", file=idx)
-            with open(os.path.join(self.dir, save_name), "wb") as f:
-                f.write(text)
-        if 0:
-            if response.history:
-                print("-"*80, num)
-                print(url, [h.url for h in response.history], response.url)
-        if 1:
-            if str(response.url) != url:
-                with open(os.path.join(self.dir, "redirects.jsonl"), "a") as redirs:
-                    print(json.dumps([url, str(response.url)]), file=redirs)
-
-
 class SessionFactory:
-    def __init__(self, max_requests=10, **kwargs):
-        self.sem = asyncio.Semaphore(max_requests)
+    def __init__(self, max_requests=10, archive=None, **kwargs):
+        self.sem = PrioritySemaphore(max_requests)
+        # Where saved pages go: an Archive.
+        self.archive = archive
         self.session_kwargs = kwargs
 
+    @property
+    def origins(self):
+        """The OriginMap the sessions use, or None."""
+        return self.session_kwargs.get("origins")
+
     def new(self, **kwargs):
-        return SmartSession(self.sem, saver=Saver().save, **self.session_kwargs, **kwargs)
+        saver = self.archive.save if self.archive else None
+        return SmartSession(self.sem, saver=saver, **self.session_kwargs, **kwargs)
@@ -3,7 +3,18 @@ UPDATE_JSON = "update.json"
 SITES_CSV = "refs/sites.csv"
 SITES_PICKLE = "state/sites.pickle"
 ALIASES_TXT = "refs/aliases.txt"
+DOMAINS_CACHE = "state/known_domains.json"
+ORIGINS_JSON = "state/origins.json"
+RAW_REFERERS = "refs/raw-referers.txt"
+REFERERS_TXT = "refs/referers.txt"
+NEW_REFERERS_TXT = "refs/new-refs.txt"
+REFERER_HISTORY = "refs/history"
+JUNK_REFERERS = "junk-referers.regex"
+SAVE_DIR = "save"
 
 MAX_REQUESTS = 50
+MAX_SITES = 500
+ENRICH_REQUESTS = 10
 TIMEOUT = 30
+SITE_TIMEOUT = 180
 USER_AGENT = "Open edX census-taker. Tell us about your site: oscm+census@edx.org"
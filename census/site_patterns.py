@@ -3,6 +3,8 @@
 import re
 
 SITE_PATTERNS = []
+CONCLUSIVE = set()
+ENRICHERS = []
 
 def matches(suffix, *args, **kwargs):
     """Decorator for a parser to apply to any url that ends with the suffix."""
@@ -17,6 +19,19 @@ def matches_any(func):
     SITE_PATTERNS.append((None, func, (), {}))
     return func
 
+def conclusive(func):
+    """Decorator for a generic parser whose count is good enough to stop trying others."""
+    CONCLUSIVE.add(func)
+    return func
+
+def is_conclusive(func):
+    return func in CONCLUSIVE
+
+def enriches(func):
+    """Decorator for a function that adds details to a site whose courses are counted."""
+    ENRICHERS.append(func)
+    return func
+
 def find_site_functions(url):
     """Yield func, args, kwargs, custom_or_not."""
     for pattern, func, args, kwargs in SITE_PATTERNS:
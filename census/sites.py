@@ -1,26 +1,81 @@
 import collections
+import contextvars
+import copy
 import csv
 import re
+import zlib
 
 import attr
-import opaque_keys
-import opaque_keys.edx.keys
 
+from census.archive import current_archive
+from census.course_ids import COURSE_IDS
+from census.domains import DomainIndex
 from census.helpers import (
-    domain_from_url, is_chaff_domain, is_known, calc_fingerprint, sniff_version,
+    domain_from_url, is_chaff_domain, is_known, calc_fingerprint, calc_simhash, sniff_version,
     sniff_tags, emails_in_text, hostname
 )
 
-@attr.s
+# When process_text looks for emails: "inline" right away, "deferred" later
+# in find_deferred_emails, or "skip" not at all.
+enrich_mode = contextvars.ContextVar("enrich_mode", default="inline")
+
+# Whether parsers should get course ids even when the count doesn't need them.
+find_course_ids = contextvars.ContextVar("find_course_ids", default=True)
+
+def get_state(obj):
+    """Pickle an attrs object as a dict of its fields, leaving out the defaults."""
+    state = {}
+    for field in attr.fields(obj.__class__):
+        value = getattr(obj, field.name)
+        default = field.default
+        if isinstance(default, attr.Factory):
+            default = default.factory()
+        if value is not default and (type(value) is not type(default) or value != default):
+            state[field.name] = value
+    return state
+
+def set_state_with_defaults(obj, state):
+    """Unpickle an attrs object, giving defaults to fields added since it was pickled."""
+    for field in attr.fields(obj.__class__):
+        if field.name in state:
+            value = state[field.name]
+        else:
+            value = field.default
+            if isinstance(value, attr.Factory):
+                value = value.factory()
+        setattr(obj, field.name, value)
+
+
+# The sites and attempts are slotted to keep them small, and pickled as dicts
+# so that fields can be added without breaking older state files.
+
+@attr.s(slots=True, getstate_setstate=False)
 class Attempt:
     """A use of a strategy on a site."""
     strategy = attr.ib(default="")
     courses = attr.ib(default=None)
     error = attr.ib(default=None)
+    # The category of the error: see ScrapeFail.kind and session.error_kind.
+    error_kind = attr.ib(default=None)
 
+    ## What the attempt cost:
+    requests = attr.ib(default=0)
+    bytes = attr.ib(default=0)
+    # Seconds from start to finish, including waiting for other tasks.
+    wall_time = attr.ib(default=0.0)
+    # Seconds of wall_time spent waiting for a turn to make a request.
+    wait_time = attr.ib(default=0.0)
+    # Seconds of CPU used by this attempt alone.
+    cpu_time = attr.ib(default=0.0)
 
+    __getstate__ = get_state
 
-@attr.s(cmp=False, frozen=False)
+    def __setstate__(self, state):
+        set_state_with_defaults(self, state)
+
+
+
+@attr.s(cmp=False, frozen=False, slots=True, getstate_setstate=False)
 class Site:
     ## Stuff from the known sites csv:
     url = attr.ib(type=str)
@@ -30,20 +85,32 @@ class Site:
     ## Stuff that we scrape:
     current_courses = attr.ib(default=None)
     is_gone_now = attr.ib(default=False)
+    # Why the site is gone, if a probe found out: (reason, detail).
+    gone_reason = attr.ib(default=None)
     # Is there any indication at all that this is an open edx site? For use
     # when there are no courses.
     is_openedx = attr.ib(default=False)
 
-    # Maps course-ids to number of instances of the course
+    # Maps course-id numbers in `course_id_table` to number of instances of
+    # the course.  Use add_course_id to add them.
     course_ids = attr.ib(factory=collections.Counter)
+    course_id_table = attr.ib(default=COURSE_IDS, repr=False)
 
     # List of Attempt's
     tried = attr.ib(factory=list)
+    # List of Attempt's of the enrichers, once the site is counted.
+    enrichments = attr.ib(factory=list)
 
     ssl_err = attr.ib(default=False)
     custom_parser_err = attr.ib(default=False)
     time = attr.ib(default=None)
     fingerprint = attr.ib(default="")
+    # SimHash of the last fingerprinted page, to find near-duplicates.
+    simhash = attr.ib(default=None)
+    # That page, until finish_pages computes its SimHash.
+    _simhash_text = attr.ib(default=None, init=False, repr=False, cmp=False)
+    # Compressed texts to look for emails in, for find_deferred_emails.
+    _email_texts = attr.ib(factory=list, init=False, repr=False, cmp=False)
     version = attr.ib(default=None)
     tags = attr.ib(factory=set)
 
@@ -51,12 +118,37 @@ class Site:
     emails = attr.ib(factory=list)
     other_info = attr.ib(factory=list)
 
+    # The texts given to process_text, if they were archived, so that they can
+    # be processed again: (digest, fingerprint, type, emails).
+    pages = attr.ib(factory=list, repr=False)
+
+    # The url of the site this one redirects to, if we used its results.
+    alias_of = attr.ib(default=None)
+
     def __eq__(self, other):
         return self.url == other.url
 
     def __hash__(self):
         return hash(self.url)
 
+    def __getstate__(self):
+        state = get_state(self)
+        state.pop("_email_texts", None)
+        # Always include the table: states without it are from before course
+        # ids were interned.
+        state["course_id_table"] = self.course_id_table
+        return state
+
+    def __setstate__(self, state):
+        set_state_with_defaults(self, state)
+        if "course_id_table" not in state:
+            # Written before course ids were interned: course_ids has strings.
+            course_ids = self.course_ids
+            self.course_id_table = COURSE_IDS
+            self.course_ids = collections.Counter()
+            for course_id, count in course_ids.items():
+                self.course_ids[COURSE_IDS.intern(course_id)] += count
+
     @classmethod
     def from_csv_row(cls, url, course_count, is_gone, **ignored):
         return cls(url, course_count, is_gone=='True')
@@ -82,14 +174,20 @@ class Site:
         """
         Text retrieved from the site, processed for a few things.
         """
+        archive = current_archive.get()
+        if archive is not None:
+            self.pages.append((archive.add(text), fingerprint, type, emails))
         if fingerprint:
             # Remove noise from the fingerprint.
             lines = text.splitlines(keepends=True)
             lines = [l for l in lines if not any(frag in l for frag in self.IGNORE_LINE_FRAGMENTS)]
-            for pat, repl in self.REMOVABLE_NOISE:
-                lines = [re.sub(pat, repl, l) for l in lines]
-            lines.append(self.fingerprint.encode('ascii'))
             text = b''.join(lines)
+            # None of the noise spans lines, so it can be removed all at once.
+            for pat, repl in self.REMOVABLE_NOISE:
+                text = re.sub(pat, repl, text)
+            if type == "html":
+                self._simhash_text = text
+            text += self.fingerprint.encode('ascii')
             self.fingerprint = calc_fingerprint(text)
         if type == "html":
             version = sniff_version(text)
@@ -97,7 +195,46 @@ class Site:
                 self.version = version
             self.tags.update(sniff_tags(self.url, text))
         if emails:
-            self.emails.extend(emails_in_text(text))
+            mode = enrich_mode.get()
+            if mode == "inline":
+                self.emails.extend(emails_in_text(text))
+            elif mode == "deferred":
+                # Compressing is much quicker than looking for emails.
+                self._email_texts.append(zlib.compress(text, 1))
+
+    def find_deferred_emails(self):
+        """Look for emails in the texts process_text kept for later."""
+        for data in self._email_texts:
+            self.emails.extend(emails_in_text(zlib.decompress(data)))
+        self._email_texts = []
+
+    def finish_pages(self):
+        """Compute what only needs doing once all the pages are processed."""
+        if self._simhash_text is not None:
+            self.simhash = calc_simhash(self._simhash_text)
+            self._simhash_text = None
+
+    # What an alias gets from the site it's an alias of.
+    ALIAS_FIELDS = [
+        "current_courses", "is_gone_now", "is_openedx", "course_ids", "course_id_table", "ssl_err",
+        "fingerprint", "simhash", "version", "tags", "emails",
+    ]
+
+    def copy_results_from(self, other):
+        """Make this site an alias of `other`, with the same results."""
+        self.alias_of = other.url
+        self._simhash_text = None
+        self._email_texts = []
+        for name in self.ALIAS_FIELDS:
+            value = getattr(other, name)
+            if isinstance(value, (list, set, dict)):
+                value = copy.copy(value)
+            setattr(self, name, value)
+        if hostname(other.url) != hostname(self.url):
+            self.other_info.append(hostname(other.url))
+
+    def add_course_id(self, course_id):
+        self.course_ids[self.course_id_table.intern(course_id)] += 1
 
     def got_response(self, url, response):
         actual_host = hostname(str(response.url))
@@ -144,16 +281,20 @@ class Site:
         return max((attempt.courses for attempt in self.tried if attempt.courses is not None), default=None)
 
 
-@attr.s()
+@attr.s(slots=True)
 class HashedSite:
     fingerprint = attr.ib(default=None)
     sites = attr.ib(default=attr.Factory(list))
     version = attr.ib(default=None)
     is_new = attr.ib(default=False)
+    _best_url = attr.ib(default=None, init=False, repr=False, cmp=False)
 
     def current_courses(self):
         return self.sites[0].current_courses
 
+    def simhash(self):
+        return next((site.simhash for site in self.sites if site.simhash is not None), None)
+
     def all_chaff(self):
         return all(is_chaff_domain(domain_from_url(site.url)) for site in self.sites)
 
@@ -170,6 +311,11 @@ class HashedSite:
         return set(inf for site in self.sites for inf in site.other_info)
 
     def best_url(self):
+        if self._best_url is None:
+            self._best_url = self._find_best_url()
+        return self._best_url
+
+    def _find_best_url(self):
         site_urls = [site.url for site in self.sites]
         non_chaff = [url for url in site_urls if not is_chaff_domain(domain_from_url(url))]
         urls = non_chaff or site_urls
@@ -179,12 +325,8 @@ class HashedSite:
 
 def non_sub_urls(urls):
     """Return urls that are not subdomains of other urls."""
-    domain_parts = [domain_from_url(u).split(".") for u in urls]
-    def is_prefix(dp1, dp2):
-        return dp1 != dp2 and dp2[len(dp2)-len(dp1):] == dp1
-    non_sub_doms = [".".join(d) for d in domain_parts if not any(is_prefix(d2, d) for d2 in domain_parts)]
-    non_subs = [u for u in urls if domain_from_url(u) in non_sub_doms]
-    return non_subs
+    domains = DomainIndex(domain_from_url(u) for u in urls)
+    return [u for u in urls if not domains.has_parent(domain_from_url(u))]
 
 
 def clean_url(url):
@@ -202,8 +344,8 @@ def read_sites_csv(csv_file):
 
 def read_sites_flat(flat_file):
     with open(flat_file) as f:
-        sites = [Site.from_url(url) for url in f]
-    return sites
+        for url in f:
+            yield Site.from_url(url)
 
 def totals(sites):
     old = new = 0
@@ -230,15 +372,16 @@ def courses_and_orgs(sites):
     all_orgs = collections.defaultdict(set)
     all_course_ids = set()
     for site in sites:
-        for course_id, num in site.course_ids.items():
+        table = site.course_id_table
+        for num in site.course_ids:
+            course_id = table[num]
             all_course_ids.add(course_id)
-            try:
-                key = opaque_keys.edx.keys.CourseKey.from_string(course_id)
+            key = table.parse(num)
+            if key.valid:
                 all_orgs[key.org].add(site)
-            except opaque_keys.InvalidKeyError:
-                course = course_id
-            else:
                 course = f"{key.org}+{key.course}"
+            else:
+                course = course_id
             all_courses[course].add(site)
     return all_courses, all_orgs, all_course_ids
 
@@ -256,33 +399,47 @@ def overcount(all_courses):
 
     Returns: an integer, the overcount.
     """
+    true_dups, reorged = overcount_details(all_courses)
+    return true_dups + sum(sum(orgs.values()) for orgs in reorged.values())
+
+
+def overcount_details(all_courses):
+    """Compute the pieces of the overcount.
+
+    `all_courses` is a dict mapping course_ids to a set of sites running that
+    course.
+
+    Returns: (true_dups, reorged).  `true_dups` is an integer. `reorged` maps
+    each syndicator onto a dict of {org: number of the syndicator's courses
+    that org re-labelled}.
+    """
     # If a course is run by 5 sites, then 4 go into the overcount.
     true_dups = sum(len(s) - 1 for s in all_courses.values())
 
     # A trickier case: some sites re-label courses with a new organization.
-    # This happens with Microsoft courses a lot.
-    reorged = 0
-    org_courses = [tuple(id.split("+")) for id in all_courses.keys()]
-    org_courses = [t for t in org_courses if len(t) == 2]
+    # This happens with Microsoft courses a lot.  Index the orgs running each
+    # course number, so each syndicator only looks at its own courses.
+    course_orgs = collections.defaultdict(list)
+    syn_courses = {syn_org: [] for syn_org in SYNDICATORS}
+    for id in all_courses:
+        org_course = id.split("+")
+        if len(org_course) != 2:
+            continue
+        org, course = org_course
+        course_orgs[course].append(org)
+        if org in syn_courses and len(course) > 3 and course[0].isalpha():
+            syn_courses[org].append(course)
+
+    reorged = {}
     for syn_org in SYNDICATORS:
-        syn_courses = {
-            course for org, course in org_courses
-            if org == syn_org and len(course) > 3 and course[0].isalpha()
-            }
-        other_orgs = collections.defaultdict(set)
-        for org, course in org_courses:
-            if org == syn_org:
-                continue
-            if course in syn_courses:
-                other_orgs[org].add(course)
-
-        # orgs maps organizations onto a set of the syndicator's course ids
-        # they run.  Just a course id isn't unique enough ("CS100"), so we
-        # look for orgs with 3 or more of those course ids.
-        for org, courses in other_orgs.items():
-            if len(courses) < 3:
-                continue
-            #print(f"Org {org} has {len(courses)} in common with {syn_org}")
-            reorged += len(courses)
-
-    return true_dups + reorged
+        # other_orgs maps organizations onto the number of the syndicator's
+        # course ids they run.
+        other_orgs = collections.Counter()
+        for course in syn_courses[syn_org]:
+            other_orgs.update(org for org in course_orgs[course] if org != syn_org)
+
+        # Just a course id isn't unique enough ("CS100"), so we look for orgs
+        # with 3 or more of those course ids.
+        reorged[syn_org] = {org: n for org, n in other_orgs.items() if n >= 3}
+
+    return true_dups, reorged
@@ -0,0 +1,62 @@
+import json
+import os
+import types
+
+from census.archive import Archive, ArchiveReader, INDEX_NAME, current_archive, page_digest
+from census.reanalyze import reanalyze_sites
+from census.sites import Site
+
+def response(url, status=200):
+    return types.SimpleNamespace(url=url, method="GET", status=status, content_type="text/html")
+
+def test_duplicate_pages_are_stored_once(tmp_path):
+    theme = b"<html>The same theme everywhere</html>" * 100
+    archive = Archive(str(tmp_path))
+    archive.save("http://one.com", theme, response("http://one.com"))
+    archive.save("http://two.com", theme, response("https://two.com/home"))
+    archive.save("http://three.com", b"<html>Different</html>", response("http://three.com"))
+    archive.close()
+
+    with open(os.path.join(tmp_path, INDEX_NAME)) as f:
+        records = [json.loads(line) for line in f]
+    assert [r["url"] for r in records] == ["http://one.com", "http://two.com", "http://three.com"]
+    assert records[1]["final_url"] == "https://two.com/home"
+    assert records[0]["digest"] == records[1]["digest"] == page_digest(theme)
+    assert records[0]["offset"] == records[1]["offset"]
+    assert ArchiveReader(str(tmp_path)).read(records[1]["digest"]) == theme
+
+    # A new archive in the same place picks up where the last one left off.
+    archive = Archive(str(tmp_path))
+    archive.save("http://four.com", theme, response("http://four.com"))
+    archive.save("http://five.com", b"Five", response("http://five.com"))
+    archive.close()
+    assert len(os.listdir(tmp_path)) == 2
+    reader = ArchiveReader(str(tmp_path))
+    assert reader.read(page_digest(theme)) == theme
+    assert reader.read(page_digest(b"Five")) == b"Five"
+
+def test_reanalyze(tmp_path):
+    page = b'<html><a class="nav-skip" href="#main">Hi</a> Write to us@hello.com</html>'
+    archive = Archive(str(tmp_path))
+    token = current_archive.set(archive)
+    try:
+        site = Site.from_url("http://hello.com")
+        site.process_text(page)
+        site.process_text(b'{"total": 17}', type="json", emails=False)
+    finally:
+        current_archive.reset(token)
+    archive.close()
+    assert site.version == "eucalytpus"
+    fingerprint = site.fingerprint
+
+    # Pretend the scrape happened with older code.
+    site.fingerprint = "old"
+    site.version = None
+    site.emails = []
+    unsaved = Site.from_url("http://unsaved.com")
+    done, changed = reanalyze_sites([site, unsaved], str(tmp_path))
+    assert done == [site]
+    assert changed == 1
+    assert site.fingerprint == fingerprint
+    assert site.version == "eucalytpus"
+    assert site.emails == ["us@hello.com"]
@@ -0,0 +1,320 @@
+import asyncio
+import io
+import pickle
+
+import aiohttp
+import aiohttp.web
+import click
+import click.testing
+import pytest
+
+import census.census
+from census.census import enrich, in_pool, parse_html_spec, parse_site, report, show_text_report
+from census.course_ids import CourseIdTable
+from census.origins import OriginClaims, OriginMap
+from census.parsers import course_api
+from census.session import SessionFactory
+from census.report_helpers import ReportData, strategy_stats
+from census.sites import Site, enrich_mode
+
+
+async def serve(app):
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+def use_parsers(monkeypatch, *parsers):
+    """Make every site use only `parsers`."""
+    monkeypatch.setattr(census.census, "find_site_functions", lambda url: [(p, (), {}, False) for p in parsers])
+
+
+async def count_slowly(site, session):
+    await session.text_from_url(site.url)
+    await asyncio.sleep(0.2)
+    return 17
+
+async def scrape_owner_and_alias():
+    """Scrape a site, and a little later, another site that redirects to it."""
+    async def hello(request):
+        return aiohttp.web.Response(text="Hello")
+    app = aiohttp.web.Application()
+    app.router.add_get("/", hello)
+    runner, origin = await serve(app)
+
+    async def redirect(request):
+        raise aiohttp.web.HTTPFound(origin + request.path_qs)
+    alias_app = aiohttp.web.Application()
+    alias_app.router.add_get("/{path:.*}", redirect)
+    alias_runner, alias_origin = await serve(alias_app)
+
+    factory = SessionFactory(origins=OriginMap())
+    claims = OriginClaims()
+    owner, alias = Site.from_url(origin), Site.from_url(alias_origin)
+    try:
+        owner_task = asyncio.ensure_future(parse_site(owner, factory, claims=claims, enrich=False))
+        await asyncio.sleep(0.05)
+        chars = [await parse_site(alias, factory, claims=claims, enrich=False), await owner_task]
+    finally:
+        await runner.cleanup()
+        await alias_runner.cleanup()
+    return owner, alias, chars
+
+def test_aliases_wait_for_their_owner(monkeypatch):
+    use_parsers(monkeypatch, count_slowly)
+    owner, alias, chars = asyncio.run(scrape_owner_and_alias())
+    assert chars == ["+", "+"]
+    assert owner.current_courses == alias.current_courses == 17
+    assert alias.alias_of == owner.url
+    # Each site made one request: the alias found where it went from its
+    # first parser's first response, and stopped there.
+    assert [(a.requests, a.error_kind) for a in owner.tried] == [(1, None)]
+    assert [(a.requests, a.error_kind) for a in alias.tried] == [(1, "alias")]
+
+def test_error_responses_find_the_owner(monkeypatch):
+    async def missing(site, session):
+        await session.text_from_url(site.url + "/missing")
+    use_parsers(monkeypatch, missing, count_slowly)
+    owner, alias, chars = asyncio.run(scrape_owner_and_alias())
+    assert chars == ["+", "+"]
+    assert alias.current_courses == 17
+    assert [(a.requests, a.error_kind) for a in owner.tried] == [(1, "http"), (1, None)]
+    assert [(a.requests, a.error_kind) for a in alias.tried] == [(1, "alias")]
+
+def test_conclusive_parsers_stop_the_others(monkeypatch):
+    async def tiles(site, session):
+        return 99
+    use_parsers(monkeypatch, course_api, tiles)
+
+    async def api(request):
+        data = {"results": [{"id": "course-v1:A+1+2024"}], "pagination": {"count": 1, "next": None}}
+        return aiohttp.web.json_response(data)
+
+    async def home(request):
+        return aiohttp.web.Response(text="<html>Home</html>", content_type="text/html")
+
+    async def scrape():
+        app = aiohttp.web.Application()
+        app.router.add_get("/api/courses/v1/courses/", api)
+        app.router.add_get("/", home)
+        runner, origin = await serve(app)
+        site = Site.from_url(origin)
+        try:
+            char = await parse_site(site, SessionFactory(), enrich=False)
+        finally:
+            await runner.cleanup()
+        return site, char
+
+    site, char = asyncio.run(scrape())
+    assert char == "+"
+    assert site.current_courses == 1
+    assert [attempt.strategy for attempt in site.tried] == ["course_api"]
+
+def hello_app():
+    async def hello(request):
+        return aiohttp.web.Response(text="Hello")
+    app = aiohttp.web.Application()
+    app.router.add_get("/", hello)
+    return app
+
+async def hang(site, session):
+    await asyncio.sleep(60)
+
+def test_site_timeout_stops_a_hung_parser(monkeypatch):
+    use_parsers(monkeypatch, hang)
+    site = Site.from_url("https://example.com")
+    char = asyncio.run(parse_site(site, SessionFactory(), site_timeout=0.1, enrich=False))
+    assert char == "T"
+    assert site.current_courses is None
+    assert site.tried[0].error_kind == "site_timeout"
+
+def test_site_timeout_keeps_the_count(monkeypatch):
+    async def count(site, session):
+        return 12
+    use_parsers(monkeypatch, count, hang)
+    site = Site.from_url("https://example.com")
+    char = asyncio.run(parse_site(site, SessionFactory(), site_timeout=0.1, enrich=False))
+    assert char == "T"
+    assert site.current_courses == 12
+    assert [attempt.courses for attempt in site.tried] == [12, None]
+    assert site.tried[1].error_kind == "site_timeout"
+
+def test_site_timeout_leaves_out_waiting_for_a_request(monkeypatch):
+    async def fetch(site, session):
+        await session.text_from_url(site.url)
+        return 8
+    use_parsers(monkeypatch, fetch)
+
+    async def scrape():
+        runner, origin = await serve(hello_app())
+        factory = SessionFactory(max_requests=1)
+        site = Site.from_url(origin)
+        try:
+            # Another site has the only request slot for longer than our time limit.
+            await factory.sem.acquire()
+            asyncio.get_running_loop().call_later(0.3, factory.sem.release)
+            char = await parse_site(site, factory, site_timeout=0.2, enrich=False)
+        finally:
+            await runner.cleanup()
+        return char, site
+
+    char, site = asyncio.run(scrape())
+    assert char == "+"
+    assert site.current_courses == 8
+    assert site.tried[0].wait_time >= 0.25
+
+def test_site_timeout_while_waiting_for_owner(monkeypatch):
+    async def count_slowly(site, session):
+        await asyncio.sleep(0.5)
+        return 17
+    use_parsers(monkeypatch, count_slowly)
+
+    async def scrape():
+        runner, origin = await serve(hello_app())
+        factory = SessionFactory(origins=OriginMap())
+        claims = OriginClaims()
+        owner, alias = Site.from_url(origin), Site.from_url(origin + "/")
+        try:
+            owner_task = asyncio.ensure_future(parse_site(owner, factory, claims=claims, enrich=False))
+            await asyncio.sleep(0.05)
+            alias_char = await parse_site(alias, factory, claims=claims, site_timeout=0.1, enrich=False)
+            owner_char = await owner_task
+        finally:
+            await runner.cleanup()
+        return owner, alias, alias_char, owner_char
+
+    owner, alias, alias_char, owner_char = asyncio.run(scrape())
+    assert alias_char == "T"
+    assert alias.current_courses is None
+    assert alias.alias_of is None
+    # The owner isn't bothered by its alias giving up.
+    assert owner_char == "+"
+    assert owner.current_courses == 17
+
+def test_in_pool_takes_items_as_needed():
+    taken = []
+    done = []
+
+    def items():
+        for i in range(100):
+            taken.append(i)
+            yield i
+
+    async def run():
+        release = asyncio.Event()
+
+        async def work(item):
+            await release.wait()
+            done.append(item)
+
+        pool = asyncio.ensure_future(in_pool(items(), work, 3))
+        await asyncio.sleep(0.01)
+        # Three workers busy, three items queued, one waiting to be queued.
+        assert len(taken) <= 7
+        release.set()
+        await pool
+
+    asyncio.run(run())
+    assert sorted(done) == list(range(100))
+
+def test_in_pool_with_more_workers_than_items():
+    done = []
+
+    async def work(item):
+        done.append(item)
+
+    asyncio.run(in_pool(iter([1, 2]), work, 5))
+    assert sorted(done) == [1, 2]
+
+
+def test_deferred_enrichment():
+    async def contact(request):
+        return aiohttp.web.Response(text="Mail help@contact.com")
+
+    async def run():
+        app = aiohttp.web.Application()
+        app.router.add_get("/contact", contact)
+        runner, origin = await serve(app)
+        # No contact page here.
+        other_runner, other_origin = await serve(aiohttp.web.Application())
+
+        owner, other = Site.from_url(origin), Site.from_url(other_origin)
+        alias, uncounted = Site.from_url("http://alias.com"), Site.from_url("http://uncounted.com")
+        token = enrich_mode.set("deferred")
+        try:
+            owner.process_text(b"<html>Write to us@home.com</html>")
+        finally:
+            enrich_mode.reset(token)
+        owner.current_courses = other.current_courses = alias.current_courses = 5
+        alias.alias_of = owner.url
+        sites = [owner, other, alias, uncounted]
+        try:
+            await enrich(sites, {}, site_timeout=5)
+        finally:
+            await runner.cleanup()
+            await other_runner.cleanup()
+        return sites
+
+    owner, other, alias, uncounted = asyncio.run(run())
+    assert sorted(owner.emails) == ["help@contact.com", "us@home.com"]
+    assert alias.emails == owner.emails
+    assert alias.enrichments == uncounted.enrichments == []
+    [attempt] = owner.enrichments
+    assert attempt.strategy == "contact_page"
+    assert attempt.error is None
+    assert attempt.requests == 1 and attempt.bytes > 0
+    [attempt] = other.enrichments
+    assert attempt.error_kind == "http"
+    stats = {st.name: st for st in strategy_stats([owner, other, alias, uncounted])}
+    assert (stats["contact_page"].tried, stats["contact_page"].succeeded) == (2, 1)
+    assert stats["contact_page"].requests == 2
+
+def test_text_report_shows_the_overcount():
+    table = CourseIdTable()
+    one, two = Site.from_url("https://one.com"), Site.from_url("https://two.com")
+    for site in [one, two]:
+        site.course_id_table = table
+        site.current_courses = 4
+    for num in ["DAT101x", "DAT102x", "DAT103x"]:
+        one.add_course_id(f"course-v1:Microsoft+{num}+2T2020")
+        two.add_course_id(f"course-v1:Contoso+{num}+2T2020")
+    one.add_course_id("course-v1:MITx+6.00x+2T2020")
+    two.add_course_id("course-v1:MITx+6.00x+3T2020")
+    out = io.StringIO()
+    show_text_report(ReportData([one, two]), out)
+    lines = out.getvalue().splitlines()
+    assert lines[1:4] == [
+        "Overcount: 4",
+        "    1 from courses run by more than one site",
+        "    3 from Microsoft courses re-labelled by Contoso",
+    ]
+
+def test_parse_html_spec():
+    assert parse_html_spec("html/sites.html") == ("html/sites.html", {
+        "skip_none": False, "only_new": False, "full": False, "sharded": False, "cluster": False,
+    })
+    assert parse_html_spec("html/full.html:full,skip-none") == ("html/full.html", {
+        "skip_none": True, "only_new": False, "full": True, "sharded": False, "cluster": False,
+    })
+    with pytest.raises(click.BadParameter, match="Unknown HTML option 'fast'"):
+        parse_html_spec("html/sites.html:full,fast")
+
+def test_report_writes_each_file(tmp_path, monkeypatch):
+    one, two = Site.from_url("https://one.com"), Site.from_url("https://two.com")
+    one.latest_courses, one.current_courses = 5, 7
+    two.latest_courses = 3
+    one.emails.append("us@one.com")
+    with open(tmp_path / "sites.pickle", "wb") as f:
+        pickle.dump([one, two], f)
+    monkeypatch.chdir(tmp_path)
+
+    # Two jobs, so the reports are written by forked processes.
+    result = click.testing.CliRunner().invoke(
+        report, ["--in", "sites.pickle", "--text", "sites.txt", "--emails", "emails.txt", "--jobs", "2"],
+    )
+    assert result.exit_code == 0, result.output
+    text = (tmp_path / "sites.txt").read_text().splitlines()
+    assert text[0] == "Found courses went from 8 to 10"
+    assert "https://one.com: 5 --> 7 ()" in text
+    assert (tmp_path / "emails.txt").read_text() == "us@one.com\n"
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+import census.report_helpers
+from census.domains import DomainIndex
+from census.report_helpers import get_known_domains
+from census.sites import non_sub_urls
+
+@pytest.fixture
+def index():
+    return DomainIndex(["example.com", "courses.edx.org", "learn.example.com"])
+
+def test_contains(index):
+    assert len(index) == 3
+    assert "example.com" in index
+    assert "courses.edx.org" in index
+    assert "edx.org" not in index
+    assert "com" not in index
+    assert "other.example.com" not in index
+
+@pytest.mark.parametrize("domain, known", [
+    ("example.com", True),
+    ("www.example.com", True),
+    ("www.courses.edx.org", True),
+    ("edx.org", False),
+    ("wwwexample.com", False),
+])
+def test_is_known(index, domain, known):
+    assert index.is_known(domain) == known
+
+@pytest.mark.parametrize("domain, has_parent", [
+    ("example.com", False),
+    ("learn.example.com", True),
+    ("a.b.learn.example.com", True),
+    ("courses.edx.org", False),
+    ("x.courses.edx.org", True),
+    ("xexample.com", False),
+])
+def test_has_parent(index, domain, has_parent):
+    assert index.has_parent(domain) == has_parent
+
+def test_empty_labels_are_ignored(index):
+    index.add("")
+    index.add("edx.org.")
+    assert len(index) == 4
+    assert "" not in index
+    assert "edx.org" in index
+    assert "example.com." in index
+    assert not index.has_parent("other.com")
+    assert index.has_parent("x.edx.org")
+    assert index.has_parent("x.example.com.")
+
+def test_iterating(index):
+    assert sorted(index) == ["courses.edx.org", "example.com", "learn.example.com"]
+
+def test_known_domains_cache(tmp_path, monkeypatch):
+    sites_csv = tmp_path / "sites.csv"
+    sites_csv.write_text("url,course_count,is_gone\nhttps://example.com,3,False\n")
+    aliases_txt = tmp_path / "aliases.txt"
+    aliases_txt.write_text("https://other.org\n")
+    cache = tmp_path / "known_domains.json"
+    monkeypatch.setattr(census.report_helpers, "SITES_CSV", str(sites_csv))
+    monkeypatch.setattr(census.report_helpers, "ALIASES_TXT", str(aliases_txt))
+    monkeypatch.setattr(census.report_helpers, "DOMAINS_CACHE", str(cache))
+
+    assert sorted(get_known_domains()) == ["example.com", "other.org"]
+    cached = json.loads(cache.read_text())
+    assert cached["domains"] == ["example.com", "other.org"]
+    # The cache is used when it matches.
+    cached["domains"].append("cached.com")
+    cache.write_text(json.dumps(cached))
+    assert "cached.com" in get_known_domains()
+    # A cache from another version of DomainIndex isn't.
+    cached["key"]["version"] -= 1
+    cache.write_text(json.dumps(cached))
+    assert "cached.com" not in get_known_domains()
+    # Nor is one we can't read.
+    cache.write_bytes(b"\x80\x04garbage")
+    assert sorted(get_known_domains()) == ["example.com", "other.org"]
+
+def test_non_sub_urls():
+    urls = [
+        "https://learn.example.com",
+        "https://example.com",
+        "http://other.org",
+        "https://a.b.other.org",
+        "https://edx.org",
+    ]
+    assert non_sub_urls(urls) == ["https://example.com", "http://other.org", "https://edx.org"]
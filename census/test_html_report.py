@@ -0,0 +1,73 @@
+import io
+import json
+import re
+
+import census.report_helpers
+from census.domains import DomainIndex
+from census.html_report import fragment_name, html_report, write_site
+from census.html_writer import HtmlOutlineWriter
+from census.report_helpers import ReportData
+from census.sites import Attempt, Site
+
+
+def read_fragment(fragment_dir, name):
+    """Get the HTML in a fragment file."""
+    text = (fragment_dir / f"{name}.js").read_text()
+    m = re.fullmatch(r"censusFragment\((.*?), (.*)\);\n", text)
+    assert json.loads(m[1]) == name
+    return json.loads(m[2])
+
+def test_one_line_errors_are_escaped():
+    site = Site.from_url("https://one.com")
+    site.tried.append(Attempt("course_api", error="ValueError: <b>bad</b> & worse\n"))
+    out = io.StringIO()
+    write_site(site, HtmlOutlineWriter(out), DomainIndex())
+    assert "<p>course_api: ValueError: &lt;b&gt;bad&lt;/b&gt; &amp; worse</p>" in out.getvalue()
+
+def test_fragments(tmp_path):
+    fragment_dir = tmp_path / "sites_files"
+    fragment_dir.mkdir()
+    (fragment_dir / "stale.js").write_text("censusFragment('stale', '');\n")
+    out = io.StringIO()
+    writer = HtmlOutlineWriter(out, fragment_dir=str(fragment_dir))
+    assert writer.start_section("Outer", fragment="outer")
+    writer.write("<p>outer text</p>")
+    assert writer.start_section("Plain")
+    writer.write("<p>plain text</p>")
+    writer.end_section()
+    assert writer.start_section("Inner", fragment="inner")
+    writer.write("<p>inner text</p>")
+    writer.end_section()
+    writer.end_section()
+    # The inner fragment is already written: the section refers to it.
+    assert not writer.start_section("Again", fragment="inner")
+    writer.end_section()
+
+    assert sorted(p.name for p in fragment_dir.iterdir()) == ["inner.js", "outer.js"]
+    html = out.getvalue()
+    assert html.count('data-fragment="inner"') == 1
+    assert 'data-fragment="outer"' in html
+    assert "text</p>" not in html
+    outer = read_fragment(fragment_dir, "outer")
+    assert "<p>outer text</p>" in outer and "<p>plain text</p>" in outer
+    assert 'data-fragment="inner"' in outer and "inner text" not in outer
+    assert read_fragment(fragment_dir, "inner") == "<p>inner text</p>"
+
+def test_sharded_report_writes_each_site_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(census.report_helpers, "get_known_domains", DomainIndex)
+    one, two = Site.from_url("https://one.com"), Site.from_url("https://two.com")
+    one.latest_courses, one.current_courses = 5, 7
+    two.current_courses = 3
+    fragment_dir = tmp_path / "sites_files"
+    out = io.StringIO()
+    html_report(out, ReportData([one, two]), fragment_dir=str(fragment_dir))
+
+    site_fragments = {fragment_name("site", site.url) + ".js" for site in [one, two]}
+    written = {p.name for p in fragment_dir.iterdir()}
+    assert site_fragments <= written
+    assert {"sites.js", "versions.js", "tags.js", "hashed.js"} <= written
+    # A site is shown in the sites list and its hashed site, but written once.
+    one_ref = f'data-fragment="{fragment_name("site", one.url)}"'
+    assert sum(one_ref in read_fragment(fragment_dir, name[:-3]) for name in written) == 2
+    assert "https://one.com" in read_fragment(fragment_dir, "sites")
+    assert "https://one.com" not in out.getvalue()
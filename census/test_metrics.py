@@ -0,0 +1,61 @@
+import asyncio
+
+import aiohttp
+
+from census.metrics import Metrics, metrics, serve_metrics
+from census.origins import OriginMap
+
+
+def test_render():
+    m = Metrics()
+    m.sites_started = 3
+    m.requests = 10
+    m.outcomes["+"] += 2
+    m.errors["timeout"] += 1
+    m.cache_lookup("origins", True)
+    m.cache_lookup("origins", True)
+    m.cache_lookup("origins", False)
+    lines = m.render().splitlines()
+    assert "# TYPE census_sites_started_total counter" in lines
+    assert "census_sites_started_total 3" in lines
+    assert "census_sites_done 2" in lines
+    assert "census_requests_total 10" in lines
+    assert 'census_outcomes_total{outcome="+"} 2' in lines
+    assert 'census_errors_total{category="timeout"} 1' in lines
+    assert 'census_cache_hits_total{cache="origins"} 2' in lines
+    assert 'census_cache_misses_total{cache="origins"} 1' in lines
+    assert 'census_cache_hit_ratio{cache="origins"} 0.6667' in lines
+
+    m.reset()
+    lines = m.render().splitlines()
+    assert "census_sites_started_total 0" in lines
+    assert not any(line.startswith("census_cache_hits_total") for line in lines)
+
+def test_origin_lookups_are_counted(tmp_path):
+    metrics.reset()
+    origins = OriginMap(str(tmp_path / "origins.json"))
+    origins.rewrite("http://example.com/courses")
+    origins.learn("http://example.com", "https://example.com/")
+    origins.rewrite("http://example.com/courses")
+    origins.known_url("http://example.com")
+    origins.known_url("http://other.com")
+    assert metrics.cache_hits == {"origins": 1, "confirmed_origins": 1}
+    assert metrics.cache_misses == {"origins": 1, "confirmed_origins": 1}
+
+def test_serve_metrics():
+    async def fetch():
+        metrics.reset()
+        metrics.sites_started = 5
+        runner = await serve_metrics(0)
+        try:
+            host, port = runner.addresses[0][:2]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://{host}:{port}/metrics") as response:
+                    return response.status, response.content_type, await response.text()
+        finally:
+            await runner.cleanup()
+
+    status, content_type, text = asyncio.run(fetch())
+    assert status == 200
+    assert content_type == "text/plain"
+    assert "census_sites_started_total 5" in text.splitlines()
@@ -0,0 +1,38 @@
+import asyncio
+import time
+
+from census.monitor import LoopMonitor, install_callback_timer, uninstall_callback_timer, working_on
+from census.sites import Attempt
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_slow_callbacks_are_attributed():
+    attempt = Attempt("slow_parser")
+
+    async def blocker():
+        working_on.set(("https://slow.example.com", attempt))
+        await asyncio.sleep(0)
+        busy(0.05)
+
+    async def main(monitor):
+        install_callback_timer(monitor)
+        monitor.start()
+        try:
+            await asyncio.gather(blocker(), asyncio.sleep(0.01))
+        finally:
+            monitor.stop()
+            uninstall_callback_timer()
+
+    monitor = LoopMonitor(threshold=0.02)
+    asyncio.run(main(monitor))
+    assert len(monitor.slow) == 1
+    duration, work = monitor.slow[0]
+    assert duration >= 0.05
+    assert work == ("https://slow.example.com", attempt)
+    assert attempt.cpu_time >= 0.04
+    assert "slow_parser: 1" in monitor.summary()
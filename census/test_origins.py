@@ -0,0 +1,24 @@
+from census.origins import OriginClaims, OriginMap
+
+def test_learn_and_rewrite(tmp_path):
+    filename = str(tmp_path / "origins.json")
+    origins = OriginMap(filename)
+    origins.learn("http://Example.com", "https://example.com/")
+    origins.learn("http://other.com/courses", "https://sso.other.com/login?next=/courses")
+    assert origins.rewrite("http://example.com/courses?page=2") == "https://example.com/courses?page=2"
+    assert origins.rewrite("http://other.com/courses") == "http://other.com/courses"
+    assert origins.known_url("http://example.com") == "https://example.com/"
+    origins.save()
+
+    # A new run uses what was learned, but hasn't confirmed it yet.
+    origins = OriginMap(filename)
+    assert origins.rewrite("http://example.com/about") == "https://example.com/about"
+    assert origins.known_url("http://example.com") is None
+    origins.forget("http://example.com/about")
+    assert origins.rewrite("http://example.com/about") == "http://example.com/about"
+
+def test_claims():
+    claims = OriginClaims()
+    assert claims.claim("https://example.com", "site1", "done1") == ("site1", "done1")
+    assert claims.claim("https://example.com", "site2", "done2") == ("site1", "done1")
+    assert claims.claim("https://other.com", "site2", "done2") == ("site2", "done2")
@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import pytest
+
+from census.helpers import GotZero, HttpError
+from census.parsers import course_api
+from census.sites import Site, find_course_ids
+
+
+class CannedSession:
+    """A stand-in for SmartSession, with a canned text for each url."""
+    def __init__(self, pages):
+        self.pages = pages
+        self.urls = []
+
+    async def text_from_url(self, url, **kwargs):
+        self.urls.append(url)
+        if url not in self.pages:
+            raise HttpError(f"404 get {url}", kind="http", status=404, url=url)
+        return self.pages[url]
+
+def api_page(courses, count, next_url=None):
+    """A Course API page.  `courses` are ids, or dicts of course details."""
+    return json.dumps({
+        "results": [course if isinstance(course, dict) else {"id": course} for course in courses],
+        "pagination": {"count": count, "next": next_url},
+    }).encode("utf8")
+
+API = "https://example.com/api/courses/v1/courses/"
+FIRST_PAGE = API + "?active_only=true&page_size=100"
+
+def test_course_api_pages():
+    session = CannedSession({
+        FIRST_PAGE: api_page(["course-v1:A+1+2024", "course-v1:A+2+2024"], 3, API + "?active_only=true&page=2&page_size=100"),
+        API + "?active_only=true&page=2&page_size=100": api_page(["course-v1:A+3+2024"], 3),
+        "https://example.com": b"<html>Home</html>",
+    })
+    site = Site.from_url("https://example.com")
+    assert asyncio.run(course_api(site, session)) == 3
+    assert len(site.course_ids) == 3
+    assert site.fingerprint
+
+def test_course_api_counts_current_courses():
+    # An older site that ignores active_only, and lists every course.
+    session = CannedSession({
+        FIRST_PAGE: api_page([
+            {"id": "course-v1:A+1+2020", "start": "2020-01-01T00:00:00Z", "end": "2020-06-01T00:00:00Z"},
+            {"id": "course-v1:A+2+2024", "start": "2024-01-01T00:00:00Z", "end": None},
+            {"id": "course-v1:A+3+2999", "start": "2999-01-01T00:00:00Z", "end": "2999-06-01T00:00:00Z"},
+            {"id": "course-v1:A+4+2024", "start": "2024-01-01T00:00:00Z", "end": "2999-01-01T00:00:00Z"},
+        ], 4),
+    })
+    site = Site.from_url("https://example.com")
+    # An earlier parser already read a page for the fingerprint.
+    site.fingerprint = "abc123"
+
+    async def count():
+        find_course_ids.set(False)
+        return await course_api(site, session)
+
+    assert asyncio.run(count()) == 2
+    assert not site.course_ids
+    assert session.urls == [FIRST_PAGE]
+
+def test_course_api_no_current_courses():
+    session = CannedSession({
+        FIRST_PAGE: api_page([{"id": "course-v1:A+1+2020", "end": "2020-06-01T00:00:00Z"}], 1),
+    })
+    site = Site.from_url("https://example.com")
+    with pytest.raises(GotZero):
+        asyncio.run(course_api(site, session))
+
+def test_course_api_stops_when_pages_repeat():
+    page2 = API + "?active_only=true&page=2&page_size=100"
+    session = CannedSession({
+        FIRST_PAGE: api_page(["course-v1:A+1+2024"], 40, page2),
+        # Page 2 says the next page is page 2.
+        page2: api_page(["course-v1:A+2+2024"], 40, page2),
+    })
+    site = Site.from_url("https://example.com")
+    assert asyncio.run(course_api(site, session)) == 2
+    assert session.urls.count(page2) == 1
+
+def test_course_api_stops_when_nothing_is_new():
+    page2 = API + "?active_only=true&page=2&page_size=100"
+    page3 = API + "?active_only=true&page=3&page_size=100"
+    session = CannedSession({
+        FIRST_PAGE: api_page(["course-v1:A+1+2024"], 40, page2),
+        page2: api_page(["course-v1:A+1+2024"], 40, page3),
+    })
+    site = Site.from_url("https://example.com")
+    assert asyncio.run(course_api(site, session)) == 1
+    assert page3 not in session.urls
+
+@pytest.mark.parametrize("text", [b"<html>Not json</html>", b'{"results": [], "pagination": {}}', b"[]"])
+def test_course_api_not_there(text):
+    site = Site.from_url("https://example.com")
+    with pytest.raises(GotZero):
+        asyncio.run(course_api(site, CannedSession({FIRST_PAGE: text})))
+
+def test_course_api_missing():
+    site = Site.from_url("https://example.com")
+    with pytest.raises(HttpError):
+        asyncio.run(course_api(site, CannedSession({})))
@@ -0,0 +1,43 @@
+import asyncio
+
+import aiohttp
+import aiohttp.web
+
+from census.probe import probe_sites
+from census.sites import Site
+
+def test_probe_marks_dead_sites_gone():
+    # Nothing listens on port 1.
+    sites = [Site.from_url("http://127.0.0.1:1"), Site.from_url("http://127.0.0.1:1/other")]
+    live = asyncio.run(probe_sites(sites, timeout=5))
+    assert live == []
+    for site in sites:
+        assert site.is_gone_now
+        assert site.gone_reason[0] == "refused"
+
+def test_probe_passes_slow_sites_on():
+    async def slow(request):
+        await asyncio.sleep(1)
+        return aiohttp.web.Response(text="Finally")
+
+    async def probe():
+        app = aiohttp.web.Application()
+        app.router.add_route("HEAD", "/", slow)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        server = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+        await server.start()
+        port = server._server.sockets[0].getsockname()[1]
+        sites = [Site.from_url("http://127.0.0.1:1"), Site.from_url(f"http://127.0.0.1:{port}")]
+        try:
+            live = await probe_sites(sites, timeout=0.1)
+        finally:
+            await runner.cleanup()
+        return sites, live
+
+    (dead, slow_site), live = asyncio.run(probe())
+    # The slow site timed out, but that doesn't make it gone.
+    assert live == [slow_site]
+    assert dead.is_gone_now
+    assert not slow_site.is_gone_now
+    assert slow_site.gone_reason is None
@@ -0,0 +1,89 @@
+import datetime
+import os
+import re
+
+import pytest
+
+from census.refs import (
+    JunkMatcher, RefererHistory, clean_referers, months_ago, normalize_referer, read_junk_regex,
+    required_literal,
+)
+
+@pytest.mark.parametrize("line, host", [
+    (" example.com.\n", "example.com"),
+    ("Courses.Example.COM", "courses.example.com"),
+    ("https://example.com/courses/", "example.com"),
+    ("   \n", ""),
+])
+def test_normalize_referer(line, host):
+    assert normalize_referer(line) == host
+
+def test_clean_referers(tmp_path):
+    junk = tmp_path / "junk.regex"
+    junk.write_text("\\.amazonaws.com$\n[:*( ]\n^[a-z0-9-]+$\n")
+    lines = [
+        " domain\n",
+        "--------\n",
+        " courses.example.com.\n",
+        " ec2-1-2-3-4.compute.amazonaws.com.\n",
+        " example.com:8000\n",
+        " staging.example.com.\n",
+        " COURSES.example.com\n",
+        " learn.example.org\n",
+        "(3 rows)\n",
+    ]
+    junk_re = read_junk_regex(junk)
+    assert list(clean_referers(lines, junk_re)) == ["courses.example.com", "learn.example.org"]
+    assert "staging.example.com" in clean_referers(lines, junk_re, keep_chaff=True)
+
+@pytest.mark.parametrize("pattern, literal", [
+    (r"\.amazonaws.com$", ".amazonaws"),
+    (r"[:*( ]", ""),
+    (r"(discovery-|ecommerce-|preview-).*\.opencraft\.hosting$", ".opencraft.hosting"),
+    (r"sandbox|staging", ""),
+    (r"abc?\d+defg", "defg"),
+    (r"x{10}yz", "yz"),
+    (r"[]x]yzw", "yzw"),
+])
+def test_required_literal(pattern, literal):
+    assert required_literal(pattern) == literal
+
+def test_junk_matcher_matches_like_one_regex():
+    with open(os.path.join(os.path.dirname(__file__), "..", "junk-referers.regex")) as f:
+        patterns = f.read().splitlines()
+    matcher = JunkMatcher(patterns)
+    one_regex = re.compile("|".join(f"(?:{pat})" for pat in patterns))
+    hosts = [
+        "courses.example.com", "ec2-1-2.compute.amazonaws.com", "foo.google.co.uk",
+        "sandbox-foo.opencraft.hosting", "preview-x.opencraft.hosting", "abcde.club",
+        "a.abcde.club", "10.2.3.4", "localhost", "1-2-3.example.com", "learn.ovh.net",
+        "vps123.ovh.net", "example.com:8000",
+    ]
+    for host in hosts:
+        assert matcher.search(host) == bool(one_regex.search(host)), host
+
+def test_referer_history(tmp_path):
+    (tmp_path / "referers_20200101.txt").write_text("a.com\nb.com\n")
+    (tmp_path / "referers_20200301.txt").write_text("a.com\nb.com\nc.com\n")
+    history = RefererHistory(tmp_path)
+    history.update()
+    assert history.first_seen == {"a.com": "20200101", "b.com": "20200101", "c.com": "20200301"}
+
+    # A new snapshot is read, and the index is re-used.
+    (tmp_path / "referers_20200501.txt").write_text("c.com\nd.com\n")
+    history = RefererHistory(tmp_path)
+    assert history.snapshots == ["referers_20200101.txt", "referers_20200301.txt"]
+    history.update()
+    assert history.first_seen["d.com"] == "20200501"
+
+    domains = ["a.com", "c.com", "d.com", "e.com"]
+    assert list(history.new_since(domains, datetime.date(2020, 3, 1))) == ["c.com", "d.com", "e.com"]
+    assert list(history.new_since(domains, datetime.date(2020, 3, 2))) == ["d.com", "e.com"]
+
+@pytest.mark.parametrize("today, months, then", [
+    ((2021, 5, 17), 2, (2021, 3, 17)),
+    ((2021, 1, 17), 2, (2020, 11, 17)),
+    ((2021, 4, 30), 2, (2021, 2, 28)),
+])
+def test_months_ago(today, months, then):
+    assert months_ago(months, datetime.date(*today)) == datetime.date(*then)
@@ -0,0 +1,59 @@
+import census.parsers  # Registers the strategies.
+import census.report_helpers
+from census.report_helpers import ReportData, strategy_stats
+from census.sites import Attempt, Site
+
+
+def test_report_data_computes_once(monkeypatch):
+    calls = []
+    def courses_and_orgs(sites):
+        calls.append(len(sites))
+        return {}, {}, set()
+    monkeypatch.setattr(census.report_helpers, "courses_and_orgs", courses_and_orgs)
+
+    counted, uncounted = Site.from_url("https://one.com"), Site.from_url("https://two.com")
+    counted.current_courses = 10
+    data = ReportData([counted, uncounted])
+    first = data.courses_and_orgs()
+    assert data.courses_and_orgs() is first
+    assert data.sites(skip_none=True) == [counted]
+    data.courses_and_orgs(skip_none=True)
+    data.courses_and_orgs(skip_none=True)
+    assert calls == [2, 1]
+
+def test_strategy_stats():
+    one, two, three = (Site.from_url(f"https://{n}.com") for n in ["one", "two", "three"])
+    one.tried = [
+        Attempt("course_api", error="GotZero: No course api", requests=1, wall_time=0.5),
+        Attempt("courses_page_full_of_tiles", courses=12, requests=2, wall_time=1.0),
+        Attempt("home_page_full_of_tiles", courses=12, requests=1, wall_time=1.0),
+    ]
+    one.current_courses = 12
+    # Two parsers counted, the larger count won.
+    two.tried = [
+        Attempt("courses_page_full_of_tiles", courses=3, requests=1),
+        Attempt("home_page_full_of_tiles", courses=8, requests=1),
+    ]
+    two.current_courses = 8
+    three.tried = [Attempt("course_api", courses=40, requests=2, cpu_time=0.25)]
+    three.current_courses = 40
+    three.enrichments = [Attempt("contact_page", requests=1)]
+    one.enrichments = [Attempt("contact_page", error="HttpError: 404", error_kind="http", requests=1)]
+
+    stats = strategy_stats([one, two, three])
+    by_name = {st.name: st for st in stats}
+    summary = {
+        name: (st.tried, st.succeeded, st.final, st.requests)
+        for name, st in by_name.items() if st.tried
+    }
+    assert summary == {
+        "course_api": (2, 1, 1, 3),
+        "courses_page_full_of_tiles": (2, 2, 1, 3),
+        "home_page_full_of_tiles": (2, 2, 1, 2),
+        "contact_page": (2, 1, 0, 2),
+    }
+    assert by_name["course_api"].wall_time == 0.5
+    assert by_name["course_api"].cpu_time == 0.25
+    # Untried strategies are listed too, and enrichers come last.
+    assert by_name["edx_search_post"].tried == 0
+    assert stats[-1].name == "contact_page"
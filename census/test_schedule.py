@@ -0,0 +1,40 @@
+import asyncio
+
+from census.schedule import prior_costs, schedule
+from census.session import PrioritySemaphore
+from census.sites import Attempt, Site
+
+def test_priority_semaphore():
+    order = []
+    async def worker(sem, name, priority):
+        await sem.acquire(priority)
+        order.append(name)
+        await asyncio.sleep(0)
+        sem.release()
+
+    async def main():
+        sem = PrioritySemaphore(1)
+        await sem.acquire()
+        tasks = [
+            asyncio.ensure_future(worker(sem, name, priority))
+            for name, priority in [("a", 5), ("b", 1), ("c", 5), ("d", -2)]
+        ]
+        await asyncio.sleep(0)
+        sem.release()
+        await asyncio.gather(*tasks)
+        assert sem.value == 1
+
+    asyncio.run(main())
+    assert order == ["d", "b", "a", "c"]
+
+def test_schedule():
+    sites = [Site.from_url(f"https://{n}.com") for n in "abcd"]
+    sites[0].tried = [Attempt("x", wall_time=3.0, wait_time=2.5)]
+    sites[1].tried = [Attempt("x", wall_time=10.0, wait_time=1.0), Attempt("y", wall_time=2.0)]
+    sites[2].time = 4.0
+    costs = prior_costs(sites)
+    assert costs == {"https://a.com": 0.5, "https://b.com": 11.0, "https://c.com": 4.0}
+    scheduled = schedule(sites, costs)
+    assert [(site.url, priority) for site, priority in scheduled] == [
+        ("https://b.com", -11.0), ("https://c.com", -4.0), ("https://d.com", -4.0), ("https://a.com", -0.5),
+    ]
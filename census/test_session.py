@@ -0,0 +1,104 @@
+import asyncio
+import socket
+import ssl
+import types
+
+import aiohttp
+import aiohttp.web
+import pytest
+
+from census.helpers import HttpError
+from census.origins import OriginMap
+from census.session import SessionFactory, UNABLE_TO_GET_ISSUER_CERT_LOCALLY, error_kind
+
+def test_error_kind():
+    assert error_kind(asyncio.TimeoutError()) == "timeout"
+    assert error_kind(aiohttp.ClientResponseError(None, (), status=503)) == "http"
+    assert error_kind(aiohttp.ServerDisconnectedError()) == "disconnected"
+    assert error_kind(ValueError("what?")) == "error"
+
+def test_error_kind_connections():
+    # Older aiohttp has no ClientConnectorDNSError, only the os_error.
+    key = types.SimpleNamespace(host="example.com", port=80, ssl=False)
+    dns_error = socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+    assert error_kind(aiohttp.ClientConnectorError(key, dns_error)) == "dns"
+    assert error_kind(aiohttp.ClientConnectorError(key, ConnectionRefusedError())) == "refused"
+    assert error_kind(aiohttp.ClientConnectorError(key, OSError("no route"))) == "connect"
+
+def test_error_kind_certificates():
+    cert_error = ssl.SSLCertVerificationError("certificate verify failed")
+    cert_error.verify_code = 10     # expired
+    assert error_kind(cert_error) == "tls_verify"
+    cert_error.verify_code = UNABLE_TO_GET_ISSUER_CERT_LOCALLY
+    assert error_kind(cert_error) == "tls_issuer"
+
+def test_request_errors_are_classified():
+    async def fetch():
+        async with SessionFactory().new(listeners=[]) as session:
+            await session.text_from_url("http://127.0.0.1:1/hello")
+
+    # Nothing listens on port 1.
+    with pytest.raises(HttpError) as exc_info:
+        asyncio.run(fetch())
+    assert exc_info.value.kind == "refused"
+    assert exc_info.value.status is None
+    assert exc_info.value.url == "http://127.0.0.1:1/hello"
+
+def test_stale_origins_are_forgotten():
+    async def hello(request):
+        return aiohttp.web.Response(text="Hello")
+
+    async def fetch():
+        app = aiohttp.web.Application()
+        app.router.add_get("/hello", hello)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        url = f"http://127.0.0.1:{port}/hello"
+        origins = OriginMap()
+        # We think the site has moved to port 1, but nothing listens there.
+        origins.origins[f"http://127.0.0.1:{port}"] = "http://127.0.0.1:1"
+        try:
+            async with SessionFactory(origins=origins).new(listeners=[]) as session:
+                text = await session.text_from_url(url)
+                assert session.requests == 2
+        finally:
+            await runner.cleanup()
+        return text, origins.rewrite(url) == url
+
+    assert asyncio.run(fetch()) == (b"Hello", True)
+
+def test_stale_origins_that_answer_are_forgotten():
+    async def hello(request):
+        return aiohttp.web.Response(text="Hello")
+
+    async def serve(app):
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    async def fetch():
+        app = aiohttp.web.Application()
+        app.router.add_get("/hello", hello)
+        runner, origin = await serve(app)
+        # The site used to redirect to a host that now only says 404.
+        old_runner, old_origin = await serve(aiohttp.web.Application())
+        origins = OriginMap()
+        origins.origins[origin] = old_origin
+        try:
+            async with SessionFactory(origins=origins).new(listeners=[]) as session:
+                text = await session.text_from_url(origin + "/hello")
+                assert session.requests == 2
+        finally:
+            await runner.cleanup()
+            await old_runner.cleanup()
+        return text, origins.origins, origin
+
+    text, known, origin = asyncio.run(fetch())
+    assert text == b"Hello"
+    # What we know now is that the site doesn't redirect.
+    assert known == {origin: origin}
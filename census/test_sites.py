@@ -0,0 +1,116 @@
+import pickle
+
+from census.course_ids import CourseIdTable
+from census.domains import DomainIndex
+from census.report_helpers import hash_sites_together
+from census.sites import Site, courses_and_orgs, enrich_mode, overcount, overcount_details
+
+def make_sites():
+    table = CourseIdTable()
+    site1 = Site.from_url("https://one.com")
+    site2 = Site.from_url("https://two.com")
+    for site in [site1, site2]:
+        site.course_id_table = table
+    site1.add_course_id("course-v1:MITx+6.00.1x+2T2020")
+    site1.add_course_id("course-v1:MITx+6.00.1x+2T2020")
+    site1.add_course_id("not a course id")
+    site2.add_course_id("course-v1:MITx+6.00.1x+3T2020")
+    site2.add_course_id("MITx/6.00x/2012_Fall")
+    return [site1, site2]
+
+def test_add_course_id():
+    site1, site2 = make_sites()
+    table = site1.course_id_table
+    assert len(table) == 4
+    assert site1.course_ids[table.intern("course-v1:MITx+6.00.1x+2T2020")] == 2
+    assert table.intern("course-v1:MITx+6.00.1x+2T2020") in site1.course_ids
+
+def test_courses_and_orgs():
+    sites = make_sites()
+    all_courses, all_orgs, all_course_ids = courses_and_orgs(sites)
+    assert all_courses == {
+        "MITx+6.00.1x": set(sites),
+        "MITx+6.00x": {sites[1]},
+        "not a course id": {sites[0]},
+    }
+    assert all_orgs == {"MITx": set(sites)}
+    assert len(all_course_ids) == 4
+
+def test_pickled_sites_share_a_table():
+    sites = pickle.loads(pickle.dumps(make_sites()))
+    assert sites[0].course_id_table is sites[1].course_id_table
+    all_courses, _, _ = courses_and_orgs(sites)
+    assert all_courses["MITx+6.00.1x"] == set(sites)
+
+def test_overcount():
+    one, two, three, four = [Site.from_url(f"https://{n}.com") for n in "abcd"]
+    all_courses = {
+        "MITx+6.00x": {one, two, three},
+        "Microsoft+DAT101x": {one},
+        "Microsoft+DAT102x": {one, two},
+        "Microsoft+DAT103x": {one},
+        "Microsoft+CS1": {one},
+        # Re-labelled Microsoft courses: three is enough to count.
+        "Contoso+DAT101x": {three},
+        "Contoso+DAT102x": {three},
+        "Contoso+DAT103x": {three, four},
+        # Only two, not counted.
+        "Fabrikam+DAT101x": {four},
+        "Fabrikam+DAT102x": {four},
+        # Course numbers too short or numeric are not counted.
+        "Other+DAT101x": {four},
+        "Other+DAT102x": {four},
+        "Other+CS1": {four},
+        "not a course id": {four},
+    }
+    true_dups, reorged = overcount_details(all_courses)
+    assert true_dups == 4
+    assert reorged == {"Microsoft": {"Contoso": 3}, "BigDataUniversity": {}}
+    assert overcount(all_courses) == 7
+
+def test_simhash_clustering():
+    page = b" ".join(b"<p>word%d</p>" % i for i in range(500))
+    sites = [Site.from_url(f"https://site{i}.com") for i in range(4)]
+    sites[0].process_text(page)
+    sites[1].process_text(page.replace(b"word10<", b"token=a8f3<"))
+    sites[2].process_text(page.replace(b"word10<", b"token=77b2<"))
+    sites[3].process_text(b" ".join(b"<li>other%d</li>" % i for i in range(500)))
+    for site in sites:
+        site.finish_pages()
+    assert len({site.fingerprint for site in sites}) == 4
+
+    hashed = hash_sites_together(sites, DomainIndex())
+    assert len(hashed) == 4
+    clustered = hash_sites_together(sites, DomainIndex(), cluster=True)
+    assert sorted(len(hs.sites) for hs in clustered) == [1, 3]
+
+def test_alias_results():
+    lms = Site.from_url("https://lms.example.org")
+    lms.current_courses = 2
+    lms.add_course_id("course-v1:Org+C1+2020")
+    lms.add_course_id("course-v1:Org+C2+2020")
+    lms.tags.add("tiles")
+    alias = Site.from_url("http://courses.example.com")
+    alias.copy_results_from(lms)
+    assert alias.alias_of == "https://lms.example.org"
+    assert alias.current_courses == 2
+    assert alias.course_ids == lms.course_ids
+    assert alias.course_id_table is lms.course_id_table
+    assert alias.other_info == ["lms.example.org"]
+    alias.tags.add("alias")
+    assert lms.tags == {"tiles"}
+
+
+def test_emails_left_for_later():
+    page = b"<html>Write to us@hello.com</html>"
+    site = Site.from_url("http://hello.com")
+    token = enrich_mode.set("deferred")
+    try:
+        site.process_text(page)
+    finally:
+        enrich_mode.reset(token)
+    assert site.emails == []
+    site.find_deferred_emails()
+    assert site.emails == ["us@hello.com"]
+    site.find_deferred_emails()
+    assert site.emails == ["us@hello.com"]